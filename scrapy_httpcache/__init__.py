@@ -1,12 +1,22 @@
 """
 scrapy-httpcache - a Scrapy Downloader Middleware
 """
+from .lazy import lazy_attributes
 
-# Package version
-import pkgutil
-__version__ = pkgutil.get_data(__package__, 'VERSION').decode('ascii').strip()
-version_info = tuple(int(v) if v.isdigit() else v
-                     for v in __version__.split('.'))
-del pkgutil
 
-from .middleware import HttpCacheMiddleware
+def _version():
+    import pkgutil
+    return pkgutil.get_data(__package__, 'VERSION').decode('ascii').strip()
+
+
+def _version_info():
+    return tuple(int(v) if v.isdigit() else v
+                 for v in _version().split('.'))
+
+
+# Loaded on first use, as Scrapy loads the package for its commands
+__getattr__, __dir__, __all__ = lazy_attributes(__name__, {
+    '__version__': _version,
+    'version_info': _version_info,
+    'HttpCacheMiddleware': '.middleware',
+})
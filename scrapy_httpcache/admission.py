@@ -0,0 +1,134 @@
+"""
+Admission filter deciding which cacheable responses are worth storing.
+"""
+import os
+from fnmatch import fnmatch
+
+from scrapy.utils.project import data_path
+from scrapy.utils.python import to_unicode
+from scrapy.utils.request import request_fingerprint
+
+
+class FrequencySketch(object):
+    """ Approximate count of how often keys (request fingerprints) are seen,
+    in a count-min sketch of 4 rows of ``width`` saturating counters, as used
+    by TinyLFU.
+
+    All counters are halved every ``10 * width`` additions, so that counts
+    reflect recent history.
+    """
+
+    ROWS = 4
+    MAX_COUNT = 15
+
+    def __init__(self, width=65536):
+        self.width = width
+        self.counters = bytearray(self.ROWS * width)
+        self.additions = 0
+
+    def add(self, key):
+        """Count the key once more and return its estimated count."""
+        indexes = self._indexes(key)
+        count = min(self.counters[i] for i in indexes)
+        if count < self.MAX_COUNT:
+            count += 1
+            # conservative update, only raise the lowest counters
+            for i in indexes:
+                if self.counters[i] < count:
+                    self.counters[i] = count
+        self.additions += 1
+        if self.additions >= 10 * self.width:
+            self.reset()
+        return count
+
+    def estimate(self, key):
+        return min(self.counters[i] for i in self._indexes(key))
+
+    def reset(self):
+        self.counters = bytearray(c >> 1 for c in self.counters)
+        self.additions //= 2
+
+    def _indexes(self, key):
+        # fingerprints are SHA1 hex digests, each row uses 8 of their digits
+        return [row * self.width + int(key[row * 8:row * 8 + 8], 16) % self.width
+                for row in range(self.ROWS)]
+
+
+class AdmissionFilter(object):
+    """ Reject cacheable responses that are not worth their storage writes.
+
+    Responses are rejected if:
+
+    * their request has not been seen ``frequency`` times yet (as estimated
+      by a :class:`FrequencySketch`, kept in the cache directory between
+      runs), so that pages only requested once are not stored
+    * their body is larger than ``max_body_size`` bytes
+    * their content type does not match any of ``content_types``, if set,
+      or matches any of ``ignore_content_types`` (shell-style patterns like
+      ``'image/*'``)
+    """
+
+    def __init__(self, cachedir, frequency=0, max_body_size=0, content_types=(),
+                 ignore_content_types=(), sketch_width=65536):
+        self.cachedir = cachedir
+        self.frequency = frequency
+        self.max_body_size = max_body_size
+        self.content_types = [t.lower() for t in content_types]
+        self.ignore_content_types = [t.lower() for t in ignore_content_types]
+        self.sketch_width = sketch_width
+        self.sketches = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(data_path(settings['HTTPCACHE_DIR'], createdir=True),
+                   frequency=settings.getint('HTTPCACHE_ADMISSION_FREQUENCY', 0),
+                   max_body_size=settings.getint('HTTPCACHE_ADMISSION_MAX_BODY_SIZE', 0),
+                   content_types=settings.getlist('HTTPCACHE_ADMISSION_CONTENT_TYPES'),
+                   ignore_content_types=settings.getlist(
+                       'HTTPCACHE_ADMISSION_IGNORE_CONTENT_TYPES'),
+                   sketch_width=settings.getint('HTTPCACHE_ADMISSION_SKETCH_WIDTH', 65536))
+
+    @property
+    def enabled(self):
+        return bool(self.frequency > 1 or self.max_body_size > 0 or
+                    self.content_types or self.ignore_content_types)
+
+    def open_spider(self, spider):
+        if self.frequency > 1:
+            sketch = self.sketches[spider] = FrequencySketch(self.sketch_width)
+            path = self._sketch_path(spider)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    counters = bytearray(f.read())
+                if len(counters) == len(sketch.counters):  # same width
+                    sketch.counters = counters
+
+    def close_spider(self, spider):
+        sketch = self.sketches.pop(spider, None)
+        if sketch is not None:
+            with open(self._sketch_path(spider), 'wb') as f:
+                f.write(bytes(sketch.counters))
+
+    def reject(self, spider, request, response, firsthand=True):
+        """Return why the response should not be stored (``'frequency'``,
+        ``'size'`` or ``'content_type'``), or None to store it. The request
+        frequency is only counted and checked for ``firsthand`` responses,
+        the others having been stored already."""
+        if 0 < self.max_body_size < len(response.body):
+            return 'size'
+        if self.content_types or self.ignore_content_types:
+            ctype = to_unicode(response.headers.get(b'Content-Type') or b'',
+                               errors='replace')
+            ctype = ctype.split(';')[0].strip().lower()
+            if self.content_types and \
+                    not any(fnmatch(ctype, t) for t in self.content_types):
+                return 'content_type'
+            if any(fnmatch(ctype, t) for t in self.ignore_content_types):
+                return 'content_type'
+        sketch = self.sketches.get(spider)
+        if firsthand and sketch is not None and \
+                sketch.add(request_fingerprint(request)) < self.frequency:
+            return 'frequency'
+
+    def _sketch_path(self, spider):
+        return os.path.join(self.cachedir, '%s.admission' % spider.name)
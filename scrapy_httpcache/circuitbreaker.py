@@ -0,0 +1,52 @@
+"""
+Per-host circuit breaker for the HttpCache middleware.
+"""
+from time import time
+
+
+class CircuitBreaker(object):
+    """ Track consecutive download failures per host.
+
+    After ``failures`` consecutive failures for a host the breaker opens and
+    no network attempt is allowed for ``cooldown`` seconds. After that, a
+    single probe attempt is allowed at a time: a success closes the breaker,
+    a failure opens it again for another cooldown. A probe that never
+    completes is replaced by a new one after a further cooldown.
+    """
+
+    def __init__(self, failures, cooldown, clock=time):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.clock = clock
+        # host -> [consecutive failures, opened at, probe started at]
+        self._hosts = {}
+
+    def is_open(self, host):
+        state = self._hosts.get(host)
+        return state is not None and state[1] is not None
+
+    def allow(self, host):
+        """Return True if a network attempt to the host is allowed."""
+        state = self._hosts.get(host)
+        if state is None or state[1] is None:
+            return True  # closed
+        now = self.clock()
+        if now - state[1] < self.cooldown:
+            return False  # open
+        if state[2] is not None and now - state[2] < self.cooldown:
+            return False  # half-open, probe in flight
+        state[2] = now
+        return True
+
+    def success(self, host):
+        self._hosts.pop(host, None)
+
+    def failure(self, host):
+        """Record a failure, return True if it opened the breaker."""
+        state = self._hosts.setdefault(host, [0, None, None])
+        state[0] += 1
+        if state[2] is not None or (state[1] is None and state[0] >= self.failures):
+            state[1] = self.clock()
+            state[2] = None
+            return True
+        return False
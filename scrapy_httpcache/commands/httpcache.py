@@ -0,0 +1,376 @@
+"""
+The ``scrapy httpcache`` command, to inspect and clean up the HTTP cache of
+a spider, whatever its storage backend.
+"""
+from __future__ import print_function, division
+
+import time
+import multiprocessing
+
+from six.moves.urllib.parse import urlparse
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import data_path
+
+
+ACTIONS = ('stats', 'purge', 'verify', 'simulate', 'import', 'compact', 'export')
+
+# histogram bucket upper bounds, the last bucket has none
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2)
+AGE_BUCKETS = (3600, 86400, 7 * 86400, 30 * 86400, 365 * 86400)
+
+
+class CacheReport(object):
+    """ What a scan of a cache found, merged over worker processes. """
+
+    def __init__(self):
+        self.entries = 0
+        self.bytes = 0
+        self.sizes = [0] * (len(SIZE_BUCKETS) + 1)
+        self.ages = [0] * (len(AGE_BUCKETS) + 1)
+        self.statuses = {}
+        self.domains = {}
+        self.purged = 0
+        self.purged_bytes = 0
+        self.invalid = []
+        self.deletes = []  # keys of the entries to delete
+
+    def add(self, response, size, now):
+        self.entries += 1
+        self.bytes += size
+        self.sizes[_bucket(size, SIZE_BUCKETS)] += 1
+        self.ages[_bucket(now - response.cache_timestamp, AGE_BUCKETS)] += 1
+        self.statuses[response.status] = self.statuses.get(response.status, 0) + 1
+        domain = urlparse(response.url).hostname or ''
+        self.domains[domain] = self.domains.get(domain, 0) + 1
+
+    def merge(self, other):
+        self.entries += other.entries
+        self.bytes += other.bytes
+        self.sizes = [a + b for a, b in zip(self.sizes, other.sizes)]
+        self.ages = [a + b for a, b in zip(self.ages, other.ages)]
+        for counts, others in ((self.statuses, other.statuses), (self.domains, other.domains)):
+            for name, count in others.items():
+                counts[name] = counts.get(name, 0) + count
+        self.purged += other.purged
+        self.purged_bytes += other.purged_bytes
+        self.invalid.extend(other.invalid)
+        self.deletes.extend(other.deletes)
+
+    def format(self, action, domains=10):
+        if action == 'purge':
+            return 'Purged entries: %d (%s)' % (self.purged, _format_size(self.purged_bytes))
+        if action == 'verify':
+            lines = ['Invalid entries: %d' % len(self.invalid)]
+            lines.extend('  %s' % key for key in sorted(self.invalid))
+            return '\n'.join(lines)
+        lines = ['Entries: %d' % self.entries, 'Size: %s' % _format_size(self.bytes), '']
+        lines.append('Body sizes:')
+        lines.extend(_format_histogram(self.sizes, [_format_size(b) for b in SIZE_BUCKETS]))
+        lines.append('Ages:')
+        lines.extend(_format_histogram(self.ages, [_format_age(b) for b in AGE_BUCKETS]))
+        lines.append('Statuses:')
+        lines.extend('  %-10s %d' % (status, count)
+                     for status, count in sorted(self.statuses.items()))
+        lines.append('Domains (top %d):' % domains)
+        top = sorted(self.domains.items(), key=lambda item: (-item[1], item[0]))[:domains]
+        lines.extend('  %-30s %d' % item for item in top)
+        return '\n'.join(lines)
+
+
+def scan(settings, spidername, action='stats', filters=None, delete=False, workers=1,
+         now=None):
+    """Scan the cache of a spider for one of the ``ACTIONS`` and return a
+    :class:`CacheReport`.
+
+    Entries are split between ``workers`` processes, each reading a
+    partition of the cache, if the storage backend can be opened by several
+    processes at once (``parallel_scan``), which only read response
+    bodies to verify them. With ``delete``, the entries matching all the
+    ``filters`` (``older_than``, ``domains``, ``statuses``) are removed when
+    purging, and invalid entries when verifying, by this process once the
+    scan is over, so that workers do not compete for write locks.
+    """
+    storagecls = load_object(settings['HTTPCACHE_STORAGE'])
+    if not getattr(storagecls, 'parallel_scan', False):
+        workers = 1
+    if now is None:
+        now = time.time()
+    # plain values, as settings are sent to the worker processes
+    settings = dict((name, settings[name]) for name in settings)
+    tasks = [(settings, spidername, action, filters or {}, delete, now, partition, workers)
+             for partition in range(workers)]
+    if workers == 1:
+        results = [_scan_partition(tasks[0])]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_scan_partition, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    report = CacheReport()
+    for result in results:
+        report.merge(result)
+    if report.deletes:
+        _delete(settings, spidername, report.deletes)
+        report.deletes = []
+    return report
+
+
+def _scan_partition(task):
+    settings, spidername, action, filters, delete, now, partition, partitions = task
+    settings = Settings(settings)
+    storage = load_object(settings['HTTPCACHE_STORAGE'])(settings)
+    spider = Spider(spidername)
+    report = CacheReport()
+    storage.open_spider(spider, readonly=True)
+    if partitions > 1:
+        entries = storage.iter_partition(spider, partition, partitions)
+    else:
+        entries = storage.iter_entries(spider)
+    # only verifying needs the bodies
+    retrieve = storage.retrieve_entry if action == 'verify' else storage.retrieve_metadata
+    try:
+        for key, size in entries:
+            try:
+                response = retrieve(spider, key)
+            except Exception:
+                response = None  # unreadable
+            if action == 'verify':
+                # the body hash stored with the entry must match its body
+                if response is None or not storage.is_body_unchanged(response, response):
+                    report.invalid.append(key)
+                    if delete:
+                        report.deletes.append(key)
+            elif response is None:
+                continue
+            elif action == 'purge':
+                if _matches(response, filters, now):
+                    report.purged += 1
+                    report.purged_bytes += size
+                    if delete:
+                        report.deletes.append(key)
+            else:
+                report.add(response, size, now)
+    finally:
+        storage.close_spider(spider)
+    return report
+
+
+def _delete(settings, spidername, keys):
+    settings = Settings(settings)
+    storage = load_object(settings['HTTPCACHE_STORAGE'])(settings)
+    spider = Spider(spidername)
+    storage.open_spider(spider)
+    try:
+        for key in keys:
+            storage.delete_response(spider, key)
+    finally:
+        storage.close_spider(spider)
+
+
+def export(settings, spidername, path):
+    """Copy the cache of a spider to a WARC cache (see
+    :class:`~scrapy_httpcache.storage.WarcCacheStorage`) in the ``path``
+    directory, in the order its responses were first stored (that of their
+    last update for storages not keeping it, see ``ordered_scan``), and
+    return how many were copied."""
+    from ..storage.warc import WarcCacheStorage
+    storage = load_object(settings['HTTPCACHE_STORAGE'])(settings)
+    targetsettings = settings.copy()
+    targetsettings.set('HTTPCACHE_DIR', path, priority='cmdline')
+    target = WarcCacheStorage(targetsettings)
+    spider = Spider(spidername)
+    exported = 0
+    storage.open_spider(spider, readonly=True)
+    target.open_spider(spider)
+    try:
+        if storage.ordered_scan:
+            keys = [key for key, _ in storage.iter_stored(spider)]
+        else:
+            # read twice, rather than keeping all responses in memory, in
+            # the order of their last update
+            entries = []
+            for key, _ in storage.iter_entries(spider):
+                response = storage.retrieve_metadata(spider, key)
+                if response is not None:
+                    entries.append((response.cache_timestamp, key))
+            keys = [key for _, key in sorted(entries)]
+        for key in keys:
+            response = storage.retrieve_entry(spider, key)
+            if response is not None:
+                target.copy_entry(spider, key, response)
+                exported += 1
+    finally:
+        target.close_spider(spider)
+        storage.close_spider(spider)
+    return exported
+
+
+def _matches(response, filters, now):
+    if filters.get('older_than') is not None and \
+            now - response.cache_timestamp <= filters['older_than']:
+        return False
+    if filters.get('domains'):
+        host = urlparse(response.url).hostname or ''
+        if not any(host == d or host.endswith('.' + d) for d in filters['domains']):
+            return False
+    if filters.get('statuses') and response.status not in filters['statuses']:
+        return False
+    return True
+
+
+def _bucket(value, bounds):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+    return len(bounds)
+
+
+def _format_histogram(counts, labels):
+    labels = ['<= %s' % label for label in labels] + ['> %s' % labels[-1]]
+    return ['  %-10s %d' % item for item in zip(labels, counts)]
+
+
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return '%g %s' % (round(size, 1), unit)
+        size /= 1024
+
+
+def _format_age(secs):
+    for unit, length in (('d', 86400), ('h', 3600), ('s', 1)):
+        if secs >= length and secs % length == 0:
+            return '%d%s' % (secs // length, unit)
+
+
+class Command(ScrapyCommand):
+
+    requires_project = False
+    default_settings = {'LOG_ENABLED': False}
+
+    def syntax(self):
+        return "<%s> <spider> [WARC file ...|directory] [options]" % '|'.join(ACTIONS)
+
+    def short_desc(self):
+        return "Inspect, clean up, simulate, seed or reorder the HTTP cache of a spider"
+
+    def long_desc(self):
+        return ("stats: show the number, size, age, status and domain of cached "
+                "responses. purge: remove the cached responses matching all of "
+                "--older-than, --domain and --status. verify: list (or --delete) "
+                "cached responses that cannot be read or do not match their "
+                "body hash. simulate: replay the trace recorded with "
+                "HTTPCACHE_TRACE (or --trace) against the cache settings, "
+                "e.g. given with -s. import: store the responses of WARC "
+                "files, with a storage which supports it. compact: rewrite "
+                "the cache in the order responses were stored, with a storage "
+                "which supports it. export: copy the cache to a WARC cache in "
+                "the given directory, in that order.")
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        # argparse since Scrapy 2.6, optparse before
+        add = getattr(parser, 'add_argument', None) or parser.add_option
+        add("-w", "--workers", metavar="N",
+            help="number of worker processes (default: number of CPUs), for "
+                 "storage backends which support it")
+        add("--older-than", metavar="SECONDS",
+            help="purge: responses stored more than SECONDS ago")
+        add("--domain", metavar="DOMAIN", action="append", default=[],
+            help="purge: responses of DOMAIN or its subdomains (may be repeated)")
+        add("--status", metavar="CODE", action="append", default=[],
+            help="purge: responses with status CODE (may be repeated)")
+        add("--dry-run", action="store_true",
+            help="purge: only count the matching responses")
+        add("--delete", action="store_true",
+            help="verify: remove invalid entries")
+        add("--trace", metavar="FILE",
+            help="simulate: trace file (default: <spider>.trace in HTTPCACHE_DIR)")
+
+    def run(self, args, opts):
+        if len(args) < 2 or args[0] not in ACTIONS:
+            raise UsageError()
+        action, spidername = args[:2]
+        if action == 'import':
+            return self._import(spidername, args[2:])
+        if action != 'simulate':
+            self._check_cache(spidername)
+        if action == 'export':
+            if len(args) != 3:
+                raise UsageError("export requires a directory")
+            print("Exported responses: %d" % export(self.settings, spidername, args[2]))
+            return
+        if len(args) != 2:
+            raise UsageError()
+        if action == 'simulate':
+            return self._simulate(spidername, opts)
+        if action == 'compact':
+            return self._compact(spidername)
+        try:
+            workers = int(opts.workers) if opts.workers else multiprocessing.cpu_count()
+            filters = {
+                'older_than': float(opts.older_than) if opts.older_than else None,
+                'domains': [d.lower().strip('.') for d in opts.domain],
+                'statuses': [int(s) for s in opts.status],
+            }
+        except ValueError as e:
+            raise UsageError(str(e))
+        if action == 'purge' and not (filters['older_than'] is not None or
+                                      filters['domains'] or filters['statuses']):
+            raise UsageError("purge requires --older-than, --domain or --status")
+        delete = not opts.dry_run if action == 'purge' else opts.delete
+        report = scan(self.settings, spidername, action, filters,
+                      delete=delete, workers=max(1, workers))
+        print(report.format(action))
+        if action == 'verify' and report.invalid and not opts.delete:
+            self.exitcode = 1
+
+    def _simulate(self, spidername, opts):
+        from ..trace import CacheSimulator, read_trace, trace_path
+        path = opts.trace or trace_path(data_path(self.settings['HTTPCACHE_DIR']), spidername)
+        try:
+            simulator = CacheSimulator.from_settings(self.settings)
+            events = list(read_trace(path))
+        except (IOError, ValueError) as e:
+            raise UsageError(str(e))
+        print(simulator.run(events).format())
+
+    def _check_cache(self, spidername):
+        # rather than creating an empty one
+        storage = load_object(self.settings['HTTPCACHE_STORAGE'])(self.settings)
+        if not storage.exists(Spider(spidername)):
+            raise UsageError("No HTTP cache for spider %r in %s" % (spidername, storage.cachedir))
+
+    def _compact(self, spidername):
+        storage = load_object(self.settings['HTTPCACHE_STORAGE'])(self.settings)
+        if not hasattr(storage, 'compact'):
+            raise UsageError("%s cannot be compacted" % storage.__class__.__name__)
+        spider = Spider(spidername)
+        storage.open_spider(spider)
+        try:
+            reclaimed = storage.compact(spider)
+        finally:
+            storage.close_spider(spider)
+        print("Reclaimed: %s" % _format_size(max(0, reclaimed)))
+
+    def _import(self, spidername, paths):
+        if not paths:
+            raise UsageError("import requires WARC files")
+        storage = load_object(self.settings['HTTPCACHE_STORAGE'])(self.settings)
+        if not hasattr(storage, 'import_warc'):
+            raise UsageError("%s cannot import WARC files" % storage.__class__.__name__)
+        spider = Spider(spidername)
+        imported = 0
+        storage.open_spider(spider)
+        try:
+            for path in paths:
+                imported += storage.import_warc(spider, path)
+        finally:
+            storage.close_spider(spider)
+        print("Imported responses: %d" % imported)
@@ -0,0 +1,51 @@
+"""
+The ``scrapy httpcacheserver`` command, to share the HTTP cache storage of
+the project with the crawlers using a ``RemoteCacheStorage``.
+"""
+from __future__ import print_function
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.misc import load_object
+
+
+class Command(ScrapyCommand):
+
+    requires_project = False
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Serve the HTTP cache storage to remote crawlers"
+
+    def long_desc(self):
+        return ("Serve the storage set in HTTPCACHE_STORAGE over HTTP, for "
+                "crawlers using scrapy_httpcache.storage.RemoteCacheStorage "
+                "with HTTPCACHE_REMOTE_URL pointing to this server.")
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        # argparse since Scrapy 2.6, optparse before
+        add = getattr(parser, 'add_argument', None) or parser.add_option
+        add("-p", "--port", metavar="PORT", default="6810",
+            help="port to listen on (default: 6810)")
+        add("-b", "--bind", metavar="ADDRESS", default="127.0.0.1",
+            help="address to listen on (default: 127.0.0.1)")
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+        try:
+            port = int(opts.port)
+        except ValueError as e:
+            raise UsageError(str(e))
+        from twisted.internet import reactor
+        from twisted.web.server import Site
+        from ..server import CacheServerResource
+        storage = load_object(self.settings['HTTPCACHE_STORAGE'])(self.settings)
+        root = CacheServerResource(storage)
+        reactor.listenTCP(port, Site(root), interface=opts.bind)
+        reactor.addSystemEventTrigger('before', 'shutdown', root.close)
+        print("Serving %s on http://%s:%d/" % (storage.__class__.__name__, opts.bind, port))
+        reactor.run()
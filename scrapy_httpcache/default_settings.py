@@ -14,11 +14,46 @@ HTTPCACHE_DIR = 'httpcache'
 HTTPCACHE_IGNORE_MISSING = False
 HTTPCACHE_STORAGE = 'scrapy_httpcache.storage.FilesystemCacheStorage'
 HTTPCACHE_EXPIRATION_SECS = 0
+HTTPCACHE_EXPIRATION_DOMAINS = {}
+HTTPCACHE_EXPIRATION_PATTERNS = []
 HTTPCACHE_ALWAYS_STORE = False
 HTTPCACHE_IGNORE_HTTP_CODES = []
 HTTPCACHE_IGNORE_SCHEMES = ['file']
 HTTPCACHE_IGNORE_RESPONSE_CACHE_CONTROLS = []
 HTTPCACHE_DBM_MODULE = 'anydbm' if six.PY2 else 'dbm'
 HTTPCACHE_DB_MODULE = None
+HTTPCACHE_WARC_MAX_SIZE = 1024 ** 3
+HTTPCACHE_SHARDS = {}
+HTTPCACHE_SHARD_STORAGE = 'scrapy_httpcache.storage.FilesystemCacheStorage'
+HTTPCACHE_SHARD_VNODES = 160
+HTTPCACHE_REMOTE_URL = 'http://127.0.0.1:6810'
+HTTPCACHE_REMOTE_POOL_SIZE = 4
+HTTPCACHE_REMOTE_TIMEOUT = 30
+HTTPCACHE_REMOTE_BATCH_SIZE = 20
+HTTPCACHE_REMOTE_LOCAL_STORAGE = None
+HTTPCACHE_BLOB_THRESHOLD = 0
+HTTPCACHE_MAX_SIZE = 0
+HTTPCACHE_MAX_ENTRIES = 0
+HTTPCACHE_EVICTION_POLICY = 'lru'
+HTTPCACHE_EVICTION_BATCH_SIZE = 100
+HTTPCACHE_ADMISSION_FREQUENCY = 0
+HTTPCACHE_ADMISSION_MAX_BODY_SIZE = 0
+HTTPCACHE_ADMISSION_CONTENT_TYPES = []
+HTTPCACHE_ADMISSION_IGNORE_CONTENT_TYPES = []
+HTTPCACHE_ADMISSION_SKETCH_WIDTH = 65536
 HTTPCACHE_POLICY = 'scrapy_httpcache.policy.DummyPolicy'
 HTTPCACHE_GZIP = False
+HTTPCACHE_FS_FANOUT_DEPTH = 1
+HTTPCACHE_FS_FANOUT_WIDTH = 2
+HTTPCACHE_INSTRUMENTATION = False
+HTTPCACHE_TRACE = False
+HTTPCACHE_COLLAPSE_REQUESTS = False
+HTTPCACHE_WRITE_BEHIND = False
+HTTPCACHE_WRITE_BEHIND_MAX_BYTES = 64 * 1024 * 1024
+HTTPCACHE_WRITE_BEHIND_BATCH_SIZE = 100
+HTTPCACHE_WRITE_BEHIND_INTERVAL = 1.0
+HTTPCACHE_CIRCUIT_BREAKER_FAILURES = 0
+HTTPCACHE_CIRCUIT_BREAKER_COOLDOWN = 60
+HTTPCACHE_ADAPTIVE_STALENESS = 0.1
+HTTPCACHE_ADAPTIVE_MIN_LIFETIME = 60
+HTTPCACHE_ADAPTIVE_MAX_LIFETIME = 30 * 86400
@@ -0,0 +1,253 @@
+"""
+Size bound for cache storages, with LRU or LFU eviction.
+"""
+from collections import OrderedDict
+
+from twisted.internet import defer
+from scrapy.utils.request import request_fingerprint
+
+
+class LRUIndex(object):
+    """ Track cache entries by recency of use. Entries found in the storage
+    (cached by previous runs) are evicted before entries used since. """
+
+    def __init__(self):
+        self._found = OrderedDict()
+        self._used = OrderedDict()  # least recently used first
+
+    def __len__(self):
+        return len(self._found) + len(self._used)
+
+    def found(self, key):
+        if key not in self._used:
+            self._found[key] = None
+
+    def touch(self, key):
+        self._found.pop(key, None)
+        self._used.pop(key, None)
+        self._used[key] = None
+
+    def remove(self, key):
+        self._found.pop(key, None)
+        self._used.pop(key, None)
+
+    def victim(self):
+        for keys in (self._found, self._used):
+            for key in keys:
+                return key
+
+
+class LFUIndex(object):
+    """ Track cache entries by number of uses, the least recently used
+    first among entries used as often. Entries found in the storage have
+    not been used yet. """
+
+    def __init__(self):
+        self._hits = {}
+        self._buckets = {}  # hits -> keys, least recently used first
+
+    def __len__(self):
+        return len(self._hits)
+
+    def found(self, key):
+        if key not in self._hits:
+            self._add(key, 0)
+
+    def touch(self, key):
+        hits = self._hits.get(key)
+        if hits is not None:
+            self.remove(key)
+        self._add(key, (hits or 0) + 1)
+
+    def remove(self, key):
+        hits = self._hits.pop(key, None)
+        if hits is None:
+            return
+        bucket = self._buckets[hits]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[hits]
+
+    def victim(self):
+        if self._buckets:
+            for key in self._buckets[min(self._buckets)]:
+                return key
+
+    def _add(self, key, hits):
+        self._hits[key] = hits
+        self._buckets.setdefault(hits, OrderedDict())[key] = None
+
+
+class _SpiderEntries(object):
+    """ Entries of the cache of one spider, as tracked by
+    :class:`EvictingStorage`. """
+
+    def __init__(self, index, scan):
+        self.index = index
+        self.size = 0
+        self.sizes = {}
+        self.scan = scan
+        self.evicted = set()  # while scanning, as the scan may still find them
+        self.call = None
+
+
+class EvictingStorage(object):
+    """ Bound the size of a cache storage, evicting the least recently
+    (``'lru'``) or least frequently (``'lfu'``) used entries.
+
+    The size is the total size of the cached response bodies (``max_bytes``)
+    and/or the number of cached responses (``max_entries``), bounded for
+    the cache of each spider. Uses are tracked in memory; entries cached by
+    previous runs are found by scanning the storage when the spider is
+    opened.
+
+    Both the scan and the eviction run in the background, ``batch_size``
+    entries at a time, so that the crawl is not stopped while they run. The
+    storage can thus go over its bounds for a short while.
+    """
+
+    INDEXES = {
+        'lru': LRUIndex,
+        'lfu': LFUIndex,
+    }
+
+    # uses are tracked, and entries evicted, from the reactor thread
+    threaded_writes = False
+
+    def __init__(self, storage, stats, max_bytes=0, max_entries=0, policy='lru',
+                 batch_size=100, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if policy not in self.INDEXES:
+            raise ValueError('Unknown eviction policy: %r' % policy)
+        self.storage = storage
+        self.stats = stats
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.policy = policy
+        self.batch_size = batch_size
+        self.clock = clock
+        self.spiders = {}
+
+    @classmethod
+    def from_settings(cls, storage, settings, stats):
+        return cls(storage, stats,
+                   max_bytes=settings.getint('HTTPCACHE_MAX_SIZE', 0),
+                   max_entries=settings.getint('HTTPCACHE_MAX_ENTRIES', 0),
+                   policy=settings.get('HTTPCACHE_EVICTION_POLICY', 'lru').lower(),
+                   batch_size=settings.getint('HTTPCACHE_EVICTION_BATCH_SIZE', 100))
+
+    def __len__(self):
+        return sum(len(entries.sizes) for entries in self.spiders.values())
+
+    @property
+    def size(self):
+        return sum(entries.size for entries in self.spiders.values())
+
+    def open_spider(self, spider):
+        self.storage.open_spider(spider)
+        self.spiders[spider] = _SpiderEntries(self.INDEXES[self.policy](),
+                                              iter(self.storage.iter_entries(spider)))
+        self._schedule(spider)
+
+    def close_spider(self, spider):
+        entries = self.spiders.pop(spider, None)
+        if entries is not None:
+            if entries.call is not None and entries.call.active():
+                entries.call.cancel()
+            self._update_stats(spider, entries)
+        return self.storage.close_spider(spider)
+
+    def retrieve_response(self, spider, request):
+        response = self.storage.retrieve_response(spider, request)
+        if isinstance(response, defer.Deferred):
+            return response.addCallback(self._retrieved, spider, request)
+        return self._retrieved(response, spider, request)
+
+    def _retrieved(self, response, spider, request):
+        if response is not None:
+            self._used(spider, request_fingerprint(request), len(response.body))
+        return response
+
+    def store_response(self, spider, request, response, metadata=None):
+        self.storage.store_response(spider, request, response, metadata)
+        self._used(spider, request_fingerprint(request), len(response.body))
+
+    def update_metadata(self, spider, request, response, metadata=None):
+        self.storage.update_metadata(spider, request, response, metadata)
+        self._used(spider, request_fingerprint(request), len(response.body))
+
+    def is_body_unchanged(self, cachedresponse, response):
+        return self.storage.is_body_unchanged(cachedresponse, response)
+
+    def _cache_metadata(self, response, metadata):
+        return self.storage._cache_metadata(response, metadata)
+
+    def evict(self, spider, limit=None):
+        """Evict entries of the cache of ``spider`` until it is within its
+        bounds, at most ``limit`` of them if set, and return how many were
+        evicted."""
+        entries = self.spiders[spider]
+        evicted = 0
+        while self._full(entries) and (limit is None or evicted < limit):
+            key = entries.index.victim()
+            if key is None:
+                break
+            self.storage.delete_response(spider, key)
+            self._remove(entries, key)
+            if entries.scan is not None:
+                entries.evicted.add(key)
+            evicted += 1
+        if evicted:
+            self.stats.inc_value('httpcache/eviction/evicted', evicted, spider=spider)
+        return evicted
+
+    def _full(self, entries):
+        return (0 < self.max_bytes < entries.size or
+                0 < self.max_entries < len(entries.sizes))
+
+    def _used(self, spider, key, size):
+        entries = self.spiders.get(spider)
+        if entries is None:
+            return  # closed since
+        entries.evicted.discard(key)
+        self._track(entries, key, size)
+        entries.index.touch(key)
+        if self._full(entries):
+            self._schedule(spider)
+
+    def _track(self, entries, key, size):
+        entries.size += size - entries.sizes.get(key, 0)
+        entries.sizes[key] = size
+
+    def _remove(self, entries, key):
+        entries.size -= entries.sizes.pop(key, 0)
+        entries.index.remove(key)
+
+    def _schedule(self, spider):
+        entries = self.spiders[spider]
+        if entries.call is None or not entries.call.active():
+            entries.call = self.clock.callLater(0, self._run_batch, spider)
+
+    def _run_batch(self, spider):
+        entries = self.spiders[spider]
+        entries.call = None
+        if entries.scan is not None:
+            for _ in range(self.batch_size):
+                try:
+                    key, size = next(entries.scan)
+                except StopIteration:
+                    entries.scan = None
+                    entries.evicted = set()
+                    break
+                if key not in entries.sizes and key not in entries.evicted:
+                    self._track(entries, key, size)
+                    entries.index.found(key)
+        self.evict(spider, limit=self.batch_size)
+        self._update_stats(spider, entries)
+        if entries.scan is not None or self._full(entries):
+            self._schedule(spider)
+
+    def _update_stats(self, spider, entries):
+        self.stats.set_value('httpcache/eviction/size', entries.size, spider=spider)
+        self.stats.set_value('httpcache/eviction/entries', len(entries.sizes), spider=spider)
@@ -0,0 +1,203 @@
+"""
+Per-domain and per-URL-pattern expiration rules for cache storages.
+"""
+import re
+from collections import deque
+
+from scrapy.utils.httpobj import urlparse_cached
+
+
+class ExpirationRules(object):
+    """ Resolve the expiration time (in seconds) of cached requests.
+
+    In order of precedence, the expiration time is taken from:
+
+    * the ``httpcache_expiration_secs`` request meta key
+    * the first of ``patterns`` (regular expressions searched in the URL)
+      to match, in declaration order
+    * the longest of ``domains`` matching the request host, either exactly
+      or as a parent domain
+    * ``default``
+
+    Domains are compiled into a trie of domain labels, looked up in a single
+    pass over the host. Literal patterns (with no other special characters
+    than escaped ones and a leading ``^``) are compiled into an
+    Aho-Corasick automaton, looked up in a single pass over the URL, so
+    thousands of them can be used; other patterns are searched one by one.
+    """
+
+    META_KEY = 'httpcache_expiration_secs'
+
+    def __init__(self, default=0, domains=None, patterns=None):
+        self.default = default
+        self._trie = {}
+        for domain, secs in _items(domains):
+            node = self._trie
+            for label in reversed(domain.lower().strip('.').split('.')):
+                node = node.setdefault(label, {})
+            node[None] = int(secs)
+
+        patterns = list(_items(patterns))
+        self._pattern_secs = [int(secs) for _, secs in patterns]
+        self._automaton = None
+        self._regexes = []  # (index, compiled regex), in declaration order
+        for idx, (pattern, _) in enumerate(patterns):
+            try:
+                regex = re.compile(pattern)
+            except re.error as e:
+                raise ValueError('Invalid expiration pattern %r: %s' % (pattern, e))
+            literal = _literal(pattern)
+            if literal is None:
+                self._regexes.append((idx, regex))
+                continue
+            if self._automaton is None:
+                self._automaton = _Automaton(len(patterns))
+            self._automaton.add(literal[0], idx, literal[1])
+        if self._automaton is not None:
+            self._automaton.build()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.getint('HTTPCACHE_EXPIRATION_SECS'),
+                   settings.getdict('HTTPCACHE_EXPIRATION_DOMAINS'),
+                   settings.get('HTTPCACHE_EXPIRATION_PATTERNS'))
+
+    def get_expiration_secs(self, request=None):
+        """Return the expiration time for the request, 0 if it never expires."""
+        if request is None:
+            return self.default
+        secs = request.meta.get(self.META_KEY)
+        if secs is not None:
+            return int(secs)
+        if self._pattern_secs:
+            secs = self._match_pattern(request.url)
+            if secs is not None:
+                return secs
+        if self._trie:
+            secs = self._match_domain(urlparse_cached(request).hostname or '')
+            if secs is not None:
+                return secs
+        return self.default
+
+    def _match_pattern(self, url):
+        # the first declared pattern found anywhere in the URL wins
+        best = len(self._pattern_secs)
+        if self._automaton is not None:
+            best = self._automaton.search(url)
+        for idx, regex in self._regexes:
+            if idx >= best:
+                break
+            if regex.search(url):
+                best = idx
+                break
+        if best == len(self._pattern_secs):
+            return None
+        return self._pattern_secs[best]
+
+    def _match_domain(self, host):
+        node = self._trie
+        secs = node.get(None)
+        for label in reversed(host.lower().split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            secs = node.get(None, secs)
+        return secs
+
+
+class _Automaton(object):
+    """ Aho-Corasick automaton returning the least index of the strings
+    found in a text, ``none`` if there is none. Anchored strings are only
+    found at the start of the text. """
+
+    def __init__(self, none):
+        self.none = none
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.found = [none]     # least index found on reaching a state
+        self.anchored = [none]  # least anchored index ending at a state
+
+    def add(self, text, idx, anchored=False):
+        state = 0
+        for char in text:
+            nextstate = self.goto[state].get(char)
+            if nextstate is None:
+                nextstate = len(self.goto)
+                self.goto[state][char] = nextstate
+                self.goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[state] + 1)
+                self.found.append(self.none)
+                self.anchored.append(self.none)
+            state = nextstate
+        table = self.anchored if anchored else self.found
+        table[state] = min(table[state], idx)
+
+    def build(self):
+        # breadth first, so that failure states are done before their users
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nextstate in self.goto[state].items():
+                queue.append(nextstate)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[nextstate] = fail
+                # strings ending at the failure state are suffixes of this one
+                self.found[nextstate] = min(self.found[nextstate], self.found[fail])
+
+    def search(self, text):
+        goto, fail, found = self.goto, self.fail, self.found
+        best = min(found[0], self.anchored[0])
+        state = 0
+        anchored = True  # all the text so far is a path from the start state
+        for pos, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if found[state] < best:
+                best = found[state]
+            if anchored:
+                if self.depth[state] == pos:
+                    best = min(best, self.anchored[state])
+                else:
+                    anchored = False
+        return best
+
+
+# unescaped characters with a special meaning in regular expressions
+_SPECIAL = frozenset('.^$*+?{}[]|()')
+
+
+def _literal(pattern):
+    """Return the string matched by the pattern and whether it is anchored
+    at the start, or None if the pattern is not a literal one."""
+    anchored = pattern.startswith('^')
+    chars = []
+    escaped = False
+    for char in pattern[1:] if anchored else pattern:
+        if escaped:
+            if char.isalnum() or char == '_':
+                return None  # character classes, backreferences...
+            chars.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in _SPECIAL:
+            return None
+        else:
+            chars.append(char)
+    if escaped:
+        return None
+    return ''.join(chars), anchored
+
+
+def _items(rules):
+    if not rules:
+        return []
+    if isinstance(rules, dict):
+        return rules.items()
+    return rules
@@ -7,10 +7,14 @@
 # Migrating to the form of `scrapy_httpcache.policy.*` and
 # `scrapy_httpcache.storage.*` is preferred however.
 
-from .policy.dummy import DummyPolicy
-from .policy.rfc2616 import RFC2616Policy
+from .lazy import lazy_attributes
 
-from .storage.filesystem import FilesystemCacheStorage
-from .storage.dbm import DbmCacheStorage
-from .storage.leveldb import LeveldbCacheStorage
-from .storage.mongodb import MongodbCacheStorage
+
+__getattr__, __dir__, __all__ = lazy_attributes(__name__, {
+    'DummyPolicy': '.policy.dummy',
+    'RFC2616Policy': '.policy.rfc2616',
+    'FilesystemCacheStorage': '.storage.filesystem',
+    'DbmCacheStorage': '.storage.dbm',
+    'LeveldbCacheStorage': '.storage.leveldb',
+    'MongodbCacheStorage': '.storage.mongodb',
+})
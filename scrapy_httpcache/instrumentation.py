@@ -0,0 +1,104 @@
+"""
+Timing and throughput instrumentation for the HttpCache middleware.
+"""
+from __future__ import division
+
+import math
+from collections import defaultdict
+from timeit import default_timer
+from scrapy.utils.httpobj import urlparse_cached
+
+from .signals import httpcache_operation
+
+
+class LatencyHistogram(object):
+    """ Histogram of latencies (in seconds) with logarithmic buckets.
+
+    Every bucket is ``growth`` times wider than the previous one, so reported
+    percentiles are accurate within that factor while memory stays constant.
+    """
+
+    def __init__(self, resolution=1e-6, growth=1.1):
+        self.resolution = resolution
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        if value > self.resolution:
+            idx = int(math.ceil(math.log(value / self.resolution) / self._log_growth))
+        else:
+            idx = 0
+        self.buckets[idx] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """Return the upper bound of the bucket holding the given percentile."""
+        if not self.count:
+            return 0.0
+        threshold = self.count * pct / 100.0
+        seen = 0
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            if seen >= threshold:
+                return min(self.resolution * self.growth ** idx, self.max)
+        return self.max
+
+
+class CacheInstrumentation(object):
+    """ Collect per-operation latencies, byte counters and per-domain hit
+    ratios, exporting them to crawler stats when the spider closes.
+
+    Every measured operation is also sent as the ``httpcache_operation``
+    signal, if a signal manager is available.
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, stats, signals=None):
+        self.stats = stats
+        self.signals = signals
+        self._histograms = defaultdict(dict)
+        self._lookups = defaultdict(dict)
+
+    def timed(self, operation, spider, request, func, *args):
+        start = default_timer()
+        result = func(*args)
+        self.record(operation, spider, request, default_timer() - start)
+        return result
+
+    def record(self, operation, spider, request, duration, nbytes=0):
+        histograms = self._histograms[spider]
+        if operation not in histograms:
+            histograms[operation] = LatencyHistogram()
+        histograms[operation].add(duration)
+        if nbytes:
+            key = 'httpcache/bytes_read' if operation == 'retrieve' else 'httpcache/bytes_written'
+            self.stats.inc_value(key, nbytes, spider=spider)
+        if self.signals is not None:
+            self.signals.send_catch_log(httpcache_operation, operation=operation,
+                duration=duration, nbytes=nbytes, request=request, spider=spider)
+
+    def record_lookup(self, spider, request, hit):
+        domain = urlparse_cached(request).hostname or ''
+        counts = self._lookups[spider].setdefault(domain, [0, 0])
+        counts[0] += int(hit)
+        counts[1] += 1
+        self.stats.inc_value('httpcache/domain/%s/%s' % (domain, 'hit' if hit else 'miss'),
+                             spider=spider)
+
+    def close_spider(self, spider):
+        for operation, histogram in self._histograms.pop(spider, {}).items():
+            prefix = 'httpcache/latency/%s' % operation
+            self.stats.set_value('%s/count' % prefix, histogram.count, spider=spider)
+            self.stats.set_value('%s/max' % prefix, histogram.max, spider=spider)
+            for pct in self.PERCENTILES:
+                self.stats.set_value('%s/p%d' % (prefix, pct), histogram.percentile(pct),
+                                     spider=spider)
+        for domain, (hits, total) in self._lookups.pop(spider, {}).items():
+            self.stats.set_value('httpcache/domain/%s/hit_ratio' % domain, hits / total,
+                                 spider=spider)
@@ -0,0 +1,38 @@
+"""
+Lazy loading of the attributes of a package, so that importing it does not
+import all its modules (and their dependencies) up front.
+"""
+import sys
+from importlib import import_module
+
+
+def lazy_attributes(name, attributes):
+    """Return the ``__getattr__``, ``__dir__`` and ``__all__`` of the module
+    ``name``, for it to load its ``attributes`` on first access.
+
+    ``attributes`` maps attribute names to the (relative) path of the
+    module defining them, or to a function returning their value.
+    Python versions without module ``__getattr__`` (before 3.7) load them
+    all right away.
+    """
+    module = sys.modules[name]
+
+    def __getattr__(attr):
+        try:
+            loader = attributes[attr]
+        except KeyError:
+            raise AttributeError('module %r has no attribute %r' % (name, attr))
+        if callable(loader):
+            value = loader()
+        else:
+            value = getattr(import_module(loader, module.__package__), attr)
+        setattr(module, attr, value)  # not looked up again
+        return value
+
+    def __dir__():
+        return sorted(set(vars(module)) | set(attributes))
+
+    if sys.version_info < (3, 7):
+        for attr in attributes:
+            __getattr__(attr)
+    return __getattr__, __dir__, sorted(a for a in attributes if not a.startswith('_'))
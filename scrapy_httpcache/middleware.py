@@ -1,9 +1,20 @@
 from email.utils import formatdate
+from timeit import default_timer
 from twisted.internet import defer, error
 from twisted.web.client import ResponseFailed
+import scrapy
 from scrapy import signals
 from scrapy.exceptions import NotConfigured, IgnoreRequest
+from scrapy.utils.httpobj import urlparse_cached
 from scrapy.utils.misc import load_object
+from scrapy.utils.request import request_fingerprint
+
+from .admission import AdmissionFilter
+from .circuitbreaker import CircuitBreaker
+from .eviction import EvictingStorage
+from .instrumentation import CacheInstrumentation
+from .trace import TraceRecorder, HIT, MISS, STALE, REVALIDATE, STORE, UPDATE, REJECT
+from .writebehind import WriteBehindQueue
 
 
 class HttpCacheMiddleware(object):
@@ -21,56 +32,195 @@ class HttpCacheMiddleware(object):
         IOError,
     )
 
-    def __init__(self, settings, stats):
+    FRESHEN_IGNORED_HEADERS = (
+        b'Content-Length',
+        b'Content-Encoding',
+        b'Content-Range',
+        b'Transfer-Encoding',
+    )
+
+    def __init__(self, settings, stats, crawler=None):
         if not settings.getbool('HTTPCACHE_ENABLED'):
             raise NotConfigured
         self.policy = load_object(settings['HTTPCACHE_POLICY'])(settings)
         self.storage = load_object(settings['HTTPCACHE_STORAGE'])(settings)
+        if settings.getint('HTTPCACHE_MAX_SIZE') > 0 or \
+                settings.getint('HTTPCACHE_MAX_ENTRIES') > 0:
+            self.storage = EvictingStorage.from_settings(self.storage, settings, stats)
+        self.writequeue = None
+        if settings.getbool('HTTPCACHE_WRITE_BEHIND'):
+            self.storage = self.writequeue = \
+                WriteBehindQueue.from_settings(self.storage, settings, stats)
+        self.admission = AdmissionFilter.from_settings(settings)
+        if not self.admission.enabled:
+            self.admission = None
         self.ignore_missing = settings.getbool('HTTPCACHE_IGNORE_MISSING')
         self.stats = stats
+        self.crawler = crawler
+        self._revalidating = set()
+        self.collapse_requests = settings.getbool('HTTPCACHE_COLLAPSE_REQUESTS')
+        self._inflight = {}
+        self.circuitbreaker = None
+        failures = settings.getint('HTTPCACHE_CIRCUIT_BREAKER_FAILURES')
+        if failures > 0:
+            cooldown = settings.getfloat('HTTPCACHE_CIRCUIT_BREAKER_COOLDOWN', 60)
+            self.circuitbreaker = CircuitBreaker(failures, cooldown)
+        self.instrumentation = None
+        if settings.getbool('HTTPCACHE_INSTRUMENTATION'):
+            sigmanager = crawler.signals if crawler is not None else None
+            self.instrumentation = CacheInstrumentation(stats, sigmanager)
+        self.trace = None
+        if settings.getbool('HTTPCACHE_TRACE'):
+            self.trace = TraceRecorder.from_settings(settings, self.policy)
 
     @classmethod
     def from_crawler(cls, crawler):
-        o = cls(crawler.settings, crawler.stats)
+        o = cls(crawler.settings, crawler.stats, crawler)
         crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
         crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
         return o
 
     def spider_opened(self, spider):
         self.storage.open_spider(spider)
+        if self.admission is not None:
+            self.admission.open_spider(spider)
+        if self.trace is not None:
+            self.trace.open_spider(spider)
 
     def spider_closed(self, spider):
-        self.storage.close_spider(spider)
+        for key in list(self._inflight):
+            self._release_waiting(key, None)
+        closed = self.storage.close_spider(spider)
+        if self.admission is not None:
+            self.admission.close_spider(spider)
+        if self.instrumentation is not None:
+            self.instrumentation.close_spider(spider)
+        if self.trace is not None:
+            self.trace.close_spider(spider)
+        return closed  # a Deferred, for storages still writing
 
     def process_request(self, request, spider):
         if request.meta.get('dont_cache', False):
             return
 
         # Skip uncacheable requests
-        if not self.policy.should_cache_request(request):
+        if not self._timed('policy', spider, request, self.policy.should_cache_request, request):
             request.meta['_dont_cache'] = True  # flag as uncacheable
             return
 
-        # Look for cached response and check if expired
-        cachedresponse = self.storage.retrieve_response(spider, request)
+        # Look for cached response (storages may look it up asynchronously)
+        cachedresponse = self._retrieve_response(spider, request)
+        if isinstance(cachedresponse, defer.Deferred):
+            return cachedresponse.addCallback(self._process_cached, request, spider)
+        return self._process_cached(cachedresponse, request, spider)
+
+    def _process_cached(self, cachedresponse, request, spider):
+        # Check if expired
+        if cachedresponse is not None and 'expired' in cachedresponse.flags:
+            # Past the storage expiration time, the cached response can only
+            # be used if the server says it has not changed
+            self.stats.inc_value('httpcache/expired', spider=spider)
+            if not self.ignore_missing:
+                served = self._serve_while_open(spider, request, cachedresponse)
+                if served is not None:
+                    if self.instrumentation is not None:
+                        self.instrumentation.record_lookup(spider, request, False)
+                    return served
+            if not self.ignore_missing and \
+                    self.policy.set_conditional_validators(request, cachedresponse):
+                if self.instrumentation is not None:
+                    self.instrumentation.record_lookup(spider, request, False)
+                self._trace_lookup(spider, request, REVALIDATE, cachedresponse)
+                cachedresponse.flags.append('cached')
+                return self._revalidate(spider, request, cachedresponse)
+            cachedresponse = None
+
         if cachedresponse is None:
             self.stats.inc_value('httpcache/miss', spider=spider)
+            if self.instrumentation is not None:
+                self.instrumentation.record_lookup(spider, request, False)
+            self._trace_lookup(spider, request, MISS)
             if self.ignore_missing:
                 self.stats.inc_value('httpcache/ignore', spider=spider)
                 raise IgnoreRequest("Ignored request not in cache: %s" % request)
-            return  # first time request
+            return self._wait_inflight(spider, request)  # first time request
 
-        # Return cached response only if not expired
+        # Return cached response only if not expired (background
+        # revalidations always go to the network)
         cachedresponse.flags.append('cached')
-        if self.policy.is_cached_response_fresh(cachedresponse, request):
+        if '_httpcache_revalidation' not in request.meta and \
+                self._timed('policy', spider, request,
+                            self.policy.is_cached_response_fresh, cachedresponse, request):
             self.stats.inc_value('httpcache/hit', spider=spider)
+            if self.instrumentation is not None:
+                self.instrumentation.record_lookup(spider, request, True)
+            # Served while stale, refresh the cache without blocking
+            if 'stale' in cachedresponse.flags:
+                self._trace_lookup(spider, request, STALE, cachedresponse)
+                self.stats.inc_value('httpcache/stale_while_revalidate', spider=spider)
+                self._revalidate_in_background(spider, request, cachedresponse)
+            else:
+                self._trace_lookup(spider, request, HIT, cachedresponse)
             return cachedresponse
 
+        if self.instrumentation is not None:
+            self.instrumentation.record_lookup(spider, request, False)
+
+        served = self._serve_while_open(spider, request, cachedresponse)
+        if served is not None:
+            return served
+
+        self._trace_lookup(spider, request, REVALIDATE, cachedresponse)
+        return self._revalidate(spider, request, cachedresponse)
+
+    def _serve_while_open(self, spider, request, cachedresponse):
+        # Serve stale (or expired) responses without attempting the network
+        # while the host keeps failing
+        if self.circuitbreaker is None or \
+                not self.policy.is_cached_response_usable_on_error(cachedresponse, request) or \
+                self.circuitbreaker.allow(urlparse_cached(request).hostname):
+            return None
+        self.stats.inc_value('httpcache/circuitbreaker/served', spider=spider)
+        self._trace_lookup(spider, request, STALE, cachedresponse)
+        for flag in ('cached', 'stale'):
+            if flag not in cachedresponse.flags:
+                cachedresponse.flags.append(flag)
+        return cachedresponse
+
+    def _revalidate(self, spider, request, cachedresponse):
+        waiting = self._wait_inflight(spider, request)
+        if waiting is not None:
+            return waiting
+
         # Keep a reference to cached response to avoid a second cache lookup on
         # process_response hook
         request.meta['cached_response'] = cachedresponse
 
     def process_response(self, request, response, spider):
+        if '_httpcache_revalidation' in request.meta:
+            self._revalidating.discard(request.meta['_httpcache_revalidation'])
+            self._process_response(request, response, spider)
+            raise IgnoreRequest("Revalidated in background: %s" % request)
+        key = request.meta.pop('_httpcache_inflight', None)
+        response = self._process_response(request, response, spider)
+        if key is not None:
+            self._release_waiting(key, response)
+        # Hold the response back while too many writes are pending
+        if self.writequeue is not None:
+            d = self.writequeue.wait_for_room()
+            if d is not None:
+                self.stats.inc_value('httpcache/writebehind/backpressure', spider=spider)
+                return d.addCallback(lambda _: response)
+        return response
+
+    def _process_response(self, request, response, spider):
+        # Server errors count as failures of the host, like download errors
+        if self.circuitbreaker is not None and 'cached' not in response.flags:
+            if response.status >= 500:
+                self._circuit_failure(request, spider)
+            else:
+                self.circuitbreaker.success(urlparse_cached(request).hostname)
+
         if request.meta.get('dont_cache', False):
             return response
 
@@ -91,23 +241,175 @@ class HttpCacheMiddleware(object):
             self._cache_response(spider, response, request, cachedresponse)
             return response
 
-        if self.policy.is_cached_response_valid(cachedresponse, response, request):
+        if 'expired' in cachedresponse.flags:
+            valid = response.status == 304
+        else:
+            valid = self._timed('policy', spider, request, self.policy.is_cached_response_valid,
+                                cachedresponse, response, request)
+        if valid:
             self.stats.inc_value('httpcache/revalidate', spider=spider)
+            if response.status == 304:
+                freshened = self._freshen_response(cachedresponse, response)
+                self._cache_response(spider, freshened, request, cachedresponse, update=True)
+                return freshened
             return cachedresponse
 
+        # Refetched with the same body, only freshen the stored entry
+        if response.status == cachedresponse.status and \
+                self.storage.is_body_unchanged(cachedresponse, response):
+            self.stats.inc_value('httpcache/revalidate', spider=spider)
+            self._cache_response(spider, response, request, cachedresponse, update=True)
+            return response
+
         self.stats.inc_value('httpcache/invalidate', spider=spider)
         self._cache_response(spider, response, request, cachedresponse)
         return response
 
     def process_exception(self, request, exception, spider):
         cachedresponse = request.meta.pop('cached_response', None)
-        if cachedresponse is not None and isinstance(exception, self.DOWNLOAD_EXCEPTIONS):
+        if self.circuitbreaker is not None and isinstance(exception, self.DOWNLOAD_EXCEPTIONS):
+            self._circuit_failure(request, spider)
+        if '_httpcache_revalidation' in request.meta:
+            self._revalidating.discard(request.meta['_httpcache_revalidation'])
+            self.stats.inc_value('httpcache/background_revalidation_failed', spider=spider)
+            raise IgnoreRequest("Background revalidation failed: %s" % request)
+        # Let waiting requests try the network on their own
+        key = request.meta.pop('_httpcache_inflight', None)
+        if key is not None:
+            self._release_waiting(key, None)
+        if cachedresponse is not None and 'expired' not in cachedresponse.flags and \
+                isinstance(exception, self.DOWNLOAD_EXCEPTIONS) and \
+                self.policy.is_cached_response_usable_on_error(cachedresponse, request):
             self.stats.inc_value('httpcache/errorrecovery', spider=spider)
             return cachedresponse
 
-    def _cache_response(self, spider, response, request, cachedresponse):
-        if self.policy.should_cache_response(response, request):
+    def _cache_response(self, spider, response, request, cachedresponse, update=False):
+        if not self._timed('policy', spider, request,
+                           self.policy.should_cache_response, response, request):
+            self.stats.inc_value('httpcache/uncacheable', spider=spider)
+            self._trace_write(spider, request, REJECT, response, cacheable=False)
+            return
+        if not update and self.admission is not None:
+            reason = self.admission.reject(spider, request, response,
+                                           firsthand=cachedresponse is None)
+            if reason is not None:
+                self.stats.inc_value('httpcache/admission/rejected', spider=spider)
+                self.stats.inc_value('httpcache/admission/rejected/%s' % reason, spider=spider)
+                self.stats.inc_value('httpcache/admission/rejected_bytes', len(response.body),
+                                     spider=spider)
+                self._trace_write(spider, request, REJECT, response, cacheable=True)
+                return
+        metadata = self._timed('policy', spider, request, self.policy.get_cache_metadata,
+                               response, request, cachedresponse)
+        start = default_timer() if self.trace is not None else None
+        if update:
+            self.stats.inc_value('httpcache/update', spider=spider)
+            self._timed('update', spider, request, self.storage.update_metadata,
+                        spider, request, response, metadata)
+        else:
             self.stats.inc_value('httpcache/store', spider=spider)
-            self.storage.store_response(spider, request, response)
+            self._store_response(spider, request, response, metadata)
+        if start is not None:
+            self._trace_write(spider, request, UPDATE if update else STORE, response,
+                              default_timer() - start, metadata, True)
+
+    def _freshen_response(self, cachedresponse, response):
+        # Update the stored headers with those of the 304 response
+        # (RFC9111, section 4.3.4), except the ones describing its own body
+        headers = cachedresponse.headers.copy()
+        headers.pop(b'Age', None)
+        for name, values in response.headers.items():
+            if name not in self.FRESHEN_IGNORED_HEADERS:
+                headers.setlist(name, values)
+        flags = [flag for flag in cachedresponse.flags if flag != 'expired']
+        freshened = cachedresponse.replace(headers=headers, flags=flags)
+        freshened.cache_metadata = getattr(cachedresponse, 'cache_metadata', {})
+        return freshened
+
+    def _revalidate_in_background(self, spider, request, cachedresponse):
+        if self.crawler is None or self.crawler.engine is None:
+            return
+        key = request_fingerprint(request)
+        if key in self._revalidating:
+            return  # already scheduled
+        self._revalidating.add(key)
+        meta = dict(request.meta, _httpcache_revalidation=key)
+        meta.pop('cached_response', None)
+        revalidation = request.replace(meta=meta, dont_filter=True, errback=None)
+        self.policy.set_conditional_validators(revalidation, cachedresponse)
+        self.stats.inc_value('httpcache/background_revalidation', spider=spider)
+        if scrapy.version_info >= (2, 6):
+            self.crawler.engine.crawl(revalidation)
         else:
-            self.stats.inc_value('httpcache/uncacheable', spider=spider)
+            self.crawler.engine.crawl(revalidation, spider)
+
+    def _wait_inflight(self, spider, request):
+        """Return a Deferred for the response of an identical request already
+        being downloaded, or None after registering this one as in flight."""
+        if not self.collapse_requests or '_httpcache_revalidation' in request.meta:
+            return
+        key = request_fingerprint(request)
+        if key in self._inflight:
+            self.stats.inc_value('httpcache/collapsed', spider=spider)
+            d = defer.Deferred()
+            self._inflight[key].append(d)
+            return d
+        self._inflight[key] = []
+        request.meta['_httpcache_inflight'] = key
+
+    def _circuit_failure(self, request, spider):
+        if self.circuitbreaker.failure(urlparse_cached(request).hostname):
+            self.stats.inc_value('httpcache/circuitbreaker/open', spider=spider)
+
+    def _release_waiting(self, key, response):
+        # Waiting requests get a copy of the response, flagged as cached so
+        # it is not stored again, or None to download it themselves
+        for d in self._inflight.pop(key, ()):
+            if response is None:
+                d.callback(None)
+            else:
+                flags = response.flags + ['cached'] if 'cached' not in response.flags \
+                    else list(response.flags)
+                d.callback(response.replace(flags=flags))
+
+    def _retrieve_response(self, spider, request):
+        if self.instrumentation is None and self.trace is None:
+            return self.storage.retrieve_response(spider, request)
+        start = default_timer()
+        cachedresponse = self.storage.retrieve_response(spider, request)
+        if isinstance(cachedresponse, defer.Deferred):
+            return cachedresponse.addCallback(self._retrieved, spider, request, start)
+        return self._retrieved(cachedresponse, spider, request, start)
+
+    def _retrieved(self, cachedresponse, spider, request, start):
+        duration = default_timer() - start
+        if self.trace is not None:
+            self.trace.retrieved(duration)
+        if self.instrumentation is not None:
+            nbytes = len(cachedresponse.body) if cachedresponse is not None else 0
+            self.instrumentation.record('retrieve', spider, request, duration, nbytes)
+        return cachedresponse
+
+    def _store_response(self, spider, request, response, metadata):
+        if self.instrumentation is None:
+            return self.storage.store_response(spider, request, response, metadata=metadata)
+        start = default_timer()
+        self.storage.store_response(spider, request, response, metadata=metadata)
+        self.instrumentation.record('store', spider, request, default_timer() - start,
+                                    len(response.body))
+
+    def _trace_lookup(self, spider, request, event, cachedresponse=None):
+        # background revalidations are not lookups of the crawl, the one
+        # serving the stale response was traced
+        if self.trace is not None and '_httpcache_revalidation' not in request.meta:
+            self.trace.lookup(spider, request, event, cachedresponse)
+
+    def _trace_write(self, spider, request, event, response, latency=0.0, metadata=None,
+                     cacheable=None):
+        if self.trace is not None:
+            self.trace.written(spider, request, event, response, latency, metadata, cacheable)
+
+    def _timed(self, operation, spider, request, func, *args):
+        if self.instrumentation is None:
+            return func(*args)
+        return self.instrumentation.timed(operation, spider, request, func, *args)
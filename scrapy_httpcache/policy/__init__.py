@@ -1,2 +1,9 @@
-from .dummy import DummyPolicy
-from .rfc2616 import RFC2616Policy
+from ..lazy import lazy_attributes
+
+
+__getattr__, __dir__, __all__ = lazy_attributes(__name__, {
+    'DummyPolicy': '.dummy',
+    'RFC2616Policy': '.rfc2616',
+    'RFC9111Policy': '.rfc9111',
+    'AdaptivePolicy': '.adaptive',
+})
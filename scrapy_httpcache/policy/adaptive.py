@@ -0,0 +1,76 @@
+from __future__ import division
+
+import math
+
+from .rfc2616 import RFC2616Policy
+
+
+class AdaptivePolicy(RFC2616Policy):
+    """ Cache Policy learning how often each cached page changes, aimed at
+    incremental recrawls.
+
+    Every revalidation of a cached response is recorded in its metadata,
+    along with whether the page had changed. Assuming pages change following
+    a Poisson process, the freshness lifetime is set so that the probability
+    of the page changing before it expires stays within
+    ``HTTPCACHE_ADAPTIVE_STALENESS``.
+    """
+
+    # Older observations are discounted past this number of revalidations,
+    # so that estimates follow pages whose change rate varies over time
+    MAX_CHECKS = 50
+
+    def __init__(self, settings):
+        super(AdaptivePolicy, self).__init__(settings)
+        self.staleness = settings.getfloat('HTTPCACHE_ADAPTIVE_STALENESS', 0.1)
+        self.min_lifetime = settings.getfloat('HTTPCACHE_ADAPTIVE_MIN_LIFETIME', 60)
+        self.max_lifetime = settings.getfloat('HTTPCACHE_ADAPTIVE_MAX_LIFETIME', 30 * 86400)
+
+    def get_cache_metadata(self, response, request, cachedresponse=None):
+        metadata = super(AdaptivePolicy, self).get_cache_metadata(response, request, cachedresponse)
+        if not metadata:
+            return metadata
+        if cachedresponse is not None:
+            changed = response.status != cachedresponse.status or \
+                response.body != cachedresponse.body
+            history = self._get_cache_metadata(cachedresponse, request, metadata['date'])
+            self._record_check(metadata, history, changed)
+        return self._adapt(metadata)
+
+    def get_change_rate(self, metadata):
+        """Return the estimated number of changes per second of the page,
+        or None if it has not been revalidated yet."""
+        checks = metadata.get('checks', 0)
+        observed = metadata.get('observed', 0)
+        if not checks or observed <= 0:
+            return None
+        # Estimator of the change rate from the number of revalidations that
+        # found the page changed, for a Poisson process (Cho and
+        # Garcia-Molina), biased so that it stays positive for pages never
+        # seen changing
+        changes = metadata.get('changes', 0)
+        interval = observed / checks
+        return -math.log((checks - changes + 0.5) / (checks + 1)) / interval
+
+    def _record_check(self, metadata, history, changed):
+        checks = history.get('checks', 0) + 1
+        changes = history.get('changes', 0) + int(changed)
+        observed = history.get('observed', 0) + max(0, metadata['date'] - history['date'])
+        if checks > self.MAX_CHECKS:
+            discount = self.MAX_CHECKS / checks
+            checks, changes, observed = \
+                checks * discount, changes * discount, observed * discount
+        metadata.update(checks=checks, changes=changes, observed=observed)
+
+    def _adapt(self, metadata):
+        rate = self.get_change_rate(metadata)
+        if rate is None:
+            # Nothing learnt yet, start from the response headers
+            lifetime = metadata['freshness_lifetime']
+        else:
+            lifetime = -math.log(1 - self.staleness) / rate
+        lifetime = max(self.min_lifetime, min(self.max_lifetime, lifetime))
+        metadata['freshness_lifetime'] = lifetime
+        metadata['expires'] = metadata['date'] + lifetime \
+            if metadata['age'] < lifetime else 0
+        return metadata
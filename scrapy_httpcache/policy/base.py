@@ -53,3 +53,33 @@ class CachePolicy(object):
 
     def is_cached_response_valid(self, cachedresponse, response, request):
         raise NotImplementedError
+
+    def is_cached_response_usable_on_error(self, cachedresponse, request):
+        """Return True if the cached response can be served when the
+        origin server can not be reached."""
+        return True
+
+    def set_conditional_validators(self, request, cachedresponse):
+        """Make the request conditional using the validators of the cached
+        response, if any. Return True if a validator was set."""
+        metadata = getattr(cachedresponse, 'cache_metadata', None) or {}
+        if 'last_modified' in metadata:
+            lastmodified, etag = metadata['last_modified'], metadata['etag']
+        else:
+            lastmodified = cachedresponse.headers.get(b'Last-Modified')
+            etag = cachedresponse.headers.get(b'ETag')
+
+        if lastmodified is not None:
+            request.headers[b'If-Modified-Since'] = lastmodified
+
+        if etag is not None:
+            request.headers[b'If-None-Match'] = etag
+
+        return lastmodified is not None or etag is not None
+
+    def get_cache_metadata(self, response, request, cachedresponse=None):
+        """Return a dict of values precomputed from the response, to be saved
+        by the storage along with it and made available on the retrieved
+        response as ``cache_metadata``. ``cachedresponse`` is the response
+        it replaces in the cache, if any."""
+        return {}
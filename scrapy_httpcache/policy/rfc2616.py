@@ -72,14 +72,14 @@ class RFC2616Policy(CachePolicy):
             return False
 
     def is_cached_response_fresh(self, cachedresponse, request):
-        cc = self._parse_cachecontrol(cachedresponse)
         ccreq = self._parse_cachecontrol(request)
-        if b'no-cache' in cc or b'no-cache' in ccreq:
+        now = time()
+        metadata = self._get_cache_metadata(cachedresponse, request, now)
+        if metadata['no_cache'] or b'no-cache' in ccreq:
             return False
 
-        now = time()
-        freshnesslifetime = self._compute_freshness_lifetime(cachedresponse, request, now)
-        currentage = self._compute_current_age(cachedresponse, request, now)
+        freshnesslifetime = metadata['freshness_lifetime']
+        currentage = max(0, now - metadata['date'], metadata['age'])
 
         reqmaxage = self._get_max_age(ccreq)
         if reqmaxage is not None:
@@ -88,7 +88,29 @@ class RFC2616Policy(CachePolicy):
         if currentage < freshnesslifetime:
             return True
 
-        if b'max-stale' in ccreq and b'must-revalidate' not in cc:
+        if self._is_stale_acceptable(cachedresponse, request, metadata,
+                                     currentage, freshnesslifetime):
+            return True
+
+        # Cached response is stale, try to set validators if any
+        self.set_conditional_validators(request, cachedresponse)
+        return False
+
+    def is_cached_response_valid(self, cachedresponse, response, request):
+        # Use the cached response if the new response is a server error,
+        # as long as the old response didn't specify must-revalidate.
+        if response.status >= 500:
+            metadata = self._get_cache_metadata(cachedresponse, request, time())
+            if not metadata['must_revalidate']:
+                return True
+
+        # Use the cached response if the server says it hasn't changed.
+        return response.status == 304
+
+    def _is_stale_acceptable(self, cachedresponse, request, metadata,
+                             currentage, freshnesslifetime):
+        ccreq = self._parse_cachecontrol(request)
+        if b'max-stale' in ccreq and not metadata['must_revalidate']:
             # From RFC2616: "Indicates that the client is willing to
             # accept a response that has exceeded its expiration time.
             # If max-stale is assigned a value, then the client is
@@ -105,28 +127,39 @@ class RFC2616Policy(CachePolicy):
                     return True
             except ValueError:
                 pass
-
-        # Cached response is stale, try to set validators if any
-        self._set_conditional_validators(request, cachedresponse)
         return False
 
-    def is_cached_response_valid(self, cachedresponse, response, request):
-        # Use the cached response if the new response is a server error,
-        # as long as the old response didn't specify must-revalidate.
-        if response.status >= 500:
-            cc = self._parse_cachecontrol(cachedresponse)
-            if b'must-revalidate' not in cc:
-                return True
-
-        # Use the cached response if the server says it hasn't changed.
-        return response.status == 304
-
-    def _set_conditional_validators(self, request, cachedresponse):
-        if b'Last-Modified' in cachedresponse.headers:
-            request.headers[b'If-Modified-Since'] = cachedresponse.headers[b'Last-Modified']
-
-        if b'ETag' in cachedresponse.headers:
-            request.headers[b'If-None-Match'] = cachedresponse.headers[b'ETag']
+    def get_cache_metadata(self, response, request, cachedresponse=None):
+        # Freshness can only be precomputed from a valid Date header (which
+        # the middleware sets if missing), otherwise it depends on the time
+        # of each lookup
+        date = rfc1123_to_epoch(response.headers.get(b'Date'))
+        if not date:
+            return {}
+        return self._compute_cache_metadata(response, request, date)
+
+    def _get_cache_metadata(self, cachedresponse, request, now):
+        metadata = getattr(cachedresponse, 'cache_metadata', None)
+        if metadata and 'freshness_lifetime' in metadata:
+            return metadata
+        date = rfc1123_to_epoch(cachedresponse.headers.get(b'Date')) or now
+        return self._compute_cache_metadata(cachedresponse, request, date)
+
+    def _compute_cache_metadata(self, response, request, date):
+        cc = self._parse_cachecontrol(response)
+        freshnesslifetime = self._compute_freshness_lifetime(response, request, date)
+        age = self._compute_current_age(response, request, date)
+        return {
+            'date': date,
+            'age': age,
+            'freshness_lifetime': freshnesslifetime,
+            # absolute time at which the response becomes stale
+            'expires': date + freshnesslifetime if age < freshnesslifetime else 0,
+            'no_cache': b'no-cache' in cc,
+            'must_revalidate': b'must-revalidate' in cc,
+            'last_modified': response.headers.get(b'Last-Modified'),
+            'etag': response.headers.get(b'ETag'),
+        }
 
     def _get_max_age(self, cc):
         try:
@@ -0,0 +1,80 @@
+from time import time
+
+from .rfc2616 import RFC2616Policy
+
+
+class RFC9111Policy(RFC2616Policy):
+    """ Cache Policy following RFC 9111 (which obsoletes RFC 2616), with
+    support for the ``stale-while-revalidate`` and ``stale-if-error``
+    extensions of RFC 5861.
+
+    Within the ``stale-while-revalidate`` window of a stale cached
+    response, the response is served at once and flagged as ``'stale'``,
+    and the middleware revalidates it in the background.
+    """
+
+    def is_cached_response_valid(self, cachedresponse, response, request):
+        # Use the cached response if the new response is a server error,
+        # as long as it may be served on errors.
+        if response.status >= 500:
+            return self.is_cached_response_usable_on_error(cachedresponse, request)
+
+        # Use the cached response if the server says it hasn't changed.
+        return response.status == 304
+
+    def is_cached_response_usable_on_error(self, cachedresponse, request):
+        now = time()
+        metadata = self._get_cache_metadata(cachedresponse, request, now)
+        currentage = max(0, now - metadata['date'], metadata['age'])
+        freshnesslifetime = metadata['freshness_lifetime']
+        if currentage < freshnesslifetime and not metadata['no_cache']:
+            return True
+
+        # RFC5861, section 4: "The stale-if-error Cache-Control extension
+        # indicates that when an error is encountered, a cached stale
+        # response MAY be used to satisfy the request, regardless of other
+        # freshness information." It may appear in requests and responses.
+        ccreq = self._parse_cachecontrol(request)
+        staleage = self._get_delta_seconds(ccreq, b'stale-if-error', None)
+        if staleage is None:
+            staleage = metadata.get('stale_if_error')
+        if staleage is None:
+            # Stale responses may be served when the origin is unreachable,
+            # unless they must be revalidated (RFC9111, section 4.2.4)
+            return not metadata['must_revalidate']
+        return currentage < freshnesslifetime + staleage
+
+    def _is_stale_acceptable(self, cachedresponse, request, metadata,
+                             currentage, freshnesslifetime):
+        if super(RFC9111Policy, self)._is_stale_acceptable(
+                cachedresponse, request, metadata, currentage, freshnesslifetime):
+            return True
+
+        # RFC5861, section 3: "When present in an HTTP response, the
+        # stale-while-revalidate Cache-Control extension indicates that
+        # caches MAY serve the response in which it appears after it
+        # becomes stale, up to the indicated number of seconds."
+        # Not when the request asks for a maximum age or the response must
+        # be revalidated once stale (RFC9111, section 5.2.2.2).
+        staleage = metadata.get('stale_while_revalidate', 0)
+        if not staleage or metadata['must_revalidate']:
+            return False
+        if b'max-age' in self._parse_cachecontrol(request):
+            return False
+        if currentage < freshnesslifetime + staleage:
+            cachedresponse.flags.append('stale')
+            return True
+        return False
+
+    def _compute_cache_metadata(self, response, request, date):
+        metadata = super(RFC9111Policy, self)._compute_cache_metadata(response, request, date)
+        cc = self._parse_cachecontrol(response)
+        metadata['stale_while_revalidate'] = self._get_delta_seconds(cc, b'stale-while-revalidate')
+        metadata['stale_if_error'] = self._get_delta_seconds(cc, b'stale-if-error', None)
+        return metadata
+
+    def _get_delta_seconds(self, cc, directive, default=0):
+        try:
+            return max(0, int(cc[directive]))
+        except (KeyError, TypeError, ValueError):
+            return default
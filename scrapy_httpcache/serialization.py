@@ -0,0 +1,79 @@
+"""
+JSON encoding of requests, responses and other data holding bytes, as sent
+to the cache server and kept in WARC records. Bytes are base64-encoded.
+"""
+import json
+import base64
+
+from scrapy.http import Request, TextResponse
+from scrapy.utils.python import to_unicode
+
+from .storage.base import build_response
+
+
+def dumps(obj):
+    return json.dumps(_to_json(obj)).encode('ascii')
+
+
+def loads(data):
+    return _from_json(json.loads(to_unicode(data)))
+
+
+def _to_json(obj):
+    if isinstance(obj, bytes):
+        return {'__bytes__': to_unicode(base64.b64encode(obj))}
+    if isinstance(obj, dict):
+        return dict((key, _to_json(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_to_json(value) for value in obj]
+    return obj
+
+
+def _from_json(obj):
+    if isinstance(obj, dict):
+        if list(obj) == ['__bytes__']:
+            return base64.b64decode(obj['__bytes__'])
+        return dict((key, _from_json(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [_from_json(value) for value in obj]
+    return obj
+
+
+def encode_request(request):
+    return {
+        'url': request.url,
+        'method': request.method,
+        'headers': list(request.headers.items()),
+        'body': request.body,
+    }
+
+
+def decode_request(data):
+    return Request(data['url'], method=data['method'], headers=data['headers'],
+                   body=data['body'])
+
+
+def encode_response(response, body=True):
+    # the class and encoding of the response, for clients to rebuild it
+    hints = {'class': '%s.%s' % (response.__class__.__module__, response.__class__.__name__)}
+    if isinstance(response, TextResponse):
+        hints['encoding'] = response.encoding
+    data = {
+        'url': response.url,
+        'status': response.status,
+        'headers': list(response.headers.items()),
+        'hints': hints,
+        'cache_metadata': getattr(response, 'cache_metadata', None) or {},
+        'cache_timestamp': getattr(response, 'cache_timestamp', None),
+    }
+    if body:
+        data['body'] = response.body
+    return data
+
+
+def decode_response(data):
+    response = build_response(data['url'], data['status'], dict(data['headers']),
+                              data['body'], data.get('hints'))
+    response.cache_metadata = data.get('cache_metadata') or {}
+    response.cache_timestamp = data.get('cache_timestamp')
+    return response
@@ -0,0 +1,136 @@
+"""
+HTTP cache server, sharing the cache storage of one node with the
+:class:`~scrapy_httpcache.storage.RemoteCacheStorage` of other nodes.
+
+The server answers ``POST /<spider>/<operation>`` requests with JSON bodies,
+for the ``get``, ``put`` and ``delete`` operations, and ``GET
+/<spider>/entries`` (of a ``partition`` out of ``partitions``, if given),
+a page of keys at a time: the next page starts after the ``next`` key of
+the previous one. Bodies and other bytes are sent base64-encoded. Metadata
+updates may be put without the body, the keys of those not cached are
+answered back as ``missing``.
+"""
+import re
+import heapq
+
+from twisted.web import resource
+from scrapy.spiders import Spider
+from scrapy.utils.python import to_unicode
+
+from .serialization import dumps, loads, decode_request, encode_response, decode_response
+from .storage.base import key_range
+
+
+# storage methods clients can write entries with
+PUT_METHODS = ('store_response', 'update_metadata')
+
+# spider names clients can use, as storages name files after them
+SPIDER_NAME = re.compile(r'[A-Za-z0-9_][A-Za-z0-9_.-]*\Z')
+
+
+class CacheServerResource(resource.Resource):
+    """ Twisted web resource exposing a cache storage, opened for each
+    spider on its first request and closed by ``close()``.
+
+    Responses are returned without their ``'expired'`` flag, clients apply
+    their own expiration rules to their ``cache_timestamp``. Entries are
+    listed ``page_size`` keys at a time.
+    """
+
+    isLeaf = True
+
+    def __init__(self, storage, page_size=1000):
+        resource.Resource.__init__(self)
+        self.storage = storage
+        self.page_size = page_size
+        self.spiders = {}
+
+    def render_GET(self, request):
+        return self._render(request, {'entries': self._entries})
+
+    def render_POST(self, request):
+        return self._render(request, {
+            'get': self._get,
+            'put': self._put,
+            'delete': self._delete,
+        })
+
+    def close(self):
+        for spider in self.spiders.values():
+            self.storage.close_spider(spider)
+        self.spiders = {}
+
+    def _render(self, request, operations):
+        path = [to_unicode(p) for p in request.postpath if p]
+        if len(path) != 2 or path[1] not in operations:
+            request.setResponseCode(404)
+            return b''
+        spidername, operation = path
+        try:
+            data = loads(request.content.read() or b'{}')
+            result = operations[operation](self._spider(spidername), data)
+        except (ValueError, KeyError, TypeError):  # malformed request
+            request.setResponseCode(400)
+            return b''
+        request.setHeader(b'Content-Type', b'application/json')
+        return dumps(result)
+
+    def _spider(self, name):
+        if not SPIDER_NAME.match(name):
+            raise ValueError('Invalid spider name: %r' % name)
+        if name not in self.spiders:
+            self.spiders[name] = Spider(name)
+            self.storage.open_spider(self.spiders[name])
+        return self.spiders[name]
+
+    def _get(self, spider, data):
+        responses = {}
+        for key in data['keys']:
+            response = self.storage.retrieve_entry(spider, key)
+            responses[key] = encode_response(response) if response is not None else None
+        return {'responses': responses}
+
+    def _put(self, spider, data):
+        for entry in data['entries']:
+            if entry['method'] not in PUT_METHODS:
+                raise ValueError('Unknown method: %r' % entry['method'])
+        stored, missing = 0, []
+        for entry in data['entries']:
+            request = decode_request(entry['request'])
+            if 'body' not in entry['response']:
+                # metadata updates come without the body, which is cached here
+                key = self.storage._request_key(request)
+                cached = self.storage.retrieve_entry(spider, key, request)
+                if cached is None:
+                    missing.append(key)
+                    continue
+                entry['response']['body'] = cached.body
+            # hints name classes to load, which clients are not trusted with
+            response = decode_response(dict(entry['response'], hints=None))
+            getattr(self.storage, entry['method'])(spider, request, response,
+                                                   entry['metadata'])
+            stored += 1
+        return {'stored': stored, 'missing': missing}
+
+    def _delete(self, spider, data):
+        for key in data['keys']:
+            self.storage.delete_response(spider, key)
+        return {'deleted': len(data['keys'])}
+
+    def _entries(self, spider, data):
+        partitions = data.get('partitions', 1)
+        if partitions == 1:
+            entries = self.storage.iter_entries(spider)
+        elif self.storage.parallel_scan:
+            entries = self.storage.iter_partition(spider, data['partition'], partitions)
+        else:
+            lo, hi = key_range(data['partition'], partitions)
+            entries = (entry for entry in self.storage.iter_entries(spider)
+                       if lo <= entry[0] and (hi is None or entry[0] < hi))
+        start = data.get('start')
+        if start is not None:
+            entries = (entry for entry in entries if entry[0] > start)
+        page = heapq.nsmallest(self.page_size, entries)
+        return {'entries': page,
+                'next': page[-1][0] if len(page) == self.page_size else None}
+
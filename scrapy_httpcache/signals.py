@@ -0,0 +1,8 @@
+"""
+Signals sent by the HttpCache middleware
+
+These signals are documented in docs/httpcache-middleware.rst. Please don't
+add new signals here without documenting them there.
+"""
+
+httpcache_operation = object()
@@ -1,5 +1,14 @@
-from .filesystem import FilesystemCacheStorage
-from .dbm import DbmCacheStorage
-from .sqlite import SqliteCacheStorage
-from .leveldb import LeveldbCacheStorage
-from .mongodb import MongodbCacheStorage
+from ..lazy import lazy_attributes
+
+
+# Backends are only imported when used, with their database modules
+__getattr__, __dir__, __all__ = lazy_attributes(__name__, {
+    'FilesystemCacheStorage': '.filesystem',
+    'DbmCacheStorage': '.dbm',
+    'SqliteCacheStorage': '.sqlite',
+    'LeveldbCacheStorage': '.leveldb',
+    'MongodbCacheStorage': '.mongodb',
+    'WarcCacheStorage': '.warc',
+    'ShardedCacheStorage': '.sharded',
+    'RemoteCacheStorage': '.remote',
+})
@@ -1,21 +1,138 @@
+import os
+import errno
 import logging
+import hashlib
 from time import time
+from scrapy.http import Headers, Response, TextResponse
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.misc import load_object
 from scrapy.utils.request import request_fingerprint
 from scrapy.utils.project import data_path
 
+from ..expiration import ExpirationRules
+
 
 logger = logging.getLogger(__name__)
 
 
+def response_hints(response):
+    """Return how to rebuild the response without sniffing its type nor
+    detecting its encoding again: the response class ``responsetypes``
+    picks for its headers and URL, and the encoding of text responses."""
+    respcls = responsetypes.from_args(headers=response.headers, url=response.url)
+    hints = {'class': '%s.%s' % (respcls.__module__, respcls.__name__)}
+    if issubclass(respcls, TextResponse):
+        if not isinstance(response, TextResponse):
+            response = respcls(url=response.url, headers=response.headers, body=response.body)
+        hints['encoding'] = response.encoding
+    return hints
+
+
+def build_response(url, status, headers, body, hints=None):
+    """Return a response, of the class and encoding given by its
+    ``response_hints()`` if any. Headers stored along with hints must be
+    the items of a ``Headers`` object, which are not normalized again."""
+    respcls = _response_class(hints['class']) if hints else None
+    if respcls is None:
+        headers = Headers(headers)
+        respcls = responsetypes.from_args(headers=headers, url=url)
+        return respcls(url=url, headers=headers, status=status, body=body)
+    if issubclass(respcls, TextResponse) and hints.get('encoding'):
+        response = respcls(url=url, status=status, body=body, encoding=hints['encoding'])
+    else:
+        response = respcls(url=url, status=status, body=body)
+    response.headers = Headers()
+    dict.update(response.headers, headers)
+    return response
+
+
+_response_classes = {}
+
+
+def _response_class(path):
+    if path not in _response_classes:
+        try:
+            respcls = load_object(path)
+        except (ImportError, NameError, ValueError):
+            respcls = None
+        if not isinstance(respcls, type) or not issubclass(respcls, Response):
+            respcls = None
+        _response_classes[path] = respcls
+    return _response_classes[path]
+
+
+class HandlePool(object):
+    """ Database handles shared by the storages of a process, one per
+    database file, so that crawlers running the same spider in one process
+    do not open it (or fail to, for locking databases) several times.
+    """
+
+    def __init__(self):
+        self._handles = {}  # path -> [handle, references]
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self._handles
+
+    def acquire(self, path, opener, readonly=False):
+        """Return the handle of the database at path, opening it with
+        ``opener(path)`` if it is not open yet. Read-only handles can not
+        be shared with storages writing to the database."""
+        path = os.path.abspath(path)
+        entry = self._handles.get(path)
+        if entry is None:
+            entry = self._handles[path] = [opener(path), 0, readonly]
+        elif entry[2] and not readonly:
+            raise ValueError('%s is already open read-only' % path)
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, path, closer):
+        """Release a handle, closing it with ``closer(handle)`` once no
+        storage uses it anymore."""
+        path = os.path.abspath(path)
+        entry = self._handles[path]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._handles[path]
+            closer(entry[0])
+
+
+handles = HandlePool()
+
+
+def key_range(partition, partitions):
+    """Return the first fingerprint prefix of one of ``partitions`` ranges
+    of fingerprints, and the first of the next one (None for the last)."""
+    lo = '%08x' % (partition * 16 ** 8 // partitions)
+    hi = '%08x' % ((partition + 1) * 16 ** 8 // partitions) if partition + 1 < partitions else None
+    return lo, hi
+
+
 class CacheStorage(object):
     """ Abstract Cache Storage backend.
     """
 
+    # if the storage can be opened by several processes at once, which
+    # then scan it with iter_partition()
+    parallel_scan = False
+
+    # if the storage keeps the order responses were first stored in, which
+    # iter_stored() yields them in
+    ordered_scan = False
+
+    # if the storage can be written from another thread than the one
+    # reading it (by one thread at a time), as write-behind queues do
+    threaded_writes = True
+
     def __init__(self, settings):
         self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
         self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.expiration = ExpirationRules.from_settings(settings)
+        self.blob_threshold = settings.getint('HTTPCACHE_BLOB_THRESHOLD', 0)
 
-    def open_spider(self, spider):
+    def open_spider(self, spider, readonly=False):
+        """Open the cache of the spider, creating it unless ``readonly``,
+        in which case it must exist and only be read from."""
         logger.debug("Opened %(storage)s on %(cachepath)s" %
             {'storage': self.__class__.__name__, 'cachepath': self.cachedir}, extra={'spider': spider})
 
@@ -24,19 +141,136 @@ class CacheStorage(object):
             {'storage': self.__class__.__name__, 'cachepath': self.cachedir}, extra={'spider': spider})
 
     def retrieve_response(self, spider, request):
+        """Return the cached response for the request, or None if not found.
+
+        The metadata stored along with the response is available as its
+        ``cache_metadata`` attribute, and the time it was stored as its
+        ``cache_timestamp`` attribute. Responses stored for longer than their
+        expiration time are flagged as ``'expired'``, so that they can still
+        be revalidated.
+        """
+        return self.retrieve_entry(spider, self._request_key(request), request)
+
+    def retrieve_entry(self, spider, key, request=None):
+        """Return the response cached with the given key (request
+        fingerprint), as ``retrieve_response`` does. Without the request,
+        the default expiration time applies."""
+        raise NotImplementedError
+
+    def retrieve_metadata(self, spider, key):
+        """Return the response cached with the given key as
+        ``retrieve_entry`` does, with an empty body if the storage can skip
+        reading it, for scans only needing its status, headers and times."""
+        return self.retrieve_entry(spider, key)
+
+    def store_response(self, spider, request, response, metadata=None):
+        """Store the response for the request, along with a dict of
+        metadata precomputed by the cache policy."""
+        raise NotImplementedError
+
+    def update_metadata(self, spider, request, response, metadata=None):
+        """Update the status, headers and metadata of the response cached
+        for the request, and refresh its timestamp, without rewriting its
+        body (which must be the body of ``response``)."""
+        raise NotImplementedError
+
+    def iter_entries(self, spider):
+        """Yield the key (request fingerprint) and body size of every
+        response cached for the spider."""
+        raise NotImplementedError
+
+    def iter_partition(self, spider, partition, partitions):
+        """Yield the entries of ``iter_entries`` in one of ``partitions``
+        disjoint parts of the cache, only reading that part. Storages which
+        can be scanned in parallel (``parallel_scan``) implement it."""
         raise NotImplementedError
 
-    def store_response(self, spider, request, response):
+    def iter_stored(self, spider):
+        """Yield the entries of ``iter_entries`` in the order their
+        responses were first stored, which updates keep. Storages keeping
+        that order (``ordered_scan``) implement it."""
         raise NotImplementedError
 
+    def delete_response(self, spider, key):
+        """Remove the response cached with the given key, if any."""
+        raise NotImplementedError
+
+    def has_entry(self, spider, key):
+        """Return True if a response is cached with the given key, expired
+        or not. Storages which can tell without reading it override this."""
+        return self.retrieve_entry(spider, key) is not None
+
+    def exists(self, spider):
+        """Return False if there is no cache for the spider (True if that
+        can not be told without opening it)."""
+        return True
+
+    def is_body_unchanged(self, cachedresponse, response):
+        """Return True if the response has the same body as the cached
+        response, comparing it with the body hash stored in its metadata."""
+        metadata = getattr(cachedresponse, 'cache_metadata', None) or {}
+        if 'body_hash' in metadata:
+            return metadata['body_hash'] == self._body_hash(response.body)
+        return cachedresponse.body == response.body  # stored without hash
+
     # helper methods
 
     def _request_key(self, request):
         return request_fingerprint(request)
 
-    def _is_expired(self, timestamp, now=None):
+    def _body_hash(self, body):
+        return hashlib.sha1(body).hexdigest()
+
+    def _cache_metadata(self, response, metadata):
+        """Return the metadata to store along with the response."""
+        metadata = dict(metadata or {})
+        metadata['body_hash'] = self._body_hash(response.body)
+        return metadata
+
+    def _blob_path(self, spider, key):
+        return os.path.join(self.cachedir, '%s.blobs' % spider.name, key[0:2], key)
+
+    def _store_blob(self, spider, key, body):
+        """Write the body to a blob file, out of the database, if it is
+        larger than the blob threshold and return True, otherwise remove any
+        blob file previously written for the key and return False. Without
+        threshold, no blob files are looked for."""
+        if not 0 < self.blob_threshold < len(body):
+            self._remove_blob(spider, key)
+            return False
+        path = self._blob_path(spider, key)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # readers never see a partially written blob
+        tmppath = '%s.tmp' % path
+        with open(tmppath, 'wb') as f:
+            f.write(body)
+        if os.path.exists(path):
+            os.remove(path)  # os.rename does not replace files on Windows
+        os.rename(tmppath, path)
+        return True
+
+    def _remove_blob(self, spider, key):
+        if self.blob_threshold <= 0:
+            return
+        try:
+            os.remove(self._blob_path(spider, key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _read_blob(self, spider, key):
+        try:
+            with open(self._blob_path(spider, key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _is_expired(self, timestamp, now=None, request=None):
         if not now:
             now = time()
-        if 0 < self.expiration_secs < now - float(timestamp):
+        expiration_secs = self.expiration.get_expiration_secs(request)
+        if 0 < expiration_secs < now - float(timestamp):
             return True # expired
         return False
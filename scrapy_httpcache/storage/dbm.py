@@ -4,10 +4,9 @@ import os
 from six.moves import cPickle as pickle
 from importlib import import_module
 from time import time
-from scrapy.http import Headers
-from scrapy.responsetypes import responsetypes
+from scrapy.utils.python import to_unicode
 
-from .base import CacheStorage
+from .base import CacheStorage, handles, build_response, response_hints
 
 
 class DbmCacheStorage(CacheStorage):
@@ -17,49 +16,160 @@ class DbmCacheStorage(CacheStorage):
     def __init__(self, settings):
         super(DbmCacheStorage, self).__init__(settings)
         self.dbmodule = import_module(settings['HTTPCACHE_DBM_MODULE'])
-        self.db = None
+        self.dbs = {}
 
-    def open_spider(self, spider):
-        super(DbmCacheStorage, self).open_spider(spider)
-        dbpath = os.path.join(self.cachedir, '%s.db' % spider.name)
-        self.db = self.dbmodule.open(dbpath, 'c')
+    def open_spider(self, spider, readonly=False):
+        super(DbmCacheStorage, self).open_spider(spider, readonly)
+        flag = 'r' if readonly else 'c'
+        self.dbs[spider] = handles.acquire(self._db_path(spider),
+                                           lambda path: self.dbmodule.open(path, flag), readonly)
 
     def close_spider(self, spider):
-        self.db.close()
+        del self.dbs[spider]
+        handles.release(self._db_path(spider), lambda db: db.close())
         super(DbmCacheStorage, self).close_spider(spider)
 
-    def retrieve_response(self, spider, request):
-        data = self._read_data(spider, request)
-        if data is None:
-            return  # not cached
-        url = data['url']
-        status = data['status']
-        headers = Headers(data['headers'])
-        body = data['body']
-        respcls = responsetypes.from_args(headers=headers, url=url)
-        response = respcls(url=url, headers=headers, status=status, body=body)
-        return response
+    def retrieve_entry(self, spider, key, request=None):
+        return self._build_response(self._read_data(spider, key, request))
+
+    def retrieve_metadata(self, spider, key):
+        return self._build_response(self._read_data(spider, key, body=False))
+
+    def store_response(self, spider, request, response, metadata=None):
+        key = self._request_key(request)
+        blob = self._store_body(spider, key, response.body)
+        self._write_data(spider, key, response, metadata, blob)
 
-    def store_response(self, spider, request, response):
+    def update_metadata(self, spider, request, response, metadata=None):
         key = self._request_key(request)
+        if self._stored_blob(spider, key):
+            blob = True
+        elif '%s_body' % key in self.dbs[spider]:
+            blob = False
+        else:
+            # entries stored before bodies were kept apart, or in blob
+            # files before blobs were disabled
+            blob = self._store_body(spider, key, response.body)
+        self._write_data(spider, key, response, metadata, blob)
+
+    def iter_entries(self, spider):
+        db = self.dbs[spider]
+        for dkey in _iter_data_keys(db):
+            key = dkey[:-len('_data')]
+            try:
+                data = pickle.loads(db[dkey])
+            except KeyError:
+                continue  # removed since
+            yield key, self._body_size(db, key, data)
+
+    def delete_response(self, spider, key):
+        db = self.dbs[spider]
+        for suffix in ('_time', '_data', '_body'):
+            dkey = '%s%s' % (key, suffix)
+            if dkey in db:
+                del db[dkey]
+        self._remove_blob(spider, key)
+
+    def has_entry(self, spider, key):
+        return '%s_time' % key in self.dbs[spider]
+
+    def exists(self, spider):
+        # dbm modules may add their own suffixes
+        path = self._db_path(spider)
+        return any(os.path.exists(path + suffix) for suffix in ('', '.db', '.dat', '.pag'))
+
+    def _db_path(self, spider):
+        return os.path.join(self.cachedir, '%s.db' % spider.name)
+
+    def _body_size(self, db, key, data):
+        if 'size' in data:
+            return data['size']
+        if 'body' in data:
+            return len(data['body'])
+        return len(db.get('%s_body' % key, b''))
+
+    def _store_body(self, spider, key, body):
+        db = self.dbs[spider]
+        bkey = '%s_body' % key
+        if self._store_blob(spider, key, body):
+            if bkey in db:
+                del db[bkey]
+            return True
+        db[bkey] = body
+        return False
+
+    def _stored_blob(self, spider, key):
+        # as flagged when stored, without blobs none are used
+        if self.blob_threshold <= 0:
+            return False
+        try:
+            return pickle.loads(self.dbs[spider]['%s_data' % key]).get('blob', False)
+        except KeyError:
+            return False
+
+    def _write_data(self, spider, key, response, metadata, blob=False):
         data = {
             'status': response.status,
             'url': response.url,
             'headers': dict(response.headers),
-            'body': response.body,
+            'hints': response_hints(response),
+            'cache_metadata': self._cache_metadata(response, metadata),
+            'blob': blob,
+            'size': len(response.body),
         }
-        self.db['%s_data' % key] = pickle.dumps(data, protocol=2)
-        self.db['%s_time' % key] = str(time())
+        db = self.dbs[spider]
+        db['%s_data' % key] = pickle.dumps(data, protocol=2)
+        db['%s_time' % key] = str(time())
 
-    def _read_data(self, spider, request):
-        key = self._request_key(request)
-        db = self.db
+    def _build_response(self, data):
+        if data is None:
+            return  # not cached
+        response = build_response(data['url'], data['status'], data['headers'],
+                                  data['body'], data.get('hints'))
+        response.cache_metadata = data.get('cache_metadata', {})
+        response.cache_timestamp = data['timestamp']
+        if data.get('expired'):
+            response.flags.append('expired')
+        return response
+
+    def _read_data(self, spider, key, request=None, body=True):
+        db = self.dbs[spider]
         tkey = '%s_time' % key
         if tkey not in db:
             return  # not found
 
-        ts = db[tkey]
-        if self._is_expired(ts):
-            return
+        data = pickle.loads(db['%s_data' % key])
+        if not body:
+            data['body'] = b''  # not read
+        elif data.get('blob'):
+            data['body'] = self._read_blob(spider, key)
+            if data['body'] is None:
+                return  # invalid entry
+        elif 'body' not in data:
+            data['body'] = db['%s_body' % key]
+        data['timestamp'] = float(db[tkey])
+        data['expired'] = self._is_expired(data['timestamp'], request=request)
+        return data
+
+
+def _iter_data_keys(db):
+    """Iterate over the data keys of the entries of a dbm database. gdbm
+    ones are walked one key at a time rather than listed, finding the next
+    entry before yielding one, so that it can be deleted meanwhile."""
+    if not hasattr(db, 'firstkey'):
+        for dkey in db.keys():
+            dkey = to_unicode(dkey)  # bytes for most dbm modules
+            if dkey.endswith('_data'):
+                yield dkey
+        return
+    dkey = _walk_to_data(db, db.firstkey())
+    while dkey is not None:
+        nextkey = _walk_to_data(db, db.nextkey(dkey))
+        yield to_unicode(dkey)
+        dkey = nextkey
+
 
-        return pickle.loads(db['%s_data' % key])
+def _walk_to_data(db, dkey):
+    while dkey is not None and not to_unicode(dkey).endswith('_data'):
+        dkey = db.nextkey(dkey)
+    return dkey
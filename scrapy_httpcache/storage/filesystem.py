@@ -1,77 +1,207 @@
 import os
+import errno
 import gzip
+import shutil
+import struct
 from six.moves import cPickle as pickle
 from time import time
 from w3lib.http import headers_raw_to_dict, headers_dict_to_raw
-from scrapy.http import Headers
-from scrapy.responsetypes import responsetypes
 from scrapy.utils.python import to_bytes
 
-from .base import CacheStorage
+from .base import CacheStorage, build_response, response_hints
 
 
 class FilesystemCacheStorage(CacheStorage):
     """ Cache Storage backend for storing data as plain files in a directory tree.
+
+    Entries are spread over ``fanout_depth`` levels of shard directories,
+    named after the next ``fanout_width`` characters of the request
+    fingerprint, which are created as entries are stored in them. Entries
+    stored with the original layout (one level, two characters) are still
+    found.
     """
 
+    LEGACY_FANOUT = (1, 2)
+    MAX_FANOUT = (4, 4)  # depth, width
+    parallel_scan = True
+
     def __init__(self, settings):
         super(FilesystemCacheStorage, self).__init__(settings)
         self.use_gzip = settings.getbool('HTTPCACHE_GZIP')
         self._open = gzip.open if self.use_gzip else open
+        self.fanout_depth = settings.getint('HTTPCACHE_FS_FANOUT_DEPTH', 1)
+        self.fanout_width = settings.getint('HTTPCACHE_FS_FANOUT_WIDTH', 2)
+        if not 0 <= self.fanout_depth <= self.MAX_FANOUT[0]:
+            raise ValueError('HTTPCACHE_FS_FANOUT_DEPTH must be between 0 and %d, not %d'
+                             % (self.MAX_FANOUT[0], self.fanout_depth))
+        if not 1 <= self.fanout_width <= self.MAX_FANOUT[1]:
+            raise ValueError('HTTPCACHE_FS_FANOUT_WIDTH must be between 1 and %d, not %d'
+                             % (self.MAX_FANOUT[1], self.fanout_width))
 
-    def retrieve_response(self, spider, request):
+    def retrieve_entry(self, spider, key, request=None):
         """Return response if present in cache, or None otherwise."""
-        metadata = self._read_meta(spider, request)
-        if metadata is None:
-            return  # not cached
-        rpath = self._get_request_path(spider, request)
-        with self._open(os.path.join(rpath, 'response_body'), 'rb') as f:
-            body = f.read()
-        with self._open(os.path.join(rpath, 'response_headers'), 'rb') as f:
-            rawheaders = f.read()
-        url = metadata.get('response_url')
-        status = metadata['status']
-        headers = Headers(headers_raw_to_dict(rawheaders))
-        respcls = responsetypes.from_args(headers=headers, url=url)
-        response = respcls(url=url, headers=headers, status=status, body=body)
-        return response
+        return self._retrieve(spider, key, request)
 
-    def store_response(self, spider, request, response):
+    def retrieve_metadata(self, spider, key):
+        return self._retrieve(spider, key, body=False)
+
+    def store_response(self, spider, request, response, metadata=None):
         """Store the given response in the cache."""
         rpath = self._get_request_path(spider, request)
-        if not os.path.exists(rpath):
-            os.makedirs(rpath)
+        try:
+            os.mkdir(rpath)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                _makedirs(rpath)  # in a new shard directory
+            elif e.errno != errno.EEXIST:
+                raise
+        with self._open(os.path.join(rpath, 'response_body'), 'wb') as f:
+            f.write(response.body)
+        self._write_meta(rpath, request, response, metadata)
+
+    def update_metadata(self, spider, request, response, metadata=None):
+        """Update the metadata and headers of a cached response, leaving its
+        body file untouched."""
+        rpath = self._find_path(spider, self._request_key(request))
+        if rpath is None or not os.path.exists(os.path.join(rpath, 'response_body')):
+            return self.store_response(spider, request, response, metadata)
+        self._write_meta(rpath, request, response, metadata)
+
+    def iter_entries(self, spider):
+        return self.iter_partition(spider, 0, 1)
+
+    def iter_partition(self, spider, partition, partitions):
+        # split by top-level directory, named after a key prefix
+        spiderdir = os.path.join(self.cachedir, spider.name)
+        if not os.path.isdir(spiderdir):
+            return
+        names = [name for name in os.listdir(spiderdir)
+                 if _hex(name) is not None and _hex(name) % partitions == partition]
+        for key, rpath in self._walk(spiderdir, names):
+            try:
+                yield key, self._body_size(os.path.join(rpath, 'response_body'))
+            except (IOError, OSError):
+                continue  # removed or incomplete entry
+
+    def delete_response(self, spider, key):
+        for rpath in self._key_paths(spider, key):
+            shutil.rmtree(rpath, ignore_errors=True)
+
+    def has_entry(self, spider, key):
+        return self._find_path(spider, key) is not None
+
+    def exists(self, spider):
+        return os.path.isdir(os.path.join(self.cachedir, spider.name))
+
+    def _body_size(self, bodypath):
+        if not self.use_gzip:
+            return os.path.getsize(bodypath)
+        # uncompressed size (modulo 2**32), from the gzip trailer
+        with open(bodypath, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+
+    def _write_meta(self, rpath, request, response, metadata):
+        # pickled_meta is written last, its mtime is the entry timestamp
         metadata = {
             'url': request.url,
             'method': request.method,
             'status': response.status,
             'response_url': response.url,
+            'response_headers': dict(response.headers),
+            'hints': response_hints(response),
             'timestamp': time(),
+            'cache_metadata': self._cache_metadata(response, metadata),
         }
-        with self._open(os.path.join(rpath, 'meta'), 'wb') as f:
-            f.write(to_bytes(repr(metadata)))
-        with self._open(os.path.join(rpath, 'pickled_meta'), 'wb') as f:
-            pickle.dump(metadata, f, protocol=2)
         with self._open(os.path.join(rpath, 'response_headers'), 'wb') as f:
             f.write(headers_dict_to_raw(response.headers))
-        with self._open(os.path.join(rpath, 'response_body'), 'wb') as f:
-            f.write(response.body)
         with self._open(os.path.join(rpath, 'request_headers'), 'wb') as f:
             f.write(headers_dict_to_raw(request.headers))
         with self._open(os.path.join(rpath, 'request_body'), 'wb') as f:
             f.write(request.body)
+        with self._open(os.path.join(rpath, 'meta'), 'wb') as f:
+            f.write(to_bytes(repr(metadata)))
+        with self._open(os.path.join(rpath, 'pickled_meta'), 'wb') as f:
+            pickle.dump(metadata, f, protocol=2)
+
+    def _retrieve(self, spider, key, request=None, body=True):
+        rpath = self._find_path(spider, key)
+        if rpath is None:
+            return  # not cached
+        metadata = self._read_meta(rpath, request)
+        if metadata is None:
+            return  # removed since
+        if body:
+            with self._open(os.path.join(rpath, 'response_body'), 'rb') as f:
+                body = f.read()
+        else:
+            body = b''  # not read
+        if 'hints' in metadata:
+            headers = metadata['response_headers']
+        else:  # stored before hints were
+            with self._open(os.path.join(rpath, 'response_headers'), 'rb') as f:
+                headers = headers_raw_to_dict(f.read())
+        response = build_response(metadata.get('response_url'), metadata['status'],
+                                  headers, body, metadata.get('hints'))
+        response.cache_metadata = metadata.get('cache_metadata', {})
+        response.cache_timestamp = metadata['mtime']
+        if metadata.get('expired'):
+            response.flags.append('expired')
+        return response
 
     def _get_request_path(self, spider, request):
-        key = self._request_key(request)
-        return os.path.join(self.cachedir, spider.name, key[0:2], key)
+        return self._key_paths(spider, self._request_key(request))[0]
 
-    def _read_meta(self, spider, request):
-        rpath = self._get_request_path(spider, request)
+    def _key_paths(self, spider, key):
+        """Return the paths where an entry may be stored, the one of the
+        current layout first."""
+        paths = []
+        for depth, width in ((self.fanout_depth, self.fanout_width), self.LEGACY_FANOUT):
+            shards = [key[i * width:(i + 1) * width] for i in range(depth)]
+            path = os.path.join(self.cachedir, spider.name, *(shards + [key]))
+            if path not in paths:
+                paths.append(path)
+        return paths
+
+    def _find_path(self, spider, key):
+        for rpath in self._key_paths(spider, key):
+            if os.path.exists(os.path.join(rpath, 'pickled_meta')):
+                return rpath
+
+    def _walk(self, path, names=None):
+        # shard directory names are shorter than fingerprints
+        for name in os.listdir(path) if names is None else names:
+            subpath = os.path.join(path, name)
+            if len(name) > max(self.fanout_width, self.LEGACY_FANOUT[1]):
+                yield name, subpath
+            elif os.path.isdir(subpath):
+                for entry in self._walk(subpath):
+                    yield entry
+
+    def _read_meta(self, rpath, request=None):
         metapath = os.path.join(rpath, 'pickled_meta')
-        if not os.path.exists(metapath):
+        try:
+            ts = os.stat(metapath).st_mtime
+        except OSError:
             return  # not found
-        ts = os.stat(metapath).st_mtime
-        if self._is_expired(ts):
-            return
         with self._open(metapath, 'rb') as f:
-            return pickle.load(f)
+            metadata = pickle.load(f)
+        metadata['mtime'] = ts
+        metadata['expired'] = self._is_expired(ts, request=request)
+        return metadata
+
+
+def _makedirs(path):
+    # created meanwhile by another writer, for all it matters
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _hex(name):
+    try:
+        return int(name, 16)
+    except ValueError:
+        return None
@@ -4,12 +4,10 @@ import os
 from six.moves import cPickle as pickle
 from importlib import import_module
 from time import time
-from scrapy.http import Headers
-from scrapy.responsetypes import responsetypes
-from scrapy.utils.python import garbage_collect, to_bytes
+from scrapy.utils.python import garbage_collect, to_bytes, to_unicode
 from scrapy.exceptions import NotConfigured
 
-from .base import CacheStorage
+from .base import CacheStorage, handles, build_response, response_hints
 
 
 class LeveldbCacheStorage(CacheStorage):
@@ -27,80 +25,176 @@ class LeveldbCacheStorage(CacheStorage):
         else:
             self.dbmodule = import_module(settings['HTTPCACHE_DB_MODULE'])
         self.dbdriver = self.dbmodule.__name__
-        self.db = None
+        self.dbs = {}
 
-    def open_spider(self, spider):
-        super(LeveldbCacheStorage, self).open_spider(spider)
-        dbpath = os.path.join(self.cachedir, '%s.leveldb' % spider.name)
+    def open_spider(self, spider, readonly=False):
+        super(LeveldbCacheStorage, self).open_spider(spider, readonly)
+        # LevelDB databases can only be opened once, share them
+        self.dbs[spider] = handles.acquire(self._db_path(spider),
+                                           lambda path: self._open_db(path, not readonly),
+                                           readonly)
+
+    def close_spider(self, spider):
+        del self.dbs[spider]
+        handles.release(self._db_path(spider), self._close_db)
+        garbage_collect()  # the leveldb driver only closes on deallocation
+        super(LeveldbCacheStorage, self).close_spider(spider)
+
+    def _db_path(self, spider):
+        return os.path.join(self.cachedir, '%s.leveldb' % spider.name)
+
+    def exists(self, spider):
+        return os.path.isdir(self._db_path(spider))
+
+    def _open_db(self, dbpath, create=True):
         if self.dbdriver == 'plyvel':
-            self.db = self.dbmodule.DB(dbpath, create_if_missing=True)
+            return self.dbmodule.DB(dbpath, create_if_missing=create)
         elif self.dbdriver == 'leveldb':
-            self.db = self.dbmodule.LevelDB(dbpath)
+            return self.dbmodule.LevelDB(dbpath, create_if_missing=create)
 
-    def close_spider(self, spider):
+    def _close_db(self, db):
         # Do compactation each time to save space and also recreate files to
         # avoid them being removed in storages with timestamp-based autoremoval.
         if self.dbdriver == 'plyvel':
-            self.db.compact_range()
+            db.compact_range()
+            db.close()
         elif self.dbdriver == 'leveldb':
-            self.db.CompactRange()
-        del self.db
-        garbage_collect()
-        super(LeveldbCacheStorage, self).close_spider(spider)
+            db.CompactRange()
 
-    def retrieve_response(self, spider, request):
-        data = self._read_data(spider, request)
-        if data is None:
-            return  # not cached
-        url = data['url']
-        status = data['status']
-        headers = Headers(data['headers'])
-        body = data['body']
-        respcls = responsetypes.from_args(headers=headers, url=url)
-        response = respcls(url=url, headers=headers, status=status, body=body)
-        return response
+    def retrieve_entry(self, spider, key, request=None):
+        return self._build_response(self._read_data(spider, key, request))
+
+    def retrieve_metadata(self, spider, key):
+        return self._build_response(self._read_data(spider, key, body=False))
+
+    def store_response(self, spider, request, response, metadata=None):
+        key = self._request_key(request)
+        blob = self._store_blob(spider, key, response.body)
+        self._write_data(spider, to_bytes(key), response, metadata,
+                         body=None if blob else response.body, blob=blob)
+
+    def update_metadata(self, spider, request, response, metadata=None):
+        key = self._request_key(request)
+        body, blob = None, self._stored_blob(spider, key)
+        if not blob and self._get(spider, to_bytes(key) + b'_body') is None:
+            # entries stored before bodies were kept apart, or in blob files
+            # before blobs were disabled
+            blob = self._store_blob(spider, key, response.body)
+            body = None if blob else response.body
+        self._write_data(spider, to_bytes(key), response, metadata, body=body, blob=blob)
+
+    def iter_entries(self, spider):
+        db = self.dbs[spider]
+        if self.dbdriver == 'plyvel':
+            items = db.iterator()
+        elif self.dbdriver == 'leveldb':
+            items = db.RangeIter()
+        for dkey, value in items:
+            dkey = bytes(dkey)
+            if not dkey.endswith(b'_data'):
+                continue
+            key = dkey[:-len(b'_data')]
+            data = pickle.loads(bytes(value))
+            if 'size' in data:
+                size = data['size']
+            elif 'body' in data:
+                size = len(data['body'])
+            else:
+                size = len(self._get(spider, key + b'_body') or b'')
+            yield to_unicode(key), size
 
-    def store_response(self, spider, request, response):
-        key = to_bytes(self._request_key(request))
+    def has_entry(self, spider, key):
+        return self._get(spider, to_bytes(key) + b'_time') is not None
+
+    def delete_response(self, spider, key):
+        db, dkey = self.dbs[spider], to_bytes(key)
+        if self.dbdriver == 'plyvel':
+            with db.write_batch() as batch:
+                for suffix in (b'_time', b'_data', b'_body'):
+                    batch.delete(dkey + suffix)
+        elif self.dbdriver == 'leveldb':
+            batch = self.dbmodule.WriteBatch()
+            for suffix in (b'_time', b'_data', b'_body'):
+                batch.Delete(dkey + suffix)
+            db.Write(batch)
+        self._remove_blob(spider, key)
+
+    def _write_data(self, spider, key, response, metadata, body=None, blob=False):
         data = {
             'status': response.status,
             'url': response.url,
             'headers': dict(response.headers),
-            'body': response.body,
+            'hints': response_hints(response),
+            'cache_metadata': self._cache_metadata(response, metadata),
+            'blob': blob,
+            'size': len(response.body),
         }
+        db = self.dbs[spider]
         if self.dbdriver == 'plyvel':
-            with self.db.write_batch() as batch:
+            with db.write_batch() as batch:
+                if body is not None:
+                    batch.put(key + b'_body', body)
+                elif blob:
+                    batch.delete(key + b'_body')
                 batch.put(key + b'_data', pickle.dumps(data, protocol=2))
                 batch.put(key + b'_time', to_bytes(str(time())))
         elif self.dbdriver == 'leveldb':
             batch = self.dbmodule.WriteBatch()
+            if body is not None:
+                batch.Put(key + b'_body', body)
+            elif blob:
+                batch.Delete(key + b'_body')
             batch.Put(key + b'_data', pickle.dumps(data, protocol=2))
             batch.Put(key + b'_time', to_bytes(str(time())))
-            self.db.Write(batch)
+            db.Write(batch)
 
-    def _read_data(self, spider, request):
-        key = to_bytes(self._request_key(request))
+    def _stored_blob(self, spider, key):
+        # as flagged when stored, without blobs none are used
+        if self.blob_threshold <= 0:
+            return False
+        data = self._get(spider, to_bytes(key) + b'_data')
+        return data is not None and pickle.loads(data).get('blob', False)
+
+    def _get(self, spider, key):
+        db = self.dbs[spider]
+        if self.dbdriver == 'plyvel':
+            return db.get(key)
         try:
-            if self.dbdriver == 'plyvel':
-                ts = self.db.get(key + b'_time')
-                if ts is None:
-                    raise KeyError
-            elif self.dbdriver == 'leveldb':
-                ts = self.db.Get(key + b'_time')
+            return bytes(db.Get(key))
         except KeyError:
-            return  # not found or invalid entry
+            return None
 
-        if self._is_expired(ts):
-            return
+    def _build_response(self, data):
+        if data is None:
+            return  # not cached
+        response = build_response(data['url'], data['status'], data['headers'],
+                                  data['body'], data.get('hints'))
+        response.cache_metadata = data.get('cache_metadata', {})
+        response.cache_timestamp = data['timestamp']
+        if data.get('expired'):
+            response.flags.append('expired')
+        return response
 
-        try:
-            if self.dbdriver == 'plyvel':
-                data = self.db.get(key + b'_data')
-                if data is None:
-                    raise KeyError
-            elif self.dbdriver == 'leveldb':
-                data = self.db.Get(key + b'_data')
-        except KeyError:
+    def _read_data(self, spider, fingerprint, request=None, body=True):
+        key = to_bytes(fingerprint)
+        ts = self._get(spider, key + b'_time')
+        if ts is None:
+            return  # not found or invalid entry
+
+        data = self._get(spider, key + b'_data')
+        if data is None:
             return  # invalid entry
-        else:
-            return pickle.loads(data)
+        data = pickle.loads(data)
+        if not body:
+            data['body'] = b''  # not read
+        elif data.get('blob'):
+            data['body'] = self._read_blob(spider, fingerprint)
+            if data['body'] is None:
+                return  # invalid entry
+        elif 'body' not in data:
+            data['body'] = self._get(spider, key + b'_body')
+            if data['body'] is None:
+                return  # invalid entry
+        data['timestamp'] = float(ts)
+        data['expired'] = self._is_expired(ts, request=request)
+        return data
@@ -3,14 +3,15 @@
 A MongoDB Cache Storage backend which stores responses using GridFS.
 """
 import os
+import re
 import logging
 from time import time
 
-from scrapy.responsetypes import responsetypes
 from scrapy.exceptions import NotConfigured
-from scrapy.http import Headers
+from scrapy.http.headers import Headers
+from scrapy.utils.python import to_bytes, to_unicode
 
-from .base import CacheStorage
+from .base import CacheStorage, key_range, build_response, response_hints
 
 try:
     from pymongo import MongoClient, MongoReplicaSetClient
@@ -76,6 +77,8 @@ class MongodbCacheStorage(CacheStorage):
     each spider, similar to FilesystemCacheStorage using folders per spider.
     """
 
+    parallel_scan = True
+
     def __init__(self, settings, **kw):
         if MongoClient is None:
             raise NotConfigured('%s is missing pymongo or gridfs module.' %
@@ -125,41 +128,40 @@ class MongodbCacheStorage(CacheStorage):
         logger.debug("Backend %(storage)s connected to %(host)s:%(port)s, using database '%(db)s'" %
             {'storage': self.__class__.__name__, 'host': client.host, 'port': client.port, 'db': db})
         self.fs = {}
+        self.files = {}
 
-    def open_spider(self, spider):
+    def open_spider(self, spider, readonly=False):
         _shard = 'httpcache'
         if self.sharded:
             _shard = 'httpcache.%s' % spider.name
         self.fs[spider] = GridFS(self.db, _shard)
+        self.files[spider] = self.db['%s.files' % _shard]
 
     def close_spider(self, spider):
         del self.fs[spider]
+        del self.files[spider]
 
     def __del__(self):
         if hasattr(self, 'db'):
             self.db.connection.close()
 
-    def retrieve_response(self, spider, request):
-        key = self._request_key(spider, request)
-        gf = self._get_file(spider, key)
-        if gf is None:
-            return # not cached
-        url = str(gf.url)
-        status = str(gf.status)
-        headers = Headers([(x, map(str, y)) for x, y in gf.headers.iteritems()])
-        body = gf.read()
-        respcls = responsetypes.from_args(headers=headers, url=url)
-        response = respcls(url=url, headers=headers, status=status, body=body)
-        return response
+    def retrieve_entry(self, spider, key, request=None):
+        return self._retrieve(spider, key, request)
 
-    def store_response(self, spider, request, response):
-        key = self._request_key(spider, request)
+    def retrieve_metadata(self, spider, key):
+        # file attributes are read without the body chunks
+        return self._retrieve(spider, key, body=False)
+
+    def store_response(self, spider, request, response, metadata=None):
+        key = self._file_key(spider, self._request_key(request))
         metadata = {
             '_id': key,
             'time': time(),
             'status': response.status,
             'url': response.url,
-            'headers': dict(response.headers),
+            'headers': _encode_headers(response.headers),
+            'hints': response_hints(response),
+            'cache_metadata': self._cache_metadata(response, metadata),
         }
         try:
             self.fs[spider].put(response.body, **metadata)
@@ -167,20 +169,76 @@ class MongodbCacheStorage(CacheStorage):
             self.fs[spider].delete(key)
             self.fs[spider].put(response.body, **metadata)
 
+    def update_metadata(self, spider, request, response, metadata=None):
+        # GridFS keeps file attributes apart from the body chunks
+        key = self._file_key(spider, self._request_key(request))
+        result = self.files[spider].update_one({'_id': key}, {'$set': {
+            'time': time(),
+            'status': response.status,
+            'url': response.url,
+            'headers': _encode_headers(response.headers),
+            'hints': response_hints(response),
+            'cache_metadata': self._cache_metadata(response, metadata),
+        }})
+        if not result.matched_count:
+            self.store_response(spider, request, response, metadata)
+
+    def iter_entries(self, spider):
+        prefix = '%s/' % spider.name
+        query = {'_id': {'$regex': '^%s' % re.escape(prefix)}}
+        for doc in self.files[spider].find(query, ['length']):
+            yield doc['_id'][len(prefix):], doc['length']
+
+    def iter_partition(self, spider, partition, partitions):
+        # ranges of _id, which is indexed ('~' sorts after hex digits)
+        prefix = '%s/' % spider.name
+        lo, hi = key_range(partition, partitions)
+        query = {'_id': {'$gt': prefix + lo, '$lt': prefix + (hi or '~')}}
+        for doc in self.files[spider].find(query, ['length']):
+            yield doc['_id'][len(prefix):], doc['length']
+
+    def delete_response(self, spider, key):
+        self.fs[spider].delete(self._file_key(spider, key))
+
+    def has_entry(self, spider, key):
+        query = {'_id': self._file_key(spider, key)}
+        return self.files[spider].find_one(query, ['_id']) is not None
+
+    def _retrieve(self, spider, key, request=None, body=True):
+        gf = self._get_file(spider, self._file_key(spider, key))
+        if gf is None:
+            return # not cached
+        response = build_response(str(gf.url), gf.status, _decode_headers(gf.headers),
+                                  gf.read() if body else b'', getattr(gf, 'hints', None))
+        response.cache_metadata = getattr(gf, 'cache_metadata', None) or {}
+        response.cache_timestamp = gf.time
+        if self._is_expired(gf.time, request=request):
+            response.flags.append('expired')
+        return response
+
     def _get_file(self, spider, key):
         try:
-            gf = self.fs[spider].get(key)
+            return self.fs[spider].get(key)
         except errors.NoFile:
             return # not found
-        if self._is_expired(gf.time):
-            return
-        return gf
 
-    def _request_key(self, spider, request):
-        rfp = self._request_key(request)
+    def _file_key(self, spider, rfp):
         # We could disable the namespacing in sharded mode (old behaviour),
         # but keeping it allows us to merge collections later without
         # worrying about key conflicts.
         #if self.sharded:
         #    return rfp
         return '%s/%s' % (spider.name, rfp)
+
+
+def _encode_headers(headers):
+    # BSON names and values are text, latin-1 keeps any byte
+    return [[to_unicode(name, 'latin-1'), [to_unicode(value, 'latin-1') for value in values]]
+            for name, values in headers.items()]
+
+
+def _decode_headers(headers):
+    if isinstance(headers, dict):  # stored before pairs were
+        headers = headers.items()
+    return Headers([(to_bytes(name, 'latin-1'), [to_bytes(value, 'latin-1') for value in values])
+                    for name, values in headers])
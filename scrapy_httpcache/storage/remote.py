@@ -0,0 +1,398 @@
+""" Remote Cache Storage
+
+A Cache Storage backend for crawler fleets, sharing the cache of an HTTP
+cache server (``scrapy httpcacheserver``), optionally in front of a local
+storage.
+"""
+import socket
+import logging
+from collections import OrderedDict
+from io import BytesIO
+from time import time
+
+from six.moves import http_client
+from six.moves.urllib.parse import urlparse
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.misc import load_object
+from scrapy.utils.python import to_bytes
+
+from .base import CacheStorage
+from ..serialization import dumps, loads, encode_request, encode_response, decode_response
+
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteCacheError(Exception):
+    """The cache server could not be reached or failed to answer."""
+
+
+class ConnectionPool(object):
+    """ Blocking keep-alive connections to the cache server, reused between
+    requests and reopened when the server has closed them. """
+
+    def __init__(self, url, maxsize=4, timeout=30):
+        url = _server_url(url)
+        self.connectioncls = http_client.HTTPSConnection if url.scheme == 'https' \
+            else http_client.HTTPConnection
+        self.netloc = url.netloc
+        self.path = url.path.rstrip('/')
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = []
+
+    def request(self, method, path, body=None):
+        """Send a request and return the body of its response."""
+        reused = bool(self._idle)
+        conn = self._idle.pop() if reused else self._connect()
+        try:
+            conn.request(method, self.path + path, body,
+                         {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            data = response.read()
+        except (socket.error, http_client.HTTPException) as e:
+            conn.close()
+            if reused:
+                return self.request(method, path, body)  # closed by the server
+            raise RemoteCacheError(str(e))
+        if response.will_close or len(self._idle) >= self.maxsize:
+            conn.close()
+        else:
+            self._idle.append(conn)
+        if response.status != 200:
+            raise RemoteCacheError('Cache server answered %d to %s %s'
+                                   % (response.status, method, path))
+        return data
+
+    def close(self):
+        for conn in self._idle:
+            conn.close()
+        self._idle = []
+
+    def _connect(self):
+        return self.connectioncls(self.netloc, timeout=self.timeout)
+
+
+class AgentPool(object):
+    """ Connections to the cache server made by a Twisted ``Agent``, which
+    do not block the reactor: ``request()`` returns a Deferred. """
+
+    def __init__(self, url, maxsize=4, timeout=30, reactor=None):
+        from twisted.web.client import Agent, HTTPConnectionPool
+        if reactor is None:
+            from twisted.internet import reactor
+        self.url = _server_url(url).geturl().rstrip('/')
+        self.timeout = timeout
+        self.reactor = reactor
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = maxsize
+        self._agent = Agent(reactor, connectTimeout=timeout, pool=self._pool)
+
+    def request(self, method, path, body=None):
+        """Send a request and return a Deferred firing with the body of its
+        response."""
+        from twisted.web.client import FileBodyProducer
+        from twisted.web.http_headers import Headers
+        producer = FileBodyProducer(BytesIO(body)) if body is not None else None
+        d = self._agent.request(to_bytes(method), to_bytes(self.url + path),
+                                Headers({b'Content-Type': [b'application/json']}), producer)
+        d.addCallback(self._read_body, method, path)
+        d.addTimeout(self.timeout, self.reactor)
+        d.addErrback(self._error)
+        return d
+
+    def close(self):
+        return self._pool.closeCachedConnections()
+
+    def _read_body(self, response, method, path):
+        from twisted.web.client import readBody
+        d = readBody(response)
+        if response.code != 200:
+            d.addBoth(lambda _: Failure(RemoteCacheError(
+                'Cache server answered %d to %s %s' % (response.code, method, path))))
+        return d
+
+    def _error(self, failure):
+        if failure.check(RemoteCacheError):
+            return failure
+        raise RemoteCacheError(failure.getErrorMessage())
+
+
+class RemoteCacheStorage(CacheStorage):
+    """ Cache Storage backend storing responses on the cache server at
+    ``HTTPCACHE_REMOTE_URL``, so that they are downloaded once for a whole
+    fleet of crawlers.
+
+    While the reactor runs, requests to the server do not block it:
+    ``retrieve_response()`` returns a Deferred when the response has to be
+    looked up on the server. Up to ``HTTPCACHE_REMOTE_POOL_SIZE`` lookups
+    are sent at once, and the keys looked up meanwhile are sent together in
+    the next ones. Writes and deletions are sent in batches of
+    ``HTTPCACHE_REMOTE_BATCH_SIZE``, metadata updates without the body.
+    ``iter_entries()``, ``iter_partition()`` and ``retrieve_entry()`` block,
+    they are meant for the ``httpcache`` command.
+
+    If ``HTTPCACHE_REMOTE_LOCAL_STORAGE`` is set, responses are also kept in
+    that storage, and only looked up on the server when missing or expired
+    there. Server errors are logged, and make lookups miss.
+    """
+
+    parallel_scan = True
+    threaded_writes = False  # sent from the reactor, without blocking it
+
+    def __init__(self, settings):
+        super(RemoteCacheStorage, self).__init__(settings)
+        self.url = settings.get('HTTPCACHE_REMOTE_URL', 'http://127.0.0.1:6810')
+        self.pool_size = settings.getint('HTTPCACHE_REMOTE_POOL_SIZE', 4)
+        self.timeout = settings.getfloat('HTTPCACHE_REMOTE_TIMEOUT', 30)
+        self.syncpool = ConnectionPool(self.url, maxsize=self.pool_size, timeout=self.timeout)
+        self.pool = None  # chosen when opened, unless set
+        self.batch_size = settings.getint('HTTPCACHE_REMOTE_BATCH_SIZE', 20)
+        self.local = None
+        if settings.get('HTTPCACHE_REMOTE_LOCAL_STORAGE'):
+            self.local = load_object(settings['HTTPCACHE_REMOTE_LOCAL_STORAGE'])(settings)
+        # (spider, fingerprint) -> [method, request, response, metadata, timestamp]
+        self._pending = OrderedDict()
+        # (spider, fingerprint), to delete
+        self._deleted = OrderedDict()
+        # (spider, fingerprint) -> Deferreds waiting for the lookup
+        self._lookups = OrderedDict()
+        self._getting = 0  # lookups sent
+        self._sending = set()  # Deferreds of the requests sent
+
+    def open_spider(self, spider, readonly=False):
+        super(RemoteCacheStorage, self).open_spider(spider, readonly)
+        if self.pool is None:
+            from twisted.internet import reactor
+            self.pool = AgentPool(self.url, self.pool_size, self.timeout) \
+                if reactor.running else self.syncpool
+        if self.local is not None:
+            self.local.open_spider(spider, readonly)
+
+    def close_spider(self, spider):
+        """Send the pending writes of the spider, and return a Deferred
+        firing once all the requests sent to the server are done."""
+        self.flush(spider)
+        if self.local is not None:
+            self.local.close_spider(spider)
+        super(RemoteCacheStorage, self).close_spider(spider)
+        d = defer.DeferredList(list(self._sending))
+        d.addBoth(lambda _: self.pool.close())
+        return d
+
+    def retrieve_response(self, spider, request):
+        """Return the cached response for the request or None, or a Deferred
+        firing with them if it is looked up on a server not answered yet."""
+        key = self._request_key(request)
+        if (spider, key) in self._deleted:
+            return
+        cached = self._retrieve_pending(spider, key)
+        if cached is None:
+            cached = self._retrieve_local(spider, key, request)
+            if cached is None or self._is_expired(cached.cache_timestamp, request=request):
+                d = self._lookup(spider, key)
+                d.addCallback(self._retrieved_remote, spider, request, cached)
+                return _result(d)
+        return self._flag_expired(cached, request)
+
+    def retrieve_entry(self, spider, key, request=None):
+        if (spider, key) in self._deleted:
+            return
+        cached = self._retrieve_pending(spider, key)
+        if cached is None:
+            cached = self._retrieve_local(spider, key, request)
+            if cached is None or self._is_expired(cached.cache_timestamp, request=request):
+                try:
+                    data = loads(self.syncpool.request('POST', '/%s/get' % spider.name,
+                                                       dumps({'keys': [key]})))
+                except RemoteCacheError as e:
+                    self._log_error(Failure(e), "reading from", spider)
+                    data = {'responses': {}}
+                cached = self._retrieved_remote(self._decode(data['responses'].get(key)),
+                                                spider, request, cached)
+        return self._flag_expired(cached, request)
+
+    def store_response(self, spider, request, response, metadata=None):
+        self._put('store_response', spider, request, response, metadata)
+
+    def update_metadata(self, spider, request, response, metadata=None):
+        self._put('update_metadata', spider, request, response, metadata)
+
+    def iter_entries(self, spider):
+        return self.iter_partition(spider, 0, 1)
+
+    def iter_partition(self, spider, partition, partitions):
+        self.flush(spider)
+        start = None
+        while True:
+            data = loads(self.syncpool.request('GET', '/%s/entries' % spider.name, dumps({
+                'partition': partition,
+                'partitions': partitions,
+                'start': start,
+            })))
+            for key, size in data['entries']:
+                yield key, size
+            start = data.get('next')
+            if start is None:
+                break
+
+    def delete_response(self, spider, key):
+        self._pending.pop((spider, key), None)
+        if self.local is not None:
+            self.local.delete_response(spider, key)
+        self._deleted[(spider, key)] = True
+        if len(self._deleted) >= self.batch_size:
+            self.flush()
+
+    def flush(self, spider=None):
+        """Send the pending deletions and writes (of the given spider only,
+        if any) to the server."""
+        deletions = OrderedDict()
+        for key in list(self._deleted):
+            if spider is None or key[0] is spider:
+                del self._deleted[key]
+                deletions.setdefault(key[0], []).append(key[1])
+        for spider_, keys in deletions.items():
+            d = self._send(spider_, 'delete', dumps({'keys': keys}))
+            d.addErrback(self._log_error, "deleting %d responses from" % len(keys), spider_)
+        batches = OrderedDict()
+        for key in list(self._pending):
+            if spider is None or key[0] is spider:
+                batches.setdefault(key[0], []).append((key[1], self._pending.pop(key)))
+        for spider_, entries in batches.items():
+            self._send_entries(spider_, entries)
+
+    def _put(self, method, spider, request, response, metadata):
+        key = (spider, self._request_key(request))
+        timestamp = time()
+        if self.local is not None:
+            self._store_local(spider, request, response, metadata, timestamp)
+        self._deleted.pop(key, None)  # written again
+        previous = self._pending.pop(key, None)
+        if previous is not None and previous[0] == 'store_response':
+            method = 'store_response'  # the body was never sent, it still has to be
+        self._pending[key] = [method, request, response, metadata, timestamp]
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def _send_entries(self, spider, entries):
+        # metadata updates are sent without the body, which the server has
+        body = dumps({'entries': [{
+            'method': method,
+            'request': encode_request(request),
+            'response': encode_response(response, body=method == 'store_response'),
+            'metadata': metadata,
+        } for _, (method, request, response, metadata, _) in entries]})
+        d = self._send(spider, 'put', body)
+        d.addCallback(self._send_missing, spider, entries)
+        d.addErrback(self._log_error, "writing %d responses to" % len(entries), spider)
+
+    def _send_missing(self, data, spider, entries):
+        # updated responses the server does not have, send them whole
+        missing = set(data.get('missing', ()))
+        entries = [(key, ['store_response'] + entry[1:])
+                   for key, entry in entries if key in missing]
+        if entries:
+            self._send_entries(spider, entries)
+
+    def _send(self, spider, operation, body):
+        d = defer.maybeDeferred(self.pool.request, 'POST',
+                                '/%s/%s' % (spider.name, operation), body)
+        d.addCallback(loads)
+        if not d.called:
+            self._sending.add(d)
+            d.addBoth(lambda result: self._sending.discard(d) or result)
+        return d
+
+    def _lookup(self, spider, key):
+        d = defer.Deferred()
+        self._lookups.setdefault((spider, key), []).append(d)
+        self._send_lookups()
+        return d
+
+    def _send_lookups(self):
+        while self._lookups and self._getting < self.pool_size:
+            spider = next(iter(self._lookups))[0]
+            waiting = OrderedDict()
+            for key in list(self._lookups):
+                if key[0] is spider and len(waiting) < self.batch_size:
+                    waiting[key[1]] = self._lookups.pop(key)
+            self._getting += 1
+            d = self._send(spider, 'get', dumps({'keys': list(waiting)}))
+            d.addCallback(lambda data: data['responses'])
+            d.addErrback(self._log_error, "reading from", spider, {})
+            d.addCallback(self._looked_up, waiting)
+
+    def _looked_up(self, responses, waiting):
+        self._getting -= 1
+        for key, deferreds in waiting.items():
+            for d in deferreds:
+                d.callback(self._decode(responses.get(key)))
+        self._send_lookups()
+
+    def _decode(self, data):
+        if data is not None:
+            return decode_response(data)
+
+    def _retrieved_remote(self, remote, spider, request, cached):
+        if remote is not None:
+            if request is not None and self.local is not None:
+                self._store_local(spider, request, remote, remote.cache_metadata,
+                                  remote.cache_timestamp)
+            cached = remote
+        return self._flag_expired(cached, request)
+
+    def _flag_expired(self, cached, request):
+        if cached is not None and 'expired' not in cached.flags and \
+                self._is_expired(cached.cache_timestamp, request=request):
+            cached.flags.append('expired')
+        return cached
+
+    def _retrieve_pending(self, spider, key):
+        entry = self._pending.get((spider, key))
+        if entry is None:
+            return
+        _, _, response, metadata, timestamp = entry
+        cached = response.replace(flags=[])
+        cached.cache_metadata = self._cache_metadata(response, metadata)
+        cached.cache_timestamp = timestamp
+        return cached
+
+    def _log_error(self, failure, action, spider, result=None):
+        failure.trap(RemoteCacheError)
+        logger.error("Error %(action)s the HTTP cache server: %(error)s",
+                     {'action': action, 'error': failure.value}, extra={'spider': spider})
+        return result
+
+    def _retrieve_local(self, spider, key, request):
+        if self.local is None:
+            return
+        cached = self.local.retrieve_entry(spider, key, request)
+        if cached is not None:
+            # expire responses as stored on the server, not locally
+            cached.cache_timestamp = cached.cache_metadata.pop(
+                '_remote_timestamp', cached.cache_timestamp)
+            if 'expired' in cached.flags:
+                cached.flags.remove('expired')
+        return cached
+
+    def _store_local(self, spider, request, response, metadata, timestamp):
+        metadata = dict(metadata or {}, _remote_timestamp=timestamp)
+        self.local.store_response(spider, request, response, metadata)
+
+
+def _server_url(url):
+    url = urlparse(url)
+    if url.scheme not in ('http', 'https'):
+        raise NotConfigured('Unsupported cache server URL: %s' % url.geturl())
+    return url
+
+
+def _result(d):
+    """Return the result of a Deferred which already fired (when the
+    server is answered synchronously), or the Deferred."""
+    results = []
+    d.addCallback(lambda result: results.append(result) or result)
+    return results[0] if results else d
@@ -0,0 +1,222 @@
+""" Sharded Cache Storage
+
+A Cache Storage backend which spreads responses over several child storages
+(e.g. SQLite databases on different disks, or several MongoDB servers) by
+consistent hashing of their request fingerprints.
+"""
+import os
+import json
+import hashlib
+from bisect import bisect
+
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.misc import load_object
+from scrapy.utils.python import to_bytes
+
+from .base import CacheStorage
+
+
+class HashRing(object):
+    """ Map keys to shard names, each shard owning ``vnodes`` points of a
+    hash ring and the keys hashed right before them.
+
+    Adding a shard only moves to it about ``1 / number of shards`` of the
+    keys, from all the others, and removing one only moves the keys it
+    owned.
+    """
+
+    def __init__(self, names=(), vnodes=160):
+        self.vnodes = vnodes
+        self._points = []
+        self._names = []
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(set(self._names))
+
+    def add(self, name):
+        ring = list(zip(self._points, self._names))
+        ring.extend((self._hash('%s-%d' % (name, i)), name) for i in range(self.vnodes))
+        ring.sort()
+        self._points = [point for point, _ in ring]
+        self._names = [name for _, name in ring]
+
+    def remove(self, name):
+        ring = [(p, n) for p, n in zip(self._points, self._names) if n != name]
+        self._points = [point for point, _ in ring]
+        self._names = [name for _, name in ring]
+
+    def get(self, key):
+        if not self._points:
+            raise KeyError(key)
+        i = bisect(self._points, self._hash(key)) % len(self._points)
+        return self._names[i]
+
+    def _hash(self, value):
+        return int(hashlib.md5(to_bytes(value)).hexdigest()[:16], 16)
+
+
+class ShardedCacheStorage(CacheStorage):
+    """ Cache Storage backend routing each response to one of the shards
+    configured in ``HTTPCACHE_SHARDS``.
+
+    The setting maps shard names to the settings overriding those of the
+    crawler for their storage, e.g. their ``HTTPCACHE_DIR`` (which defaults
+    to a subdirectory named after the shard) or ``HTTPCACHE_STORAGE`` (which
+    defaults to ``HTTPCACHE_SHARD_STORAGE``). Shards are placed on the hash
+    ring by name, so renaming one moves its responses.
+
+    The shards used by previous runs of each spider are kept in
+    ``shards.json``: after shards are added, responses not found in their
+    shard are looked up in the shards which owned them before, and moved to
+    their shard when written again. Previous shards are forgotten once no
+    response is left in them.
+    """
+
+    def __init__(self, settings):
+        super(ShardedCacheStorage, self).__init__(settings)
+        shards = settings.getdict('HTTPCACHE_SHARDS')
+        if not shards:
+            raise NotConfigured('HTTPCACHE_SHARDS must be set to use %s'
+                                % self.__class__.__name__)
+        self.shards = {}
+        for name, overrides in shards.items():
+            self.shards[name] = self._create_shard(settings, name, overrides or {})
+        self.vnodes = settings.getint('HTTPCACHE_SHARD_VNODES', 160)
+        self.ring = HashRing(sorted(self.shards), vnodes=self.vnodes)
+        self.previous = {}  # spider -> rings of previous runs, latest first
+
+    @property
+    def threaded_writes(self):
+        return all(storage.threaded_writes for storage in self.shards.values())
+
+    def open_spider(self, spider, readonly=False):
+        super(ShardedCacheStorage, self).open_spider(spider, readonly)
+        for storage in self.shards.values():
+            storage.open_spider(spider, readonly)
+        current = sorted(self.shards)
+        stored = self._read_history().get(spider.name, [])
+        history = [current] + [names for names in stored if names != current]
+        self.previous[spider] = self._rings(history[1:])
+        if not readonly and self.previous[spider] and self._migrated(spider):
+            history, self.previous[spider] = [current], []
+        if not readonly and history != stored:
+            self._write_history(spider, history)
+
+    def close_spider(self, spider):
+        for storage in self.shards.values():
+            storage.close_spider(spider)
+        del self.previous[spider]
+        super(ShardedCacheStorage, self).close_spider(spider)
+
+    def retrieve_response(self, spider, request):
+        for shard in self._shards(spider, self._request_key(request)):
+            response = shard.retrieve_response(spider, request)
+            if response is not None:
+                return response
+
+    def retrieve_entry(self, spider, key, request=None):
+        for shard in self._shards(spider, key):
+            response = shard.retrieve_entry(spider, key, request)
+            if response is not None:
+                return response
+
+    def retrieve_metadata(self, spider, key):
+        for shard in self._shards(spider, key):
+            response = shard.retrieve_metadata(spider, key)
+            if response is not None:
+                return response
+
+    def store_response(self, spider, request, response, metadata=None):
+        key = self._request_key(request)
+        self._shard(key).store_response(spider, request, response, metadata)
+        self._delete_previous(spider, key)
+
+    def update_metadata(self, spider, request, response, metadata=None):
+        key = self._request_key(request)
+        shard = self._shard(key)
+        if shard.has_entry(spider, key) or not self._delete_previous(spider, key):
+            shard.update_metadata(spider, request, response, metadata)
+        else:
+            # moved to its shard, with the body of the response
+            shard.store_response(spider, request, response, metadata)
+
+    def iter_entries(self, spider):
+        for name in sorted(self.shards):
+            for entry in self.shards[name].iter_entries(spider):
+                yield entry
+
+    def delete_response(self, spider, key):
+        self._shard(key).delete_response(spider, key)
+        self._delete_previous(spider, key)
+
+    def has_entry(self, spider, key):
+        return any(shard.has_entry(spider, key) for shard in self._shards(spider, key))
+
+    def exists(self, spider):
+        return any(storage.exists(spider) for storage in self.shards.values())
+
+    def _shard(self, key):
+        return self.shards[self.ring.get(key)]
+
+    def _shards(self, spider, key):
+        # the shard of the key, then those which owned it before
+        names = [self.ring.get(key)]
+        for ring in self.previous.get(spider, ()):
+            name = ring.get(key)
+            if name not in names:
+                names.append(name)
+        return [self.shards[name] for name in names]
+
+    def _delete_previous(self, spider, key):
+        """Delete the response from the shards which owned the key before,
+        and return whether any had it."""
+        found = False
+        for shard in self._shards(spider, key)[1:]:
+            if shard.has_entry(spider, key):
+                shard.delete_response(spider, key)
+                found = True
+        return found
+
+    def _rings(self, history):
+        rings = [HashRing([name for name in names if name in self.shards], self.vnodes)
+                 for names in history]
+        return [ring for ring in rings if len(ring)]
+
+    def _migrated(self, spider):
+        # stops at the first response left out of its shard
+        return all(self.ring.get(key) == name
+                   for name in sorted(self.shards)
+                   for key, _ in self.shards[name].iter_entries(spider))
+
+    def _read_history(self):
+        try:
+            with open(os.path.join(self.cachedir, 'shards.json')) as f:
+                history = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        return history if isinstance(history, dict) else {}
+
+    def _write_history(self, spider, history):
+        # read again, as other processes may have written it meanwhile
+        histories = self._read_history()
+        histories[spider.name] = history
+        path = os.path.join(self.cachedir, 'shards.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(histories, f)
+        os.rename(path + '.tmp', path)
+
+    def _create_shard(self, settings, name, overrides):
+        shardsettings = settings.copy()
+        shardsettings.set('HTTPCACHE_DIR', os.path.join(self.cachedir, name),
+                          priority='cmdline')
+        shardsettings.set('HTTPCACHE_STORAGE', settings.get(
+            'HTTPCACHE_SHARD_STORAGE', 'scrapy_httpcache.storage.FilesystemCacheStorage'),
+            priority='cmdline')
+        for setting, value in overrides.items():
+            shardsettings.set(setting, value, priority='cmdline')
+        storagecls = load_object(shardsettings['HTTPCACHE_STORAGE'])
+        if issubclass(storagecls, ShardedCacheStorage):
+            raise NotConfigured('Shards cannot be sharded storages')
+        return storagecls(shardsettings)
@@ -5,117 +5,325 @@ import time
 from six.moves import cPickle as pickle
 from importlib import import_module
 from datetime import datetime
-from scrapy.http import Headers
-from scrapy.responsetypes import responsetypes
+from six.moves.urllib.request import pathname2url
+from scrapy.utils.python import to_unicode
 
-from .base import CacheStorage
+from .base import CacheStorage, handles, key_range, build_response, response_hints
 
 
 CREATE_QUERY = """CREATE TABLE httpcache (
                        request_fingerprint TEXT PRIMARY KEY,
                        timestamp TIMESTAMP,
-                       data BLOB
+                       data BLOB,
+                       expires REAL,
+                       body BLOB,
+                       seq INTEGER
                    )
                """
+CREATE_EXPIRES_INDEX_QUERY = """CREATE INDEX IF NOT EXISTS httpcache_expires
+                                    ON httpcache (expires)
+                             """
+CREATE_SEQ_INDEX_QUERY = """CREATE INDEX IF NOT EXISTS httpcache_seq
+                                ON httpcache (seq)
+                         """
+ADD_EXPIRES_QUERY = """ALTER TABLE httpcache ADD COLUMN expires REAL"""
+ADD_BODY_QUERY = """ALTER TABLE httpcache ADD COLUMN body BLOB"""
+# rows stored before are numbered in the order they were inserted
+ADD_SEQ_QUERY = """ALTER TABLE httpcache ADD COLUMN seq INTEGER"""
+SET_SEQ_QUERY = """UPDATE httpcache SET seq=rowid WHERE seq IS NULL"""
+# the order rows were first written in, kept by updates
+NEXT_SEQ = """(SELECT IFNULL(MAX(seq), 0) + 1 FROM httpcache)"""
 SELECT_QUERY = """SELECT request_fingerprint,
                          timestamp as "timestamp [timestamp]",
-                         data
+                         data,
+                         body
                   FROM httpcache
                       WHERE request_fingerprint=:request_fingerprint
                """
-UPSERT_QUERY = """INSERT INTO httpcache (request_fingerprint, timestamp, data)
-                      VALUES (:request_fingerprint, :timestamp, :data)
-                  ON CONFLICT(request_fingerprint)
-                      DO UPDATE SET timestamp=:timestamp, data=:data
-               """
-INSERT_QUERY = """INSERT INTO httpcache (request_fingerprint, timestamp, data)
-                      VALUES (:request_fingerprint, :timestamp, :data)
+SELECT_METADATA_QUERY = """SELECT request_fingerprint,
+                                  timestamp as "timestamp [timestamp]",
+                                  data
+                           FROM httpcache
+                               WHERE request_fingerprint=:request_fingerprint
+                        """
+EXISTS_QUERY = """SELECT 1 FROM httpcache
+                      WHERE request_fingerprint=:request_fingerprint
                """
+SELECT_DATA_QUERY = """SELECT data FROM httpcache
+                           WHERE request_fingerprint=:request_fingerprint
+                    """
+UPSERT_QUERY = """INSERT INTO httpcache (request_fingerprint, timestamp, data, expires, body, seq)
+                      VALUES (:request_fingerprint, :timestamp, :data, :expires, :body, %s)
+                  ON CONFLICT(request_fingerprint)
+                      DO UPDATE SET timestamp=:timestamp, data=:data, expires=:expires, body=:body
+               """ % NEXT_SEQ
+INSERT_QUERY = """INSERT INTO httpcache (request_fingerprint, timestamp, data, expires, body, seq)
+                      VALUES (:request_fingerprint, :timestamp, :data, :expires, :body, %s)
+               """ % NEXT_SEQ
 UPDATE_QUERY = """UPDATE httpcache
-                      SET timestamp=:timestamp, data=:data
+                      SET timestamp=:timestamp, data=:data, expires=:expires, body=:body
                       WHERE request_fingerprint=:request_fingerprint
                """
+# rows stored before bodies were kept apart get their body moved
+UPDATE_METADATA_QUERY = """UPDATE httpcache
+                               SET timestamp=:timestamp, data=:data, expires=:expires,
+                                   body=COALESCE(body, :body)
+                               WHERE request_fingerprint=:request_fingerprint
+                        """
+ENTRIES_QUERY = """SELECT request_fingerprint, data, length(body) AS size
+                     FROM httpcache
+                         WHERE request_fingerprint > :after AND request_fingerprint < :before
+                     ORDER BY request_fingerprint
+                     LIMIT :limit
+                """
+# tables not upgraded yet (when opened readonly) are in rowid order
+STORED_QUERY = """SELECT request_fingerprint, data, length(body) AS size, %(seq)s AS seq
+                    FROM httpcache
+                        WHERE %(seq)s > :after
+                    ORDER BY %(seq)s
+                    LIMIT :limit
+               """
 DELETE_QUERY = """DELETE FROM httpcache
                       WHERE request_fingerprint=:request_fingerprint
                """
+# compaction copies rows to a new table in the order they were first stored
+RENAME_OLD_QUERY = """ALTER TABLE httpcache RENAME TO httpcache_old"""
+COPY_ORDERED_QUERY = """INSERT INTO httpcache (request_fingerprint, timestamp, data, expires,
+                                               body, seq)
+                            SELECT request_fingerprint, timestamp, data, expires, body, seq
+                                FROM httpcache_old
+                            ORDER BY seq
+                     """
+DROP_OLD_QUERY = """DROP TABLE httpcache_old"""
 
 
 class SqliteCacheStorage(CacheStorage):
     """ Cache Storage backend for storing data in SQLite3 databases.
     """
 
+    parallel_scan = True
+    ordered_scan = True
+
     def __init__(self, settings):
         super(SqliteCacheStorage, self).__init__(settings)
         self.dbmodule = import_module('sqlite3')
-        self.db = None
-
-    def open_spider(self, spider):
-        super(SqliteCacheStorage, self).open_spider(spider)
-        create = False
-        dbpath = os.path.join(self.cachedir, '%s.db' % spider.name)
-        if not os.path.isfile(dbpath):
-            create = True
-        self.db = self.dbmodule.connect(dbpath, detect_types=self.dbmodule.PARSE_DECLTYPES|self.dbmodule.PARSE_COLNAMES)
-        self.db.text_factory = bytes
-        self.db.row_factory = self.dbmodule.Row
-        if create:
-            with self.db:
-                self.db.execute(CREATE_QUERY)
+        self.dbs = {}
+
+    def open_spider(self, spider, readonly=False):
+        super(SqliteCacheStorage, self).open_spider(spider, readonly)
+        self.dbs[spider] = handles.acquire(self._db_path(spider),
+                                           lambda path: self._connect(path, readonly),
+                                           readonly)
 
     def close_spider(self, spider):
-        self.db.close()
+        del self.dbs[spider]
+        handles.release(self._db_path(spider), lambda db: db.close())
         super(SqliteCacheStorage, self).close_spider(spider)
 
-    def retrieve_response(self, spider, request):
-        data = self._read_data(spider, request)
-        if data is None:
-            return  # not cached
-        url = data['url']
-        status = data['status']
-        headers = Headers(data['headers'])
-        body = data['body']
-        respcls = responsetypes.from_args(headers=headers, url=url)
-        response = respcls(url=url, headers=headers, status=status, body=body)
-        return response
+    def retrieve_entry(self, spider, key, request=None):
+        return self._build_response(self._read_data(spider, key, request))
+
+    def retrieve_metadata(self, spider, key):
+        return self._build_response(self._read_data(spider, key, body=False))
+
+    def store_response(self, spider, request, response, metadata=None):
+        blob = self._store_blob(spider, self._request_key(request), response.body)
+        self._store_data(spider, self._get_dbdata(request, response, metadata, blob))
+
+    def update_metadata(self, spider, request, response, metadata=None):
+        blob = self._stored_blob(spider, self._request_key(request))
+        dbdata = self._get_dbdata(request, response, metadata, blob)
+        db = self.dbs[spider]
+        with db:
+            cursor = db.execute(UPDATE_METADATA_QUERY, dbdata)
+        if not cursor.rowcount:
+            self.store_response(spider, request, response, metadata)
+
+    def iter_entries(self, spider, chunksize=100):
+        return self._iter_range(spider, '', None, chunksize)
+
+    def iter_partition(self, spider, partition, partitions):
+        # ranges of the primary key, which is indexed
+        lo, hi = key_range(partition, partitions)
+        return self._iter_range(spider, lo, hi)
+
+    def iter_stored(self, spider, chunksize=100):
+        db = self.dbs[spider]
+        query = STORED_QUERY % {'seq': 'seq' if 'seq' in self._columns(db) else 'rowid'}
+        params = {'after': 0, 'limit': chunksize}
+        while True:
+            rows = db.execute(query, params).fetchall()
+            for row in rows:
+                params['after'] = row['seq']
+                yield to_unicode(row['request_fingerprint']), self._row_size(row)
+            if len(rows) < chunksize:
+                return
+
+    def has_entry(self, spider, key):
+        cursor = self.dbs[spider].execute(EXISTS_QUERY, {'request_fingerprint': key})
+        return cursor.fetchone() is not None
 
-    def store_response(self, spider, request, response):
-        key = self._request_key(request)
+    def exists(self, spider):
+        return os.path.isfile(self._db_path(spider))
+
+    def delete_response(self, spider, key):
+        db = self.dbs[spider]
+        with db:
+            db.execute(DELETE_QUERY, {'request_fingerprint': key})
+        self._remove_blob(spider, key)
+
+    def compact(self, spider):
+        """Rewrite the database of the spider with its responses in the
+        order they were first stored, and return the number of bytes
+        reclaimed."""
+        db = self.dbs[spider]
+        dbpath = self._db_path(spider)
+        size = os.path.getsize(dbpath)
+        with db:
+            # the sqlite3 module would not begin a transaction before the
+            # schema changes, the table is swapped at once or not at all
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(RENAME_OLD_QUERY)
+            db.execute(CREATE_QUERY)
+            db.execute(COPY_ORDERED_QUERY)
+            db.execute(DROP_OLD_QUERY)
+            db.execute(CREATE_EXPIRES_INDEX_QUERY)
+            db.execute(CREATE_SEQ_INDEX_QUERY)
+        db.execute('VACUUM')  # lays the pages out in row order
+        return size - os.path.getsize(dbpath)
+
+    def _stored_blob(self, spider, key):
+        # as flagged when stored, without blobs none are used (bodies of
+        # rows stored in blob files are then stored in the row again)
+        if self.blob_threshold <= 0:
+            return False
+        for row in self.dbs[spider].execute(SELECT_DATA_QUERY, {'request_fingerprint': key}):
+            return pickle.loads(row['data']).get('blob', False)
+        return False
+
+    def _get_dbdata(self, request, response, metadata, blob=False):
         data = {
             'status': response.status,
             'url': response.url,
             'headers': dict(response.headers),
-            'body': response.body,
+            'hints': response_hints(response),
+            'cache_metadata': self._cache_metadata(response, metadata),
+            'blob': blob,
+            'size': len(response.body),
         }
-
-        dbdata = {
-            'request_fingerprint': key,
+        return {
+            'request_fingerprint': self._request_key(request),
             'timestamp': datetime.now(),
             'data': pickle.dumps(data, protocol=2),
+            # indexed, to find entries gone stale without loading them
+            'expires': (metadata or {}).get('expires'),
+            'body': None if blob else self.dbmodule.Binary(response.body),
         }
-        self._store_data(dbdata)
 
-    def _store_data(self, dbdata):
+    def _db_path(self, spider):
+        return os.path.join(self.cachedir, '%s.db' % spider.name)
+
+    def _connect(self, dbpath, readonly=False):
+        create = not os.path.isfile(dbpath)
+        detect_types = self.dbmodule.PARSE_DECLTYPES|self.dbmodule.PARSE_COLNAMES
+        if readonly:
+            db = self.dbmodule.connect('file:%s?mode=ro' % pathname2url(dbpath),
+                                       detect_types=detect_types, uri=True,
+                                       check_same_thread=False)
+        else:
+            db = self.dbmodule.connect(dbpath, detect_types=detect_types,
+                                       check_same_thread=False)
+        db.text_factory = bytes
+        db.row_factory = self.dbmodule.Row
+        if readonly:
+            return db
+        with db:
+            if create:
+                db.execute(CREATE_QUERY)
+            else:
+                columns = self._columns(db)
+                if 'expires' not in columns:
+                    # upgrade tables created before policy metadata was stored
+                    db.execute(ADD_EXPIRES_QUERY)
+                if 'body' not in columns:
+                    # upgrade tables created before bodies were kept apart
+                    db.execute(ADD_BODY_QUERY)
+                if 'seq' not in columns:
+                    # upgrade tables created before compaction kept write order
+                    db.execute(ADD_SEQ_QUERY)
+                    db.execute(SET_SEQ_QUERY)
+            db.execute(CREATE_EXPIRES_INDEX_QUERY)
+            db.execute(CREATE_SEQ_INDEX_QUERY)
+        return db
+
+    def _store_data(self, spider, dbdata):
+        db = self.dbs[spider]
         if self.dbmodule.sqlite_version_info >= (3, 24, 0):  # upsert available
-            with self.db:
-                self.db.execute(UPSERT_QUERY, dbdata)
+            with db:
+                db.execute(UPSERT_QUERY, dbdata)
         else:
             try:
-                with self.db:
-                    self.db.execute(INSERT_QUERY, dbdata)
+                with db:
+                    db.execute(INSERT_QUERY, dbdata)
             except self.dbmodule.IntegrityError:  # assume the error is an existing entry
-                with self.db:
-                    self.db.execute(UPDATE_QUERY, dbdata)
+                with db:
+                    db.execute(UPDATE_QUERY, dbdata)
 
-    def _read_data(self, spider, request):
-        key = self._request_key(request)
-        for row in self.db.execute(SELECT_QUERY, {'request_fingerprint': key}):
-            #ts = row["timestamp"].timestamp()  # Python3 only, Py2 compat. below:
-            ts = time.mktime(row["timestamp"].timetuple()) + row["timestamp"].microsecond/1000000.0
-            if self._is_expired(ts):
-                # cleanup is not currently performed by any backend
-                # and potentially unwelcome (e.g. for dummy policy cache replays)
-                #self.db.execute(DELETE_QUERY, {'request_fingerprint': key})
+    def _iter_range(self, spider, after, before, chunksize=100):
+        # in chunks, as commits in between would reset an open cursor
+        db = self.dbs[spider]
+        params = {'before': before or '~', 'limit': chunksize}  # '~' sorts after hex digits
+        while True:
+            params['after'] = after
+            rows = db.execute(ENTRIES_QUERY, params).fetchall()
+            for row in rows:
+                after = to_unicode(row['request_fingerprint'])
+                yield after, self._row_size(row)
+            if len(rows) < chunksize:
                 return
 
-            return pickle.loads(row['data'])
+    def _row_size(self, row):
+        data = pickle.loads(row['data'])
+        if 'size' in data:
+            return data['size']
+        elif 'body' in data:
+            return len(data['body'])
+        return row['size'] or 0
+
+    def _columns(self, db):
+        # text_factory is bytes, decode column names
+        return [to_unicode(row['name']) for row in db.execute('PRAGMA table_info(httpcache)')]
+
+    def _build_response(self, data):
+        if data is None:
+            return  # not cached
+        response = build_response(data['url'], data['status'], data['headers'],
+                                  data['body'], data.get('hints'))
+        response.cache_metadata = data.get('cache_metadata', {})
+        response.cache_timestamp = data['timestamp']
+        if data.get('expired'):
+            response.flags.append('expired')
+        return response
+
+    def _read_data(self, spider, key, request=None, body=True):
+        query = SELECT_QUERY if body else SELECT_METADATA_QUERY
+        for row in self.dbs[spider].execute(query, {'request_fingerprint': key}):
+            #ts = row["timestamp"].timestamp()  # Python3 only, Py2 compat. below:
+            ts = time.mktime(row["timestamp"].timetuple()) + row["timestamp"].microsecond/1000000.0
+            data = pickle.loads(row['data'])
+            if not body:
+                data['body'] = b''  # not read
+            elif data.get('blob'):
+                data['body'] = self._read_blob(spider, key)
+                if data['body'] is None:
+                    return  # invalid entry
+            elif 'body' not in data:
+                data['body'] = row['body']
+            # expired entries are kept for revalidation, cleanup is not
+            # currently performed by any backend and potentially unwelcome
+            # (e.g. for dummy policy cache replays)
+            #self.dbs[spider].execute(DELETE_QUERY, {'request_fingerprint': key})
+            data['timestamp'] = ts
+            data['expired'] = self._is_expired(ts, request=request)
+            return data
         return  # not found (implicit)
@@ -0,0 +1,492 @@
+""" WARC Cache Storage
+
+A Cache Storage backend appending responses to WARC files, which other web
+archive tools can read, indexed by request fingerprint.
+"""
+import os
+import re
+import gzip
+import shutil
+import zlib
+import uuid
+import calendar
+from time import time, gmtime, strftime, strptime
+
+from six.moves import http_client
+from w3lib.http import headers_raw_to_dict, headers_dict_to_raw
+from scrapy.http import Request
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.python import to_bytes, to_unicode
+
+from .base import CacheStorage, handles, build_response, response_hints
+from ..serialization import dumps, loads
+
+
+# a WARC header holding the cache metadata and response hints, as JSON
+CACHE_HEADER = b'WARC-Scrapy-Cache'
+
+
+class WarcArchive(object):
+    """ The WARC files of a spider, with their index.
+
+    Every stored response is appended to the current WARC file as a
+    ``response`` record followed by its ``request`` record, each compressed
+    as a separate gzip member. The file is rotated once larger than
+    ``max_size`` bytes.
+
+    The index (``index.cdx``) has a line for every stored response, with
+    its fingerprint, the time it was stored and the file, offset and length
+    of its response record, so that reading it takes one seek and one
+    decompression. Deletions are recorded as ``<fingerprint> -`` lines.
+
+    ``compact()`` rewrites the files with the responses in the order they
+    were first stored (that of their first index line, kept by updates),
+    for replays to read them sequentially.
+    """
+
+    INDEX_HEADER = b' CDX fingerprint timestamp filename offset length size\n'
+
+    def __init__(self, path, prefix, max_size=1024 ** 3, readonly=False):
+        self.path = path
+        self.prefix = prefix
+        self.max_size = max_size
+        self.readonly = readonly
+        self._open()
+
+    def _open(self):
+        path, prefix = self.path, self.prefix
+        if not os.path.exists(path) and not self.readonly:
+            os.makedirs(path)
+        self.index = {}  # fingerprint -> (timestamp, filename, offset, length, size)
+        self.sequence = {}  # fingerprint -> order of its first write
+        self._seq = 0
+        indexpath = os.path.join(path, 'index.cdx')
+        if os.path.exists(indexpath):
+            with open(indexpath, 'rb') as f:
+                for line in f:
+                    self._load_line(line)
+        self._readers = {}
+        self.file = self.indexfile = None
+        if self.readonly:
+            return
+        self.indexfile = open(indexpath, 'ab')
+        if self.indexfile.tell() == 0:
+            self.indexfile.write(self.INDEX_HEADER)
+        serials = [int(name[len(prefix) + 1:-len('.warc.gz')]) for name in os.listdir(path)
+                   if re.match(r'%s-\d+\.warc\.gz$' % re.escape(prefix), name)]
+        self._open_file(max(serials) if serials else 0)
+
+    def append(self, key, records, timestamp, size):
+        """Append the records (the response record first) and index them
+        under the key."""
+        self._append_members(key, [_compress(record) for record in records], timestamp, size)
+
+    def compact(self):
+        """Rewrite the files with the indexed responses (and their request
+        records) only, in the order they were first stored, and return the
+        number of bytes reclaimed."""
+        tmppath = self.path + '.compact'
+        if os.path.exists(tmppath):
+            shutil.rmtree(tmppath)  # left by an interrupted compaction
+        compacted = WarcArchive(tmppath, self.prefix, self.max_size)
+        for key in sorted(self.index, key=self.sequence.get):
+            timestamp, filename, offset, length, size = self.index[key]
+            compacted._append_members(key, self._read_members(filename, offset, length),
+                                      timestamp, size)
+        compacted.close()
+        self.close()
+        size = _tree_size(self.path)
+        oldpath = self.path + '.old'
+        os.rename(self.path, oldpath)
+        os.rename(tmppath, self.path)
+        shutil.rmtree(oldpath)
+        self._open()
+        return size - _tree_size(self.path)
+
+    def read(self, key):
+        """Return the response record indexed under the key and its index
+        entry, or None."""
+        entry = self.index.get(key)
+        if entry is None:
+            return
+        _, filename, offset, length, _ = entry
+        f = self._readers.get(filename)
+        if f is None:
+            f = self._readers[filename] = open(os.path.join(self.path, filename), 'rb')
+        f.seek(offset)
+        return zlib.decompress(f.read(length), 16 + zlib.MAX_WBITS), entry
+
+    def delete(self, key):
+        if key in self.index:
+            self._index(key, None)
+
+    def close(self):
+        if not self.readonly:
+            self.file.close()
+            self.indexfile.close()
+        for f in self._readers.values():
+            f.close()
+        self._readers = {}
+
+    def _append_members(self, key, members, timestamp, size):
+        # every file holds one response at least
+        if self.file.tell() > max(self.max_size, self._first_offset):
+            self._open_file(self.serial + 1)
+        offset = self.file.tell()
+        self.file.write(b''.join(members))
+        self.file.flush()
+        self._index(key, (timestamp, self.filename, offset, len(members[0]), size))
+
+    def _read_members(self, filename, offset, length):
+        # the compressed response record, and the request record following
+        # it if it is its own
+        with open(os.path.join(self.path, filename), 'rb') as f:
+            f.seek(offset)
+            members = [f.read(length)]
+            responseid = parse_warc_record(
+                zlib.decompress(members[0], 16 + zlib.MAX_WBITS))[0].get(b'WARC-Record-ID')
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data, record = b'', b''
+            while not decompressor.eof:
+                chunk = f.read(65536)
+                if not chunk:
+                    return members
+                data += chunk
+                record += decompressor.decompress(chunk)
+        headers, _ = parse_warc_record(record)
+        if headers.get(b'WARC-Type') == b'request' and responseid and \
+                headers.get(b'WARC-Concurrent-To') == responseid:
+            members.append(data[:len(data) - len(decompressor.unused_data)])
+        return members
+
+    def _open_file(self, serial):
+        if self.file is not None:
+            self.file.close()
+        self.serial = serial
+        self.filename = '%s-%05d.warc.gz' % (self.prefix, serial)
+        self.file = open(os.path.join(self.path, self.filename), 'ab')
+        self._first_offset = 0
+        if self.file.tell() == 0:
+            fields = b'software: scrapy-httpcache\r\nformat: WARC File Format 1.0\r\n'
+            self.file.write(_compress(warc_record(b'warcinfo', fields, [
+                (b'WARC-Filename', to_bytes(self.filename)),
+                (b'Content-Type', b'application/warc-fields'),
+            ])))
+            self._first_offset = self.file.tell()
+
+    def _index(self, key, entry):
+        if entry is None:
+            line = '%s -\n' % key
+            self._remove(key)
+        else:
+            line = '%s %r %s %d %d %d\n' % ((key,) + entry)
+            self._add(key, entry)
+        self.indexfile.write(to_bytes(line))
+        self.indexfile.flush()
+
+    def _load_line(self, line):
+        fields = to_unicode(line).split()
+        if len(fields) == 2 and fields[1] == '-':
+            self._remove(fields[0])
+        elif len(fields) == 6:
+            try:
+                self._add(fields[0], (float(fields[1]), fields[2], int(fields[3]),
+                                      int(fields[4]), int(fields[5])))
+            except ValueError:
+                pass  # torn by a crash
+
+    def _add(self, key, entry):
+        if key not in self.index:
+            self._seq += 1
+            self.sequence[key] = self._seq
+        self.index[key] = entry
+
+    def _remove(self, key):
+        self.index.pop(key, None)
+        self.sequence.pop(key, None)
+
+
+class WarcCacheStorage(CacheStorage):
+    """ Cache Storage backend storing responses in rotating WARC files
+    (``<spider>-NNNNN.warc.gz``, in the ``<spider>.warc`` directory of the
+    cache), which are only ever appended to. Updated responses are appended
+    again, and deleted ones only removed from the index.
+
+    WARC files written by other tools can be imported with
+    ``import_warc()``.
+    """
+
+    ordered_scan = True
+
+    def __init__(self, settings):
+        super(WarcCacheStorage, self).__init__(settings)
+        self.max_size = settings.getint('HTTPCACHE_WARC_MAX_SIZE', 1024 ** 3)
+        self.archives = {}
+
+    def open_spider(self, spider, readonly=False):
+        super(WarcCacheStorage, self).open_spider(spider, readonly)
+        self.archives[spider] = handles.acquire(
+            self._archive_path(spider),
+            lambda path: WarcArchive(path, spider.name, self.max_size, readonly), readonly)
+
+    def close_spider(self, spider):
+        del self.archives[spider]
+        handles.release(self._archive_path(spider), lambda archive: archive.close())
+        super(WarcCacheStorage, self).close_spider(spider)
+
+    def retrieve_entry(self, spider, key, request=None):
+        found = self.archives[spider].read(key)
+        if found is None:
+            return  # not cached
+        record, (timestamp, _, _, _, _) = found
+        warcheaders, block = parse_warc_record(record)
+        cache = loads(warcheaders.get(CACHE_HEADER, b'{}'))
+        status, headers, body = parse_http_response(block)
+        response = build_response(to_unicode(warcheaders[b'WARC-Target-URI']), status,
+                                  headers, body, cache.get('hints'))
+        response.cache_metadata = cache.get('cache_metadata', {})
+        response.cache_timestamp = timestamp
+        if self._is_expired(timestamp, request=request):
+            response.flags.append('expired')
+        return response
+
+    def store_response(self, spider, request, response, metadata=None):
+        self._append(spider, self._request_key(request), request, response,
+                     self._cache_metadata(response, metadata))
+
+    def update_metadata(self, spider, request, response, metadata=None):
+        self.store_response(spider, request, response, metadata)
+
+    def iter_entries(self, spider):
+        for key, entry in list(self.archives[spider].index.items()):
+            yield key, entry[4]
+
+    def iter_stored(self, spider):
+        archive = self.archives[spider]
+        entries = sorted(archive.index.items(), key=lambda item: archive.sequence[item[0]])
+        for key, entry in entries:
+            yield key, entry[4]
+
+    def delete_response(self, spider, key):
+        self.archives[spider].delete(key)
+
+    def has_entry(self, spider, key):
+        return key in self.archives[spider].index
+
+    def exists(self, spider):
+        return os.path.isdir(self._archive_path(spider))
+
+    def compact(self, spider):
+        """Rewrite the WARC files of the spider without the records of
+        updated and deleted responses, in the order responses were stored,
+        and return the number of bytes reclaimed."""
+        return self.archives[spider].compact()
+
+    def copy_entry(self, spider, key, response):
+        """Store a response retrieved from another storage (without its
+        request) under its key, keeping its metadata and storage time."""
+        self._append(spider, key, None, response, response.cache_metadata,
+                     response.cache_timestamp)
+
+    def import_warc(self, spider, path):
+        """Store the responses of a WARC file (compressed or not), keyed by
+        the fingerprint of their request record, or of a GET request of
+        their URL, and return how many were imported."""
+        imported = 0
+        # records are paired by the WARC-Concurrent-To header of either, and
+        # wait for the other under both their ids
+        requests = {}
+        responses = {}
+        for warcheaders, block in iter_warc_records(path):
+            rtype = warcheaders.get(b'WARC-Type')
+            ids = [i for i in (warcheaders.get(b'WARC-Record-ID'),
+                               warcheaders.get(b'WARC-Concurrent-To')) if i]
+            if rtype == b'request':
+                request = _parse_http_request(warcheaders, block)
+                response = _pop_record(responses, ids)
+                if response is not None:
+                    imported += self._import(spider, request, *response)
+                else:
+                    requests.update((i, request) for i in ids)
+            elif rtype == b'response' and block.startswith(b'HTTP/'):
+                request = _pop_record(requests, ids)
+                if request is not None or not ids:
+                    imported += self._import(spider, request, warcheaders, block)
+                else:
+                    responses.update((i, (warcheaders, block)) for i in ids)
+        # responses without request records
+        for response in dict((id(r), r) for r in responses.values()).values():
+            imported += self._import(spider, None, *response)
+        return imported
+
+    def _import(self, spider, request, warcheaders, block):
+        try:
+            status, headers, body = parse_http_response(block)
+        except ValueError:
+            return 0
+        if request is None:
+            request = Request(to_unicode(warcheaders[b'WARC-Target-URI']))
+        if b'chunked' in b','.join(headers.pop(b'Transfer-Encoding', [])).lower():
+            body = _dechunk(body)
+        response = build_response(to_unicode(warcheaders[b'WARC-Target-URI']), status,
+                                  headers, body)
+        timestamp = _parse_warc_date(warcheaders.get(b'WARC-Date'))
+        self._append(spider, self._request_key(request), request, response,
+                     self._cache_metadata(response, None), timestamp)
+        return 1
+
+    def _append(self, spider, key, request, response, metadata, timestamp=None):
+        if timestamp is None:
+            timestamp = time()
+        responseid = _record_id()
+        cache = dumps({'cache_metadata': metadata, 'hints': response_hints(response)})
+        records = [warc_record(b'response', _http_response(response), [
+            (b'WARC-Record-ID', responseid),
+            (b'WARC-Target-URI', to_bytes(response.url)),
+            (b'Content-Type', b'application/http; msgtype=response'),
+            (CACHE_HEADER, cache),
+        ], timestamp)]
+        if request is not None:
+            records.append(warc_record(b'request', _http_request(request), [
+                (b'WARC-Record-ID', _record_id()),
+                (b'WARC-Concurrent-To', responseid),
+                (b'WARC-Target-URI', to_bytes(request.url)),
+                (b'Content-Type', b'application/http; msgtype=request'),
+            ], timestamp))
+        self.archives[spider].append(key, records, timestamp, len(response.body))
+
+    def _archive_path(self, spider):
+        return os.path.join(self.cachedir, '%s.warc' % spider.name)
+
+
+def warc_record(rtype, block, headers, timestamp=None):
+    """Return a WARC record of the given type, block and extra headers."""
+    head = [
+        b'WARC/1.0',
+        b'WARC-Type: ' + rtype,
+        b'WARC-Date: ' + to_bytes(strftime('%Y-%m-%dT%H:%M:%SZ',
+                                           gmtime(time() if timestamp is None else timestamp))),
+    ]
+    head.extend(name + b': ' + value for name, value in headers)
+    head.append(b'Content-Length: ' + to_bytes(str(len(block))))
+    return b'\r\n'.join(head) + b'\r\n\r\n' + block + b'\r\n\r\n'
+
+
+def parse_warc_record(record):
+    """Return the headers (a dict) and block of a WARC record."""
+    head, _, rest = record.partition(b'\r\n\r\n')
+    headers = _parse_warc_headers(head.split(b'\r\n')[1:])
+    return headers, rest[:int(headers.get(b'Content-Length', len(rest)))]
+
+
+def iter_warc_records(path):
+    """Iterate over the headers and block of the records of a WARC file."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            if not line.startswith(b'WARC/'):
+                continue  # blank lines between records
+            lines = []
+            line = f.readline()
+            while line.strip():
+                lines.append(line)
+                line = f.readline()
+            headers = _parse_warc_headers(lines)
+            yield headers, f.read(int(headers.get(b'Content-Length', 0)))
+
+
+def _parse_warc_headers(lines):
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(b':')
+        headers[name.strip()] = value.strip()
+    return headers
+
+
+def _pop_record(records, ids):
+    for i in ids:
+        record = records.get(i)
+        if record is not None:
+            for key in [k for k, r in records.items() if r is record]:
+                del records[key]
+            return record
+
+
+def parse_http_response(block):
+    """Return the status, headers (a dict of lists) and body of an HTTP
+    response."""
+    head, _, body = block.partition(b'\r\n\r\n')
+    statusline, _, rawheaders = head.partition(b'\r\n')
+    try:
+        status = int(statusline.split(None, 2)[1])
+    except (IndexError, ValueError):
+        raise ValueError('Invalid HTTP status line: %r' % statusline)
+    return status, headers_raw_to_dict(rawheaders), body
+
+
+def _parse_http_request(warcheaders, block):
+    head, _, body = block.partition(b'\r\n\r\n')
+    requestline, _, rawheaders = head.partition(b'\r\n')
+    method = to_unicode(requestline.split(None, 1)[0]) if requestline else 'GET'
+    return Request(to_unicode(warcheaders[b'WARC-Target-URI']), method=method,
+                   headers=headers_raw_to_dict(rawheaders), body=body)
+
+
+def _http_response(response):
+    reason = to_bytes(http_client.responses.get(response.status, ''))
+    head = b'HTTP/1.1 ' + to_bytes(str(response.status)) + b' ' + reason
+    rawheaders = headers_dict_to_raw(response.headers)
+    if rawheaders:
+        head += b'\r\n' + rawheaders
+    return head + b'\r\n\r\n' + response.body
+
+
+def _http_request(request):
+    parsed = urlparse_cached(request)
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    head = to_bytes('%s %s HTTP/1.1\r\nHost: %s' % (request.method, path, parsed.netloc))
+    rawheaders = headers_dict_to_raw(request.headers)
+    if rawheaders:
+        head += b'\r\n' + rawheaders
+    return head + b'\r\n\r\n' + request.body
+
+
+def _dechunk(body):
+    chunks = []
+    while body:
+        size, _, body = body.partition(b'\r\n')
+        try:
+            size = int(size.split(b';')[0], 16)
+        except ValueError:
+            break
+        if not size:
+            break
+        chunks.append(body[:size])
+        body = body[size + 2:]
+    return b''.join(chunks)
+
+
+def _parse_warc_date(value):
+    try:
+        return calendar.timegm(strptime(to_unicode(value)[:19], '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _tree_size(path):
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+               for dirpath, _, names in os.walk(path) for name in names)
+
+
+def _record_id():
+    return to_bytes('<urn:uuid:%s>' % uuid.uuid4())
+
+
+def _compress(data):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
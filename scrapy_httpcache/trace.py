@@ -0,0 +1,320 @@
+"""
+Binary traces of the lookups and writes of the HTTP cache, and their offline
+replay against other cache configurations.
+
+A trace starts with ``MAGIC``, followed by records of one byte type and
+fixed-size fields, in little-endian order. Type 0 records name a domain
+(``DOMAIN``, followed by the UTF-8 encoded name); all others are cache
+events (``EVENT``), referring to domains by the id last named.
+"""
+from __future__ import division
+
+import os
+import struct
+from binascii import hexlify, unhexlify
+from collections import namedtuple
+from time import time
+
+from scrapy.http import Request
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import data_path
+from scrapy.utils.python import to_bytes, to_unicode
+from scrapy.utils.request import request_fingerprint
+
+from .admission import FrequencySketch
+from .eviction import EvictingStorage
+from .expiration import ExpirationRules
+
+
+MAGIC = b'HTTPCACHE-TRACE\x01'
+
+# type, domain id, length of the name
+DOMAIN = struct.Struct('<BIH')
+# type, fingerprint, time, domain id, status, body size, latency,
+# freshness lifetime (-1 if unknown), HTTP cacheable
+EVENT = struct.Struct('<B20sdIHIff?')
+
+# lookups, then writes
+HIT, MISS, STALE, REVALIDATE, STORE, UPDATE, REJECT = range(1, 8)
+EVENT_NAMES = {
+    HIT: 'hit',
+    MISS: 'miss',
+    STALE: 'stale',
+    REVALIDATE: 'revalidate',
+    STORE: 'store',
+    UPDATE: 'update',
+    REJECT: 'reject',
+}
+LOOKUPS = (HIT, MISS, STALE, REVALIDATE)
+
+
+TraceEvent = namedtuple('TraceEvent', 'event fingerprint time domain status size '
+                                      'latency lifetime cacheable')
+
+
+class TraceWriter(object):
+    """ Append cache events to a trace file. """
+
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self._domains = {}
+
+    def write(self, event, fingerprint, domain, status=0, size=0, latency=0.0,
+              lifetime=-1.0, cacheable=False, timestamp=None):
+        # ids are numbered by every run appending to the file, which names
+        # its domains again, so that readers map ids as they read them
+        domain = to_bytes(domain)
+        domainid = self._domains.get(domain)
+        if domainid is None:
+            domainid = self._domains[domain] = len(self._domains)
+            self.file.write(DOMAIN.pack(0, domainid, len(domain)) + domain)
+        self.file.write(EVENT.pack(event, unhexlify(fingerprint),
+                                   time() if timestamp is None else timestamp,
+                                   domainid, status, size, latency, lifetime, cacheable))
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(path):
+    """Iterate over the :class:`TraceEvent` of a trace file."""
+    domains = {}
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not an HTTP cache trace: %s' % path)
+        while True:
+            rtype = f.read(1)
+            if not rtype:
+                break
+            if rtype == b'\x00':
+                data = rtype + f.read(DOMAIN.size - 1)
+                if len(data) < DOMAIN.size:
+                    break
+                _, domainid, length = DOMAIN.unpack(data)
+                name = f.read(length)
+                if len(name) < length:
+                    break
+                domains[domainid] = to_unicode(name)
+                continue
+            data = rtype + f.read(EVENT.size - 1)
+            if len(data) < EVENT.size:
+                break  # truncated by a crash
+            event, fp, timestamp, domainid, status, size, latency, lifetime, cacheable = \
+                EVENT.unpack(data)
+            yield TraceEvent(event, to_unicode(hexlify(fp)), timestamp, domains[domainid],
+                             status, size, latency, lifetime, cacheable)
+
+
+class TraceRecorder(object):
+    """ Record the cache events of the middleware in ``<spider>.trace``
+    files of the cache directory, appended to on every run.
+
+    Written responses are recorded with their HTTP freshness lifetime and
+    cacheability (per RFC 2616, whatever the cache policy), for the
+    :class:`CacheSimulator` to replay them under any policy. Those the
+    cache ``policy`` computed are reused if it is an RFC 2616 one.
+    """
+
+    def __init__(self, cachedir, settings, policy=None):
+        from .policy.rfc2616 import RFC2616Policy
+        self.cachedir = cachedir
+        # adapted freshness lifetimes are not the HTTP ones
+        self.shared = isinstance(policy, RFC2616Policy) and \
+            type(policy).get_cache_metadata == RFC2616Policy.get_cache_metadata
+        self.http = policy if self.shared else RFC2616Policy(settings)
+        self.writers = {}
+        self._latency = 0.0
+
+    @classmethod
+    def from_settings(cls, settings, policy=None):
+        return cls(data_path(settings['HTTPCACHE_DIR'], createdir=True), settings, policy)
+
+    def open_spider(self, spider):
+        self.writers[spider] = TraceWriter(trace_path(self.cachedir, spider.name))
+
+    def close_spider(self, spider):
+        writer = self.writers.pop(spider, None)
+        if writer is not None:
+            writer.close()
+
+    def retrieved(self, latency):
+        # the lookup outcome is recorded right after, in the same call
+        self._latency = latency
+
+    def lookup(self, spider, request, event, cachedresponse=None):
+        status = size = 0
+        if cachedresponse is not None:
+            status, size = cachedresponse.status, len(cachedresponse.body)
+        self._write(spider, request, event, status, size, self._latency)
+
+    def written(self, spider, request, event, response, latency=0.0, metadata=None,
+                cacheable=None):
+        if not self.shared or not metadata:
+            metadata = self.http._compute_cache_metadata(response, request, time())
+        if not self.shared or cacheable is None:
+            cacheable = self.http.should_cache_response(response, request)
+        lifetime = 0 if metadata['no_cache'] else \
+            max(0, metadata['freshness_lifetime'] - metadata['age'])
+        self._write(spider, request, event, response.status, len(response.body), latency,
+                    lifetime, cacheable)
+
+    def _write(self, spider, request, event, *args):
+        writer = self.writers.get(spider)
+        if writer is not None:
+            writer.write(event, request_fingerprint(request),
+                         urlparse_cached(request).hostname or '', *args)
+
+
+def trace_path(cachedir, spidername):
+    return os.path.join(cachedir, '%s.trace' % spidername)
+
+
+class SimulationReport(object):
+    """ Outcome of the replay of a trace by a :class:`CacheSimulator`,
+    next to what was recorded. """
+
+    FIELDS = ('lookups', 'hits', 'misses', 'revalidations', 'stores', 'rejected',
+              'evictions', 'downloaded_bytes', 'stored_bytes', 'max_bytes', 'max_entries')
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+        self.recorded_hits = 0
+
+    @property
+    def hit_ratio(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    @property
+    def recorded_hit_ratio(self):
+        return self.recorded_hits / self.lookups if self.lookups else 0.0
+
+    def format(self):
+        lines = ['%-20s %d' % (field.replace('_', ' ').capitalize() + ':', getattr(self, field))
+                 for field in self.FIELDS]
+        lines.append('%-20s %.1f%% (recorded: %.1f%%)' % (
+            'Hit ratio:', 100 * self.hit_ratio, 100 * self.recorded_hit_ratio))
+        return '\n'.join(lines)
+
+
+class CacheSimulator(object):
+    """ Replay the lookups of a trace against a cache configuration:
+
+    * ``policy``: ``'dummy'`` (cached responses are fresh until they
+      expire) or ``'rfc2616'`` (they are fresh for their recorded HTTP
+      freshness lifetime, and only HTTP cacheable responses are stored)
+    * ``expiration``: the :class:`~scrapy_httpcache.expiration.ExpirationRules`
+      of the storage, applied to domains only, as traces have no URLs
+    * ``max_bytes``, ``max_entries`` and ``eviction`` (``'lru'`` or
+      ``'lfu'``), as in :class:`~scrapy_httpcache.eviction.EvictingStorage`
+    * ``frequency`` and ``max_body_size``, as in
+      :class:`~scrapy_httpcache.admission.AdmissionFilter`
+    * ``ignore_http_codes``, not stored by any policy
+
+    Lookups of responses the trace has no write of (because they were never
+    downloaded) are counted as misses that cannot be stored. Expired and
+    stale responses are revalidated, which downloads and stores them again.
+    """
+
+    POLICIES = ('dummy', 'rfc2616')
+
+    def __init__(self, policy='dummy', expiration=None, max_bytes=0, max_entries=0,
+                 eviction='lru', frequency=0, max_body_size=0, sketch_width=65536,
+                 ignore_http_codes=()):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown cache policy: %r' % policy)
+        if eviction not in EvictingStorage.INDEXES:
+            raise ValueError('Unknown eviction policy: %r' % eviction)
+        self.policy = policy
+        self.expiration = expiration or ExpirationRules()
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.eviction = eviction
+        self.frequency = frequency
+        self.max_body_size = max_body_size
+        self.sketch_width = sketch_width
+        self.ignore_http_codes = set(ignore_http_codes)
+
+    @classmethod
+    def from_settings(cls, settings):
+        from .policy.dummy import DummyPolicy
+        policycls = load_object(settings.get('HTTPCACHE_POLICY',
+                                             'scrapy_httpcache.policy.DummyPolicy'))
+        return cls(policy='dummy' if issubclass(policycls, DummyPolicy) else 'rfc2616',
+                   expiration=ExpirationRules.from_settings(settings),
+                   max_bytes=settings.getint('HTTPCACHE_MAX_SIZE', 0),
+                   max_entries=settings.getint('HTTPCACHE_MAX_ENTRIES', 0),
+                   eviction=settings.get('HTTPCACHE_EVICTION_POLICY', 'lru').lower(),
+                   frequency=settings.getint('HTTPCACHE_ADMISSION_FREQUENCY', 0),
+                   max_body_size=settings.getint('HTTPCACHE_ADMISSION_MAX_BODY_SIZE', 0),
+                   sketch_width=settings.getint('HTTPCACHE_ADMISSION_SKETCH_WIDTH', 65536),
+                   ignore_http_codes=[int(x) for x in
+                                      settings.getlist('HTTPCACHE_IGNORE_HTTP_CODES')])
+
+    def run(self, events):
+        """Replay a sequence of :class:`TraceEvent` (iterated twice) and
+        return a :class:`SimulationReport`."""
+        # the last written version of every response
+        responses = {}
+        for e in events:
+            if e.event not in LOOKUPS:
+                responses[e.fingerprint] = e
+
+        report = SimulationReport()
+        index = EvictingStorage.INDEXES[self.eviction]()
+        sketch = FrequencySketch(self.sketch_width) if self.frequency > 1 else None
+        cached = {}  # fingerprint -> (time stored, size, lifetime)
+        size = 0
+        ttls = {}
+        for e in events:
+            if e.event not in LOOKUPS:
+                continue
+            report.lookups += 1
+            if e.event in (HIT, STALE):
+                report.recorded_hits += 1
+            if e.domain not in ttls:
+                ttls[e.domain] = self.expiration.get_expiration_secs(
+                    Request('http://%s/' % e.domain))
+            entry = cached.get(e.fingerprint)
+            if entry is not None:
+                age = e.time - entry[0]
+                ttl = ttls[e.domain]
+                if not 0 < ttl < age and (self.policy == 'dummy' or age < entry[2]):
+                    report.hits += 1
+                    index.touch(e.fingerprint)
+                    continue
+                report.revalidations += 1
+            else:
+                report.misses += 1
+            response = responses.get(e.fingerprint)
+            if response is None:
+                continue
+            report.downloaded_bytes += response.size
+            if entry is not None:
+                # refreshed in place, admitted already
+                cached[e.fingerprint] = (e.time, entry[1], response.lifetime)
+                index.touch(e.fingerprint)
+                continue
+            if response.status in self.ignore_http_codes or \
+                    (self.policy == 'rfc2616' and not response.cacheable):
+                continue
+            if 0 < self.max_body_size < response.size or (
+                    sketch is not None and sketch.add(e.fingerprint) < self.frequency):
+                report.rejected += 1
+                continue
+            report.stores += 1
+            report.stored_bytes += response.size
+            cached[e.fingerprint] = (e.time, response.size, response.lifetime)
+            size += response.size
+            index.touch(e.fingerprint)
+            while 0 < self.max_bytes < size or 0 < self.max_entries < len(cached):
+                victim = index.victim()
+                index.remove(victim)
+                size -= cached.pop(victim)[1]
+                report.evictions += 1
+            report.max_bytes = max(report.max_bytes, size)
+            report.max_entries = max(report.max_entries, len(cached))
+        return report
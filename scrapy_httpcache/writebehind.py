@@ -0,0 +1,214 @@
+"""
+Write-behind queue between the HttpCache middleware and its storage.
+"""
+import sys
+import logging
+import threading
+from collections import OrderedDict
+from time import time
+
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+from scrapy.utils.request import request_fingerprint
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue(object):
+    """ Buffer the writes to a cache storage in memory, and flush them in
+    batches later on, so that responses do not wait for the storage.
+
+    Repeated writes for the same request are coalesced, and lookups for
+    requests with pending writes are answered from the queue. Batches are
+    written every ``interval`` seconds, or right away while the queue holds
+    more than ``max_bytes`` of response bodies; ``wait_for_room()`` lets
+    callers wait for it to drain in that case.
+
+    Batches are written by a dedicated writer thread, one entry at a time,
+    other calls to the storage waiting for the entry being written, unless
+    the storage cannot be written from another thread (``threaded_writes``),
+    in which case they are written from the reactor thread.
+
+    The queue has the same interface as cache storages, and writes all its
+    pending entries for a spider when the spider is closed.
+    """
+
+    def __init__(self, storage, stats, max_bytes=64 * 1024 * 1024, batch_size=100,
+                 interval=1.0, clock=None, threaded=True):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.storage = storage
+        self.stats = stats
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.interval = interval
+        self.clock = clock
+        self.threaded = threaded
+        self.threadpool = None  # started with the first batch
+        self._shutdown = None
+        self.lock = threading.Lock()  # held while calling the storage
+        # (spider, fingerprint) -> [method, request, response, metadata, timestamp]
+        self._pending = OrderedDict()
+        self._writing = OrderedDict()  # the batch being written, still readable
+        self._batch = None  # Deferred of the batch being written
+        self._bytes = 0
+        self._call = None
+        self._waiting = []
+
+    @classmethod
+    def from_settings(cls, storage, settings, stats):
+        return cls(storage, stats,
+                   max_bytes=settings.getint('HTTPCACHE_WRITE_BEHIND_MAX_BYTES', 64 * 1024 * 1024),
+                   batch_size=settings.getint('HTTPCACHE_WRITE_BEHIND_BATCH_SIZE', 100),
+                   interval=settings.getfloat('HTTPCACHE_WRITE_BEHIND_INTERVAL', 1.0),
+                   threaded=getattr(storage, 'threaded_writes', False))
+
+    def __len__(self):
+        return len(self._pending) + len(self._writing)
+
+    @property
+    def full(self):
+        return self._bytes >= self.max_bytes
+
+    def open_spider(self, spider):
+        with self.lock:
+            self.storage.open_spider(spider)
+
+    def close_spider(self, spider):
+        """Write the pending entries of the spider and close its storage,
+        once the batch being written (if any) is. Return a Deferred then."""
+        if self._batch is not None:
+            return self._batch.addBoth(lambda _: self.close_spider(spider))
+        self.flush(spider)
+        if not self._pending:
+            if self._call is not None and self._call.active():
+                self._call.cancel()
+            self._stop()
+        with self.lock:
+            return self.storage.close_spider(spider)
+
+    def retrieve_response(self, spider, request):
+        key = (spider, request_fingerprint(request))
+        entry = self._pending.get(key) or self._writing.get(key)
+        if entry is None:
+            with self.lock:
+                return self.storage.retrieve_response(spider, request)
+        _, _, response, metadata, timestamp = entry
+        self.stats.inc_value('httpcache/writebehind/read', spider=spider)
+        cached = response.replace(flags=[])
+        cached.cache_metadata = self.storage._cache_metadata(response, metadata)
+        cached.cache_timestamp = timestamp
+        return cached
+
+    def store_response(self, spider, request, response, metadata=None):
+        self._enqueue('store_response', spider, request, response, metadata)
+
+    def update_metadata(self, spider, request, response, metadata=None):
+        self._enqueue('update_metadata', spider, request, response, metadata)
+
+    def is_body_unchanged(self, cachedresponse, response):
+        return self.storage.is_body_unchanged(cachedresponse, response)
+
+    def wait_for_room(self):
+        """Return a Deferred firing once the queue is below its size bound,
+        or None if it is not full."""
+        if not self.full:
+            return None
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def flush(self, spider=None, limit=None):
+        """Write pending entries (of the given spider only, if any) to the
+        storage, at most ``limit`` of them if set, from the calling thread."""
+        self._written(self._write(self._pop(spider, limit)))
+
+    def _pop(self, spider=None, limit=None):
+        # entries being written are written again after, not meanwhile
+        keys = [key for key in self._pending if (spider is None or key[0] is spider)
+                and key not in self._writing]
+        return [(key, self._pending.pop(key)) for key in keys[:limit]]
+
+    def _write(self, entries):
+        # from the writer thread, no stats or logging until back in the reactor
+        results = []
+        for key, (method, request, response, metadata, _) in entries:
+            try:
+                with self.lock:
+                    getattr(self.storage, method)(key[0], request, response, metadata)
+            except Exception:
+                results.append((key, request, response, sys.exc_info()))
+            else:
+                results.append((key, request, response, None))
+        return results
+
+    def _written(self, results):
+        for key, request, response, exc_info in results:
+            self._bytes -= len(response.body)
+            if exc_info is not None:
+                logger.error("Error writing %(request)s to the HTTP cache",
+                             {'request': request}, exc_info=exc_info, extra={'spider': key[0]})
+                self.stats.inc_value('httpcache/writebehind/error', spider=key[0])
+            else:
+                self.stats.inc_value('httpcache/writebehind/flushed', spider=key[0])
+        if not self.full:
+            waiting, self._waiting = self._waiting, []
+            for d in waiting:
+                d.callback(None)
+
+    def _enqueue(self, method, spider, request, response, metadata):
+        key = (spider, request_fingerprint(request))
+        previous = self._pending.pop(key, None)
+        if previous is not None:
+            self.stats.inc_value('httpcache/writebehind/coalesced', spider=spider)
+            self._bytes -= len(previous[2].body)
+            if previous[0] == 'store_response':
+                # the body was never written, it still has to be
+                method = 'store_response'
+        self._pending[key] = [method, request, response, metadata, time()]
+        self._bytes += len(response.body)
+        self.stats.max_value('httpcache/writebehind/max_pending', len(self), spider=spider)
+        self._schedule()
+
+    def _schedule(self):
+        if self._batch is not None:
+            return  # scheduled once the batch is written
+        delay = 0 if self.full else self.interval
+        if self._call is not None and self._call.active():
+            if self._call.getTime() <= self.clock.seconds() + delay:
+                return  # already due soon enough
+            self._call.cancel()
+        self._call = self.clock.callLater(delay, self._flush_batch)
+
+    def _flush_batch(self):
+        self._call = None
+        entries = self._pop(limit=self.batch_size)
+        if not self.threaded:
+            self._written(self._write(entries))
+            if self._pending:
+                self._schedule()
+            return
+        if self.threadpool is None:
+            self.threadpool = ThreadPool(1, 1, 'httpcache-writer')
+            self.threadpool.start()
+            self._shutdown = self.clock.addSystemEventTrigger('during', 'shutdown', self._stop)
+        self._writing = OrderedDict(entries)
+        self._batch = threads.deferToThreadPool(self.clock, self.threadpool,
+                                                self._write, entries)
+        self._batch.addCallback(self._batch_written)
+
+    def _stop(self):
+        if self.threadpool is not None:
+            self.threadpool.stop()
+            self.threadpool = None
+            if self._shutdown is not None:
+                self.clock.removeSystemEventTrigger(self._shutdown)
+                self._shutdown = None
+
+    def _batch_written(self, results):
+        self._writing = OrderedDict()
+        self._batch = None
+        self._written(results)
+        if self._pending:
+            self._schedule()
@@ -29,6 +29,12 @@ setup(
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
+    entry_points={
+        'scrapy.commands': [
+            'httpcache = scrapy_httpcache.commands.httpcache:Command',
+            'httpcacheserver = scrapy_httpcache.commands.httpcacheserver:Command',
+        ],
+    },
     install_requires=[
         'Scrapy>=1.0.0',
         'six',
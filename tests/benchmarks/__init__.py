@@ -0,0 +1,385 @@
+"""
+Synthetic benchmarks for HttpCache storage backends and policies.
+
+Every bundled storage backend is exercised with a reproducible mix of
+store, retrieve (hit) and retrieve (miss) operations, and every policy is
+exercised through the middleware with a full request/response cycle.
+Results report throughput and latency percentiles as JSON. The startup
+benchmark times importing the package and loading its components in fresh
+Python processes, as every Scrapy process does.
+
+Run from the source root with::
+
+    python -m tests.benchmarks --output results.json
+
+See ``python -m tests.benchmarks --help`` for the available options.
+"""
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import subprocess
+import tempfile
+import platform
+from timeit import default_timer
+from importlib import import_module
+
+import scrapy
+from scrapy.http import Request, Response
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+from scrapy.utils.misc import load_object
+from scrapy.utils.test import get_crawler
+
+from scrapy_httpcache import HttpCacheMiddleware
+
+
+def _has_module(*names):
+    for name in names:
+        try:
+            import_module(name)
+        except ImportError:
+            continue
+        return True
+    return False
+
+
+def _has_mongodb():
+    try:
+        from pymongo import MongoClient
+        MongoClient(serverSelectionTimeoutMS=200).server_info()
+    except Exception:
+        return False
+    return True
+
+
+# name -> (storage class, extra settings, availability check)
+STORAGES = {
+    'filesystem': ('scrapy_httpcache.storage.FilesystemCacheStorage', {}, None),
+    'filesystem-gzip': ('scrapy_httpcache.storage.FilesystemCacheStorage',
+                        {'HTTPCACHE_GZIP': True}, None),
+    'dbm': ('scrapy_httpcache.storage.DbmCacheStorage', {}, None),
+    'sqlite': ('scrapy_httpcache.storage.SqliteCacheStorage', {}, None),
+    'leveldb': ('scrapy_httpcache.storage.LeveldbCacheStorage', {},
+                lambda: _has_module('plyvel', 'leveldb')),
+    'mongodb': ('scrapy_httpcache.storage.MongodbCacheStorage',
+                {'HTTPCACHE_MONGO_DATABASE': 'httpcache_benchmark'}, _has_mongodb),
+}
+
+POLICIES = {
+    'dummy': 'scrapy_httpcache.policy.DummyPolicy',
+    'rfc2616': 'scrapy_httpcache.policy.RFC2616Policy',
+    'adaptive': 'scrapy_httpcache.policy.AdaptivePolicy',
+}
+
+# name -> object path, or module path for the package
+STARTUP_TARGETS = {
+    'package': 'scrapy_httpcache',
+    'middleware': 'scrapy_httpcache.HttpCacheMiddleware',
+    'filesystem': 'scrapy_httpcache.storage.FilesystemCacheStorage',
+    'sqlite': 'scrapy_httpcache.storage.SqliteCacheStorage',
+    'rfc2616': 'scrapy_httpcache.policy.RFC2616Policy',
+}
+
+# Scrapy itself is imported first, any Scrapy process loads it anyway
+_STARTUP_SCRIPT = """
+import sys, json
+from importlib import import_module
+from timeit import default_timer
+from scrapy.utils.misc import load_object
+path = sys.argv[1]
+start = default_timer()
+if '.' in path:
+    load_object(path)
+else:
+    import_module(path)
+elapsed = default_timer() - start
+print(json.dumps({'elapsed': elapsed, 'modules': sorted(
+    name for name in sys.modules if name.split('.')[0] == 'scrapy_httpcache')}))
+"""
+
+DEFAULT_BODY_SIZES = (1024, 16 * 1024, 256 * 1024)
+DEFAULT_ENTRIES = (1000,)
+DEFAULT_HIT_RATIOS = (0.5, 0.9)
+DEFAULT_OPERATIONS = 2000
+DEFAULT_WRITE_RATIO = 0.1
+DEFAULT_SEED = 2616
+
+_WORDS = (b'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+          b'tempor incididunt ut labore et dolore magna aliqua <div> </div> <a href=')
+
+
+def available_storages():
+    """Return the names of the storage backends usable in this environment."""
+    names = []
+    for name, (_, _, check) in sorted(STORAGES.items()):
+        if check is None or check():
+            names.append(name)
+    return names
+
+
+def summarize(samples, elapsed=None):
+    """Return count, throughput and latency percentiles for a list of
+    per-operation durations (in seconds)."""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    count = len(ordered)
+    total = elapsed if elapsed is not None else sum(ordered)
+
+    def pct(p):
+        return ordered[min(count - 1, int(count * p / 100.0))]
+
+    return {
+        'count': count,
+        'throughput': count / total if total else None,
+        'mean': sum(ordered) / count,
+        'p50': pct(50),
+        'p95': pct(95),
+        'p99': pct(99),
+        'max': ordered[-1],
+    }
+
+
+class Workload(object):
+    """ A reproducible synthetic workload.
+
+    ``entries`` responses of ``body_size`` bytes are stored first, then
+    ``operations`` operations are run, of which ``write_ratio`` overwrite an
+    existing entry and the rest are lookups, hitting an existing entry with
+    probability ``hit_ratio``.
+    """
+
+    def __init__(self, body_size, entries, hit_ratio, operations=DEFAULT_OPERATIONS,
+                 write_ratio=DEFAULT_WRITE_RATIO, seed=DEFAULT_SEED):
+        self.body_size = body_size
+        self.entries = entries
+        self.hit_ratio = hit_ratio
+        self.operations = operations
+        self.write_ratio = write_ratio
+        self.seed = seed
+
+    def params(self):
+        return {
+            'body_size': self.body_size,
+            'entries': self.entries,
+            'hit_ratio': self.hit_ratio,
+            'operations': self.operations,
+            'write_ratio': self.write_ratio,
+            'seed': self.seed,
+        }
+
+    def body(self, rng):
+        chunks = []
+        size = 0
+        while size < self.body_size:
+            chunk = _WORDS[rng.randrange(len(_WORDS)):]
+            chunks.append(chunk)
+            size += len(chunk)
+        return b''.join(chunks)[:self.body_size]
+
+    def request(self, idx, missing=False):
+        host = 'miss' if missing else 'bench'
+        return Request('http://%s-%d.example.com/page/%d' % (host, idx % 97, idx))
+
+    def response(self, request, body, headers=None):
+        headers = dict(headers or {}, **{'Content-Type': 'text/html; charset=utf-8'})
+        return Response(request.url, status=200, headers=headers, body=body)
+
+    def plan(self, rng):
+        """Yield (operation, entry index) tuples for the mixed phase."""
+        missing = 0
+        for _ in range(self.operations):
+            if rng.random() < self.write_ratio:
+                yield 'store', rng.randrange(self.entries)
+            elif rng.random() < self.hit_ratio:
+                yield 'retrieve_hit', rng.randrange(self.entries)
+            else:
+                missing += 1
+                yield 'retrieve_miss', missing
+
+
+def _settings(cachedir, storage, policy=None, **extra):
+    cls, storage_settings, _ = STORAGES[storage]
+    settings = {
+        'HTTPCACHE_ENABLED': True,
+        'HTTPCACHE_DIR': cachedir,
+        'HTTPCACHE_STORAGE': cls,
+        'HTTPCACHE_POLICY': POLICIES[policy or 'dummy'],
+    }
+    settings.update(storage_settings)
+    settings.update(extra)
+    return Settings(settings)
+
+
+def run_storage_benchmark(storage, workload, cachedir=None):
+    """Run ``workload`` directly against a storage backend."""
+    tmpdir = cachedir or tempfile.mkdtemp(prefix='httpcache-bench-')
+    rng = random.Random(workload.seed)
+    spider = Spider('benchmark')
+    settings = _settings(tmpdir, storage)
+    backend = load_object(settings['HTTPCACHE_STORAGE'])(settings)
+    populate = []
+    backend.open_spider(spider)
+    try:
+        requests = [workload.request(i) for i in range(workload.entries)]
+        bodies = [workload.body(rng) for _ in range(min(workload.entries, 16))]
+
+        populate_start = default_timer()
+        for idx, request in enumerate(requests):
+            response = workload.response(request, bodies[idx % len(bodies)])
+            start = default_timer()
+            backend.store_response(spider, request, response)
+            populate.append(default_timer() - start)
+        populate_elapsed = default_timer() - populate_start
+
+        mixed = {'store': [], 'retrieve_hit': [], 'retrieve_miss': []}
+        mixed_start = default_timer()
+        for operation, idx in workload.plan(rng):
+            if operation == 'store':
+                request = requests[idx]
+                response = workload.response(request, bodies[idx % len(bodies)])
+                start = default_timer()
+                backend.store_response(spider, request, response)
+            elif operation == 'retrieve_hit':
+                request = requests[idx]
+                start = default_timer()
+                backend.retrieve_response(spider, request)
+            else:
+                request = workload.request(idx, missing=True)
+                start = default_timer()
+                backend.retrieve_response(spider, request)
+            mixed[operation].append(default_timer() - start)
+        mixed_elapsed = default_timer() - mixed_start
+    finally:
+        backend.close_spider(spider)
+        if cachedir is None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    all_mixed = [s for values in mixed.values() for s in values]
+    return {
+        'benchmark': 'storage',
+        'storage': storage,
+        'workload': workload.params(),
+        'populate': summarize(populate, populate_elapsed),
+        'mixed': summarize(all_mixed, mixed_elapsed),
+        'operations': dict((op, summarize(values)) for op, values in mixed.items()),
+    }
+
+
+def run_policy_benchmark(policy, workload, storage='filesystem', cachedir=None):
+    """Run ``workload`` through the middleware with the given policy.
+
+    Each operation is a full ``process_request``/``process_response``
+    cycle, with responses carrying expiration and validation headers.
+    """
+    tmpdir = cachedir or tempfile.mkdtemp(prefix='httpcache-bench-')
+    rng = random.Random(workload.seed)
+    spider = Spider('benchmark')
+    stats = get_crawler(Spider).stats
+    mw = HttpCacheMiddleware(_settings(tmpdir, storage, policy), stats)
+    headers = {
+        'Cache-Control': 'max-age=3600',
+        'Last-Modified': 'Mon, 01 Jan 2018 00:00:00 GMT',
+        'ETag': '"benchmark"',
+    }
+    samples = []
+    mw.spider_opened(spider)
+    try:
+        bodies = [workload.body(rng) for _ in range(min(workload.entries, 16))]
+
+        def cycle(request, body):
+            start = default_timer()
+            result = mw.process_request(request, spider)
+            if result is None:
+                response = workload.response(request, body, headers)
+                mw.process_response(request, response, spider)
+            samples.append(default_timer() - start)
+
+        for idx in range(workload.entries):
+            cycle(workload.request(idx), bodies[idx % len(bodies)])
+        del samples[:]
+
+        start = default_timer()
+        for operation, idx in workload.plan(rng):
+            missing = operation == 'retrieve_miss'
+            cycle(workload.request(idx, missing=missing), bodies[idx % len(bodies)])
+        elapsed = default_timer() - start
+    finally:
+        mw.spider_closed(spider)
+        if cachedir is None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    counters = stats.get_stats(spider)
+    return {
+        'benchmark': 'policy',
+        'policy': policy,
+        'storage': storage,
+        'workload': workload.params(),
+        'cycle': summarize(samples, elapsed),
+        'stats': dict((k, v) for k, v in counters.items() if k.startswith('httpcache/')),
+    }
+
+
+def run_startup_benchmark(target, runs=10):
+    """Time loading a ``STARTUP_TARGETS`` target in ``runs`` fresh
+    processes, and list the modules of the package it loaded."""
+    sourceroot = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (sourceroot, env.get('PYTHONPATH')) if p)
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', _STARTUP_SCRIPT, STARTUP_TARGETS[target]], env=env)
+        result = json.loads(output.decode('ascii').strip().splitlines()[-1])
+        samples.append(result['elapsed'])
+    return {
+        'benchmark': 'startup',
+        'target': target,
+        'load': summarize(samples),
+        'modules': result['modules'],
+    }
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'scrapy': scrapy.__version__,
+        'time': time.time(),
+    }
+
+
+def workloads(body_sizes=DEFAULT_BODY_SIZES, entries=DEFAULT_ENTRIES,
+              hit_ratios=DEFAULT_HIT_RATIOS, **kwargs):
+    for body_size in body_sizes:
+        for count in entries:
+            for hit_ratio in hit_ratios:
+                yield Workload(body_size, count, hit_ratio, **kwargs)
+
+
+def run(storages=None, policies=None, startup_runs=10, log=None, **kwargs):
+    """Run the full benchmark matrix and return a JSON-serializable dict."""
+    storages = storages if storages is not None else available_storages()
+    policies = policies if policies is not None else sorted(POLICIES)
+    results = []
+    if startup_runs:
+        for target in sorted(STARTUP_TARGETS):
+            if log:
+                log('startup %s' % target)
+            results.append(run_startup_benchmark(target, startup_runs))
+    for workload in workloads(**kwargs):
+        for storage in storages:
+            if log:
+                log('storage %s %r' % (storage, workload.params()))
+            results.append(run_storage_benchmark(storage, workload))
+        for policy in policies:
+            if log:
+                log('policy %s %r' % (policy, workload.params()))
+            results.append(run_policy_benchmark(policy, workload))
+    return {'environment': environment(), 'results': results}
@@ -0,0 +1,62 @@
+"""
+Command line entry point for the HttpCache benchmarks.
+
+    python -m tests.benchmarks [options]
+"""
+from __future__ import print_function
+
+import sys
+import json
+import argparse
+
+from . import (run, available_storages, POLICIES, DEFAULT_BODY_SIZES, DEFAULT_ENTRIES,
+               DEFAULT_HIT_RATIOS, DEFAULT_OPERATIONS, DEFAULT_WRITE_RATIO, DEFAULT_SEED)
+
+
+def _list(cast):
+    return lambda value: [cast(v) for v in value.split(',') if v]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tests.benchmarks',
+        description='Benchmark HttpCache storage backends and policies.')
+    parser.add_argument('--storages', type=_list(str), default=None,
+        help='comma-separated storages (default: all available: %s)'
+             % ','.join(available_storages()))
+    parser.add_argument('--policies', type=_list(str), default=sorted(POLICIES),
+        help='comma-separated policies (default: %(default)s)')
+    parser.add_argument('--body-sizes', type=_list(int), default=list(DEFAULT_BODY_SIZES),
+        help='comma-separated body sizes in bytes (default: %(default)s)')
+    parser.add_argument('--entries', type=_list(int), default=list(DEFAULT_ENTRIES),
+        help='comma-separated entry counts (default: %(default)s)')
+    parser.add_argument('--hit-ratios', type=_list(float), default=list(DEFAULT_HIT_RATIOS),
+        help='comma-separated lookup hit ratios (default: %(default)s)')
+    parser.add_argument('--operations', type=int, default=DEFAULT_OPERATIONS,
+        help='operations in the mixed phase (default: %(default)s)')
+    parser.add_argument('--write-ratio', type=float, default=DEFAULT_WRITE_RATIO,
+        help='share of writes in the mixed phase (default: %(default)s)')
+    parser.add_argument('--startup-runs', type=int, default=10,
+        help='processes started by the startup benchmark, 0 to skip it '
+             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+        help='random seed (default: %(default)s)')
+    parser.add_argument('-o', '--output', default='-',
+        help='write JSON results to this file (default: stdout)')
+    opts = parser.parse_args(argv)
+
+    log = lambda msg: print(msg, file=sys.stderr)
+    results = run(storages=opts.storages, policies=opts.policies,
+                  startup_runs=opts.startup_runs, log=log,
+                  body_sizes=opts.body_sizes, entries=opts.entries,
+                  hit_ratios=opts.hit_ratios, operations=opts.operations,
+                  write_ratio=opts.write_ratio, seed=opts.seed)
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if opts.output == '-':
+        print(data)
+    else:
+        with open(opts.output, 'w') as f:
+            f.write(data)
+
+
+if __name__ == '__main__':
+    main()
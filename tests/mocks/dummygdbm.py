@@ -0,0 +1,38 @@
+"""DBM-like dummy module walking its keys like gdbm"""
+import collections
+
+
+class DummyDB(collections.OrderedDict):
+    """Provide dummy gdbm-like interface, without listing keys."""
+    def close(self):
+        pass
+
+    def keys(self):
+        raise AssertionError('keys listed')
+
+    walks = 0
+
+    def firstkey(self):
+        self.walks += 1
+        return next(iter(self), None)
+
+    def nextkey(self, key):
+        found = False
+        for k in self:
+            if found:
+                return k
+            found = k == key
+
+
+error = KeyError
+
+
+_DATABASES = collections.defaultdict(DummyDB)
+
+def open(file, flag='r', mode=0o666):
+    """Open or create a dummy database compatible.
+
+    Arguments `flag` and `mode` are ignored.
+    """
+    # return same instance for same file argument
+    return _DATABASES[file]
@@ -0,0 +1,50 @@
+import json
+import unittest
+
+from tests import benchmarks
+
+
+class BenchmarksTest(unittest.TestCase):
+
+    workload = benchmarks.Workload(body_size=512, entries=20, hit_ratio=0.5, operations=50)
+
+    def test_summarize(self):
+        summary = benchmarks.summarize([0.001 * i for i in range(1, 101)], elapsed=1.0)
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['throughput'], 100)
+        self.assertAlmostEqual(summary['p50'], 0.051)
+        self.assertAlmostEqual(summary['p99'], 0.1)
+        self.assertEqual(benchmarks.summarize([]), {'count': 0})
+
+    def test_workload_is_reproducible(self):
+        import random
+        plan1 = list(self.workload.plan(random.Random(1)))
+        plan2 = list(self.workload.plan(random.Random(1)))
+        self.assertEqual(plan1, plan2)
+        self.assertEqual(len(plan1), self.workload.operations)
+
+    def test_storage_benchmark(self):
+        for storage in ('filesystem', 'sqlite'):
+            result = benchmarks.run_storage_benchmark(storage, self.workload)
+            self.assertEqual(result['storage'], storage)
+            self.assertEqual(result['populate']['count'], self.workload.entries)
+            self.assertEqual(result['mixed']['count'], self.workload.operations)
+            assert result['mixed']['throughput'] > 0
+            json.dumps(result)
+
+    def test_policy_benchmark(self):
+        for policy in sorted(benchmarks.POLICIES):
+            result = benchmarks.run_policy_benchmark(policy, self.workload)
+            self.assertEqual(result['policy'], policy)
+            self.assertEqual(result['cycle']['count'], self.workload.operations)
+            assert result['stats']['httpcache/hit'] > 0
+            json.dumps(result)
+
+    def test_startup_benchmark(self):
+        result = benchmarks.run_startup_benchmark('filesystem', runs=2)
+        self.assertEqual(result['load']['count'], 2)
+        # other backends and the middleware are not loaded
+        assert 'scrapy_httpcache.storage.filesystem' in result['modules']
+        assert 'scrapy_httpcache.storage.mongodb' not in result['modules']
+        assert 'scrapy_httpcache.middleware' not in result['modules']
+        json.dumps(result)
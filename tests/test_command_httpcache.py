@@ -0,0 +1,216 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from scrapy.exceptions import UsageError
+from scrapy.http import Request, Response
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+from scrapy.utils.misc import load_object
+from scrapy.utils.request import request_fingerprint
+
+from scrapy_httpcache.commands.httpcache import Command, export, scan
+from scrapy_httpcache.storage import WarcCacheStorage
+
+
+class HttpCacheCommandTest(unittest.TestCase):
+
+    storage_class = 'scrapy_httpcache.storage.DbmCacheStorage'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = Settings({
+            'HTTPCACHE_DIR': self.tmpdir,
+            'HTTPCACHE_STORAGE': self.storage_class,
+        })
+        self.spider = Spider('example.com')
+        self.requests = [
+            Request('http://www.example.com/1'),
+            Request('http://www.example.com/2'),
+            Request('http://example.net/'),
+        ]
+        storage = load_object(self.storage_class)(self.settings)
+        storage.open_spider(self.spider)
+        for request, status in zip(self.requests, (200, 200, 404)):
+            storage.store_response(self.spider, request,
+                                   Response(request.url, status=status, body=b'body'))
+        storage.close_spider(self.spider)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _scan(self, action, **kwargs):
+        return scan(self.settings, self.spider.name, action, **kwargs)
+
+    def test_stats(self):
+        report = self._scan('stats')
+        self.assertEqual(report.entries, 3)
+        self.assertEqual(report.bytes, 12)
+        self.assertEqual(report.sizes[0], 3)
+        self.assertEqual(report.ages[0], 3)
+        self.assertEqual(report.statuses, {200: 2, 404: 1})
+        self.assertEqual(report.domains, {'www.example.com': 2, 'example.net': 1})
+        output = report.format('stats')
+        assert 'Entries: 3' in output
+        assert 'www.example.com' in output
+
+    def test_purge(self):
+        report = self._scan('purge', filters={'domains': ['example.com'], 'statuses': [200]},
+                            delete=True)
+        self.assertEqual(report.purged, 2)
+        self.assertEqual(report.entries, 0)
+        self.assertEqual(self._scan('stats').domains, {'example.net': 1})
+
+        report = self._scan('purge', filters={'older_than': 3600}, delete=True)
+        self.assertEqual(report.purged, 0)
+        report = self._scan('purge', filters={'older_than': 3600}, delete=True,
+                            now=time.time() + 7200)
+        self.assertEqual(report.purged, 1)
+        self.assertEqual(self._scan('stats').entries, 0)
+
+    def test_metadata_only(self):
+        storagecls = load_object(self.storage_class)
+        if 'retrieve_metadata' not in vars(storagecls):
+            raise unittest.SkipTest('%s reads bodies along with metadata' % self.storage_class)
+        retrieve_entry = storagecls.retrieve_entry
+
+        def unexpected(*args, **kwargs):
+            raise AssertionError('body read')
+        storagecls.retrieve_entry = unexpected
+        try:
+            report = self._scan('stats')
+            self.assertEqual((report.entries, report.bytes), (3, 12))
+            report = self._scan('purge', filters={'statuses': [404]}, delete=True)
+            self.assertEqual((report.purged, report.purged_bytes), (1, 4))
+        finally:
+            storagecls.retrieve_entry = retrieve_entry
+        self.assertEqual(self._scan('stats').entries, 2)
+
+    def test_purge_dry_run(self):
+        report = self._scan('purge', filters={'statuses': [404]})
+        self.assertEqual(report.purged, 1)
+        self.assertEqual(self._scan('stats').entries, 3)
+
+    def test_verify(self):
+        self.assertEqual(self._scan('verify').invalid, [])
+        storage = load_object(self.storage_class)(self.settings)
+        storage.open_spider(self.spider)
+        self._corrupt(storage, request_fingerprint(self.requests[0]))
+        storage.close_spider(self.spider)
+        self.assertEqual(self._scan('verify').invalid, [request_fingerprint(self.requests[0])])
+        self._scan('verify', delete=True)
+        self.assertEqual(self._scan('verify').invalid, [])
+        self.assertEqual(self._scan('stats').entries, 2)
+
+    def test_export(self):
+        path = os.path.join(self.tmpdir, 'export')
+        self.assertEqual(export(self.settings, self.spider.name, path), 3)
+        settings = Settings({'HTTPCACHE_DIR': path})
+        storage = WarcCacheStorage(settings)
+        storage.open_spider(self.spider)
+        try:
+            # in the order they were stored
+            self.assertEqual([key for key, _ in storage.iter_entries(self.spider)],
+                             [request_fingerprint(r) for r in self.requests])
+            source = load_object(self.storage_class)(self.settings)
+            source.open_spider(self.spider)
+            for request in self.requests:
+                cached = source.retrieve_response(self.spider, request)
+                exported = storage.retrieve_response(self.spider, request)
+                self.assertEqual((exported.url, exported.status, exported.body),
+                                 (cached.url, cached.status, cached.body))
+                self.assertEqual(exported.cache_timestamp, cached.cache_timestamp)
+            source.close_spider(self.spider)
+        finally:
+            storage.close_spider(self.spider)
+
+    def test_export_updated(self):
+        storage = load_object(self.storage_class)(self.settings)
+        storage.open_spider(self.spider)
+        request = self.requests[0]
+        storage.update_metadata(self.spider, request,
+                                Response(request.url, status=304, body=b'body'))
+        storage.close_spider(self.spider)
+        path = os.path.join(self.tmpdir, 'export')
+        export(self.settings, self.spider.name, path)
+        keys = [request_fingerprint(r) for r in self.requests]
+        if not storage.ordered_scan:
+            keys.append(keys.pop(0))  # in the order of their last update
+        target = WarcCacheStorage(Settings({'HTTPCACHE_DIR': path}))
+        target.open_spider(self.spider, readonly=True)
+        try:
+            self.assertEqual([key for key, _ in target.iter_stored(self.spider)], keys)
+        finally:
+            target.close_spider(self.spider)
+
+    def test_partitions(self):
+        storage = load_object(self.storage_class)(self.settings)
+        if not storage.parallel_scan:
+            raise unittest.SkipTest('%s is not scanned in parallel' % self.storage_class)
+        storage.open_spider(self.spider, readonly=True)
+        try:
+            entries = sorted(storage.iter_entries(self.spider))
+            for partitions in (2, 3, 7):
+                parts = [list(storage.iter_partition(self.spider, partition, partitions))
+                         for partition in range(partitions)]
+                self.assertEqual(sorted(sum(parts, [])), entries)
+        finally:
+            storage.close_spider(self.spider)
+
+    def test_missing_cache(self):
+        command = Command()
+        command.settings = self.settings
+        files = sorted(os.listdir(self.tmpdir))
+        for action in ('stats', 'purge', 'verify', 'compact', 'export'):
+            self.assertRaises(UsageError, command.run, [action, 'example.org', 'dir'], None)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), files)
+
+    def _corrupt(self, storage, key):
+        storage.dbs[self.spider]['%s_body' % key] = b'corrupted'
+
+
+class FilesystemHttpCacheCommandTest(HttpCacheCommandTest):
+
+    storage_class = 'scrapy_httpcache.storage.FilesystemCacheStorage'
+
+    def _corrupt(self, storage, key):
+        with open(os.path.join(storage._find_path(self.spider, key), 'response_body'), 'wb') as f:
+            f.write(b'corrupted')
+
+    def test_parallel(self):
+        report = self._scan('stats', workers=2)
+        self.assertEqual(report.entries, 3)
+        report = self._scan('purge', filters={'statuses': [404]}, delete=True, workers=2)
+        self.assertEqual(report.purged, 1)
+        self.assertEqual(self._scan('stats', workers=3).entries, 2)
+
+
+class SqliteHttpCacheCommandTest(HttpCacheCommandTest):
+
+    storage_class = 'scrapy_httpcache.storage.SqliteCacheStorage'
+
+    def test_parallel(self):
+        report = self._scan('stats', workers=2)
+        self.assertEqual(report.entries, 3)
+        report = self._scan('purge', filters={'statuses': [404]}, delete=True, workers=2)
+        self.assertEqual(report.purged, 1)
+        self.assertEqual(self._scan('stats', workers=3).entries, 2)
+
+    def _corrupt(self, storage, key):
+        db = storage.dbs[self.spider]
+        with db:
+            db.execute("UPDATE httpcache SET body=? WHERE request_fingerprint=?",
+                       (b'corrupted', key))
+
+
+class WarcHttpCacheCommandTest(HttpCacheCommandTest):
+
+    storage_class = 'scrapy_httpcache.storage.WarcCacheStorage'
+
+    def _corrupt(self, storage, key):
+        # appended again with the body hash of the original body
+        request = [r for r in self.requests if request_fingerprint(r) == key][0]
+        storage._append(self.spider, key, request, Response(request.url, body=b'corrupted'),
+                        {'body_hash': storage._body_hash(b'body')})
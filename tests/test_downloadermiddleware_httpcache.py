@@ -1,18 +1,47 @@
 from __future__ import print_function
+import os
+import json
+import hashlib
 import time
+import timeit
 import tempfile
 import shutil
+import subprocess
+import sys
+import threading
 import unittest
 import email.utils
 from contextlib import contextmanager
 import pytest
+from io import BytesIO
+from six.moves import queue
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.web.test.requesthelper import DummyRequest
 
-from scrapy.http import Response, HtmlResponse, Request
+from scrapy.http import Headers, Response, HtmlResponse, Request
 from scrapy.spiders import Spider
 from scrapy.settings import Settings
-from scrapy.exceptions import IgnoreRequest
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.utils.python import to_bytes, to_unicode
+from scrapy.utils.request import request_fingerprint
 from scrapy.utils.test import get_crawler
 from scrapy_httpcache import HttpCacheMiddleware
+from scrapy_httpcache.admission import FrequencySketch
+from scrapy_httpcache.circuitbreaker import CircuitBreaker
+from scrapy_httpcache.eviction import EvictingStorage
+from scrapy_httpcache.expiration import ExpirationRules
+from scrapy_httpcache.instrumentation import LatencyHistogram
+from scrapy_httpcache.signals import httpcache_operation
+from scrapy_httpcache.serialization import dumps, loads, encode_request, encode_response
+from scrapy_httpcache.server import CacheServerResource
+from scrapy_httpcache.storage import (DbmCacheStorage, FilesystemCacheStorage,
+                                      ShardedCacheStorage, SqliteCacheStorage)
+from scrapy_httpcache.storage.base import CacheStorage, build_response, response_hints
+from scrapy_httpcache.storage.remote import RemoteCacheError
+from scrapy_httpcache.storage.sharded import HashRing
+from scrapy_httpcache.storage.warc import iter_warc_records, warc_record
+from scrapy_httpcache import trace
 
 
 class _BaseTest(unittest.TestCase):
@@ -104,6 +133,15 @@ class _BaseTest(unittest.TestCase):
 
 class DefaultStorageTest(_BaseTest):
 
+    blob_storage = True  # if bodies over HTTPCACHE_BLOB_THRESHOLD are spilled
+
+    def _has_blob(self, key):
+        # in the blob files of any storage (or shard) of the test
+        for dirpath, _, filenames in os.walk(self.tmpdir):
+            if key in filenames and '.blobs' in dirpath:
+                return True
+        return False
+
     def test_storage(self):
         with self._storage() as storage:
             request2 = self.request.copy()
@@ -114,8 +152,12 @@ class DefaultStorageTest(_BaseTest):
             assert isinstance(response2, HtmlResponse)  # content-type header
             self.assertEqualResponse(self.response, response2)
 
+            assert 'expired' not in response2.flags
+
             time.sleep(2)  # wait for cache to expire
-            assert storage.retrieve_response(self.spider, request2) is None
+            response3 = storage.retrieve_response(self.spider, request2)
+            self.assertEqualResponse(self.response, response3)
+            assert 'expired' in response3.flags
 
     def test_storage_never_expire(self):
         with self._storage(HTTPCACHE_EXPIRATION_SECS=0) as storage:
@@ -124,10 +166,208 @@ class DefaultStorageTest(_BaseTest):
             time.sleep(0.5)  # give the chance to expire
             assert storage.retrieve_response(self.spider, self.request)
 
+    def test_storage_metadata(self):
+        metadata = {'expires': 1234.5, 'no_cache': False, 'etag': b'"foo"'}
+        body_hash = hashlib.sha1(self.response.body).hexdigest()
+        with self._storage() as storage:
+            storage.store_response(self.spider, self.request, self.response)
+            response = storage.retrieve_response(self.spider, self.request)
+            self.assertEqual(response.cache_metadata, {'body_hash': body_hash})
+            storage.store_response(self.spider, self.request, self.response,
+                                   metadata=metadata)
+            response = storage.retrieve_response(self.spider, self.request)
+            self.assertEqual(response.cache_metadata, dict(metadata, body_hash=body_hash))
+            self.assertEqualResponse(self.response, response)
+
+    def test_update_metadata(self):
+        with self._storage(HTTPCACHE_EXPIRATION_SECS=0) as storage:
+            storage.store_response(self.spider, self.request, self.response)
+            cached = storage.retrieve_response(self.spider, self.request)
+            assert storage.is_body_unchanged(cached, self.response)
+            assert not storage.is_body_unchanged(cached, self.response.replace(body=b'other'))
+
+            response = self.response.replace(status=200, headers={
+                'Content-Type': 'text/html', 'ETag': 'bar'})
+            storage.update_metadata(self.spider, self.request, response, {'etag': b'bar'})
+            cached = storage.retrieve_response(self.spider, self.request)
+            self.assertEqualResponse(response, cached)
+            self.assertEqual(cached.cache_metadata['etag'], b'bar')
+            assert storage.is_body_unchanged(cached, self.response)
+
+            # missing entries are stored in full
+            request = Request('http://www.example.com/missing')
+            storage.update_metadata(self.spider, request, response)
+            self.assertEqualResponse(response, storage.retrieve_response(self.spider, request))
+
+    def test_storage_expiration_rules(self):
+        settings = {
+            'HTTPCACHE_EXPIRATION_SECS': 0,
+            'HTTPCACHE_EXPIRATION_DOMAINS': {'example.com': 60},
+            'HTTPCACHE_EXPIRATION_PATTERNS': [('/search', 5)],
+        }
+        with self._storage(**settings) as storage:
+            now = time.time()
+            ts = now - 10
+            assert not storage._is_expired(ts, now, Request('http://www.example.com/'))
+            assert storage._is_expired(ts, now, Request('http://www.example.com/search'))
+            assert not storage._is_expired(ts, now, Request('http://example.net/'))
+            request = Request('http://www.example.com/', meta={'httpcache_expiration_secs': 1})
+            assert storage._is_expired(ts, now, request)
+
+            request = Request('http://example.net/', meta={'httpcache_expiration_secs': 1})
+            storage.store_response(self.spider, request, self.response)
+            time.sleep(1.5)  # wait for cache to expire
+            assert 'expired' in storage.retrieve_response(self.spider, request).flags
+            response = storage.retrieve_response(self.spider, request.replace(meta={}))
+            assert 'expired' not in response.flags
+
+    def test_storage_blobs(self):
+        key = request_fingerprint(self.request)
+        response = self.response.replace(body=b'large body' * 10)
+        with self._storage(HTTPCACHE_EXPIRATION_SECS=0, HTTPCACHE_BLOB_THRESHOLD=20) as storage:
+            storage.store_response(self.spider, self.request, response)
+            self.assertEqual(self._has_blob(key), self.blob_storage)
+            self.assertEqualResponse(response, storage.retrieve_response(self.spider, self.request))
+
+            storage.update_metadata(self.spider, self.request, response, {'etag': b'bar'})
+            cached = storage.retrieve_response(self.spider, self.request)
+            self.assertEqualResponse(response, cached)
+            self.assertEqual(cached.cache_metadata['etag'], b'bar')
+
+            # small bodies are kept in the database
+            storage.store_response(self.spider, self.request, self.response)
+            assert not self._has_blob(key)
+            self.assertEqualResponse(self.response, storage.retrieve_response(self.spider, self.request))
+
+    def test_storage_blobs_disabled(self):
+        key = request_fingerprint(self.request)
+        response = self.response.replace(body=b'large body' * 10)
+        with self._storage(HTTPCACHE_EXPIRATION_SECS=0, HTTPCACHE_BLOB_THRESHOLD=20) as storage:
+            storage.store_response(self.spider, self.request, response)
+        with self._storage(HTTPCACHE_EXPIRATION_SECS=0) as storage:
+            # stored in blob files before, still read from there
+            self.assertEqualResponse(response, storage.retrieve_response(self.spider, self.request))
+            storage.update_metadata(self.spider, self.request, response, {'etag': b'bar'})
+            cached = storage.retrieve_response(self.spider, self.request)
+            self.assertEqualResponse(response, cached)
+            self.assertEqual(cached.cache_metadata['etag'], b'bar')
+
+            # blob files are not looked for otherwise
+            def _blob_path(spider, key):
+                raise AssertionError('blob file looked for')
+            storage._blob_path = _blob_path
+            request2 = Request('http://www.example.com/other')
+            storage.store_response(self.spider, request2, response)
+            storage.update_metadata(self.spider, request2, response)
+            self.assertEqualResponse(response, storage.retrieve_response(self.spider, request2))
+            storage.delete_response(self.spider, request_fingerprint(request2))
+
+    def test_iter_entries(self):
+        request2 = Request('http://www.example.com/other')
+        response2 = self.response.replace(body=b'large body' * 10)
+        with self._storage(HTTPCACHE_BLOB_THRESHOLD=20) as storage:
+            self.assertEqual(list(storage.iter_entries(self.spider)), [])
+            storage.store_response(self.spider, self.request, self.response)
+            storage.store_response(self.spider, request2, response2)
+            key1, key2 = request_fingerprint(self.request), request_fingerprint(request2)
+            self.assertEqual(sorted(storage.iter_entries(self.spider)),
+                             sorted([(key1, len(self.response.body)), (key2, 100)]))
+
+            storage.delete_response(self.spider, key2)
+            storage.delete_response(self.spider, key2)  # already removed
+            assert storage.retrieve_response(self.spider, request2) is None
+            assert not self._has_blob(key2)
+            assert not storage.has_entry(self.spider, key2)
+            assert storage.has_entry(self.spider, key1)
+            self.assertEqual(list(storage.iter_entries(self.spider)),
+                             [(key1, len(self.response.body))])
+
+    def test_retrieve_metadata(self):
+        key = request_fingerprint(self.request)
+        with self._storage() as storage:
+            assert storage.retrieve_metadata(self.spider, key) is None
+            storage.store_response(self.spider, self.request, self.response)
+            cached = storage.retrieve_entry(self.spider, key)
+            response = storage.retrieve_metadata(self.spider, key)
+            self.assertEqual((response.url, response.status, response.headers),
+                             (cached.url, cached.status, cached.headers))
+            self.assertEqual(response.cache_timestamp, cached.cache_timestamp)
+            self.assertEqual(response.cache_metadata, cached.cache_metadata)
+            assert response.body in (b'', cached.body)
+
+    def test_response_hints(self):
+        body = b'<html><head><meta charset="cp1251"></head><body>\xcf\xf0\xe8</body></html>'
+        response = Response('http://www.example.com', body=body,
+                            headers={'Content-Type': 'text/html', 'X-Test': ['a', 'b']})
+        with self._storage() as storage:
+            storage.store_response(self.spider, self.request, response)
+            cached = storage.retrieve_response(self.spider, self.request)
+            assert isinstance(cached, HtmlResponse)
+            self.assertEqualResponse(response, cached)
+            # the encoding is not detected again
+            self.assertEqual(cached._encoding, 'cp1251')
+            self.assertEqual(cached.text, body.decode('cp1251'))
+            self.assertEqual(cached.headers.getlist('x-test'), [b'a', b'b'])
+
+    def test_multiple_spiders(self):
+        spider2 = Spider('example.net')
+        with self._storage() as storage, self._storage() as storage2:
+            # crawlers of the same spider in one process share its database
+            storage.store_response(self.spider, self.request, self.response)
+            self.assertEqualResponse(self.response,
+                                     storage2.retrieve_response(self.spider, self.request))
+            storage.open_spider(spider2)
+            try:
+                assert storage.retrieve_response(spider2, self.request) is None
+                storage.store_response(spider2, self.request, self.response)
+                self.assertEqualResponse(self.response,
+                                         storage.retrieve_response(spider2, self.request))
+            finally:
+                storage.close_spider(spider2)
+            self.assertEqualResponse(self.response,
+                                     storage.retrieve_response(self.spider, self.request))
+
 
 class FilesystemStorageTest(DefaultStorageTest):
 
     storage_class = 'scrapy_httpcache.storage.FilesystemCacheStorage'
+    blob_storage = False
+
+    def test_fanout(self):
+        key = request_fingerprint(self.request)
+        spiderdir = os.path.join(self.tmpdir, self.spider.name)
+        with self._storage() as storage:
+            storage.store_response(self.spider, self.request, self.response)
+            assert os.path.isdir(os.path.join(spiderdir, key[0:2], key))
+            # shard directories are created as needed
+            self.assertEqual(os.listdir(spiderdir), [key[0:2]])
+        with self._storage(HTTPCACHE_FS_FANOUT_DEPTH=2, HTTPCACHE_FS_FANOUT_WIDTH=1) as storage:
+            self.assertEqual(os.listdir(spiderdir), [key[0:2]])
+            # entries of the previous layout are still found
+            self.assertEqualResponse(self.response,
+                                     storage.retrieve_response(self.spider, self.request))
+            storage.update_metadata(self.spider, self.request, self.response)
+            assert not os.path.exists(os.path.join(spiderdir, key[0], key[1], key))
+            request2 = Request('http://www.example.com/other')
+            key2 = request_fingerprint(request2)
+            storage.store_response(self.spider, request2, self.response)
+            assert os.path.isdir(os.path.join(spiderdir, key2[0], key2[1], key2))
+            self.assertEqual(sorted(k for k, _ in storage.iter_entries(self.spider)),
+                             sorted([key, key2]))
+            storage.delete_response(self.spider, key)
+            assert storage.retrieve_response(self.spider, self.request) is None
+
+    def test_fanout_settings(self):
+        key = request_fingerprint(self.request)
+        with self._storage(HTTPCACHE_FS_FANOUT_DEPTH=0) as storage:
+            storage.store_response(self.spider, self.request, self.response)
+            self.assertEqual(os.listdir(os.path.join(self.tmpdir, self.spider.name)), [key])
+            self.assertEqualResponse(self.response,
+                                     storage.retrieve_response(self.spider, self.request))
+        for depth, width in ((-1, 2), (5, 2), (1, 0), (1, 5)):
+            settings = self._get_settings(HTTPCACHE_FS_FANOUT_DEPTH=depth,
+                                          HTTPCACHE_FS_FANOUT_WIDTH=width)
+            self.assertRaises(ValueError, FilesystemCacheStorage, settings)
 
 class FilesystemStorageGzipTest(FilesystemStorageTest):
 
@@ -154,15 +394,95 @@ class DbmStorageWithCustomDbmModuleTest(DbmStorageTest):
             self.assertEqual(storage.dbmodule.__name__, self.dbm_module)
 
 
+class DbmStorageWithKeyWalkTest(DbmStorageWithCustomDbmModuleTest):
+
+    dbm_module = 'tests.mocks.dummygdbm'
+
+    def test_iter_entries_evicted(self):
+        requests = [Request('http://www.example.com/%d' % i) for i in range(3)]
+        with self._storage() as storage:
+            for request in requests:
+                storage.store_response(self.spider, request, self.response)
+            keys = []
+            for key, _ in storage.iter_entries(self.spider):
+                keys.append(key)
+                # deleted while walking its keys
+                storage.delete_response(self.spider, key)
+            self.assertEqual(keys, [request_fingerprint(r) for r in requests])
+            # in one walk
+            self.assertEqual(storage.dbs[self.spider].walks, 1)
+
+
 class SqliteStorageTest(DefaultStorageTest):
 
     storage_class = 'scrapy_httpcache.storage.SqliteCacheStorage'
+    blob_storage = True
+
+
+    def test_upgrade_table(self):
+        import sqlite3
+        from datetime import datetime
+        from six.moves import cPickle as pickle
+        dbpath = os.path.join(self.tmpdir, '%s.db' % self.spider.name)
+        db = sqlite3.connect(dbpath)
+        request = Request('http://www.example.com/old')
+        data = {'status': 200, 'url': request.url, 'headers': {}, 'body': b'old body'}
+        with db:
+            db.execute("CREATE TABLE httpcache (request_fingerprint TEXT PRIMARY KEY, "
+                       "timestamp TIMESTAMP, data BLOB)")
+            db.execute("INSERT INTO httpcache VALUES (?, ?, ?)", (
+                request_fingerprint(request), datetime.now(),
+                sqlite3.Binary(pickle.dumps(data, protocol=2))))
+        db.close()
+        with self._storage(HTTPCACHE_EXPIRATION_SECS=0) as storage:
+            db = storage.dbs[self.spider]
+            assert 'expires' in storage._columns(db)
+            assert 'body' in storage._columns(db)
+            # entries stored with their body keep it on metadata updates
+            cached = storage.retrieve_response(self.spider, request)
+            self.assertEqual(cached.body, b'old body')
+            storage.update_metadata(self.spider, request, cached)
+            self.assertEqual(storage.retrieve_response(self.spider, request).body, b'old body')
+            storage.store_response(self.spider, self.request, self.response,
+                                   metadata={'expires': 1234.5})
+            rows = list(db.execute('SELECT expires FROM httpcache ORDER BY expires'))
+            self.assertEqual([r['expires'] for r in rows], [None, 1234.5])
+            # numbered after the rows stored before
+            rows = list(db.execute('SELECT seq FROM httpcache ORDER BY seq'))
+            self.assertEqual([r['seq'] for r in rows], [1, 2])
+
+
+    def test_compact(self):
+        requests = [Request('http://www.example.com/%d' % i) for i in range(3)]
+        with self._storage(HTTPCACHE_EXPIRATION_SECS=0) as storage:
+            for request in requests:
+                storage.store_response(self.spider, request, self.response)
+            storage.update_metadata(self.spider, requests[0], self.response)
+            storage.delete_response(self.spider, request_fingerprint(requests[1]))
+            storage.compact(self.spider)
+            # in the order they were first stored, not updated
+            rows = storage.dbs[self.spider].execute(
+                'SELECT request_fingerprint FROM httpcache ORDER BY rowid')
+            self.assertEqual([to_unicode(row['request_fingerprint']) for row in rows],
+                             [request_fingerprint(requests[i]) for i in (0, 2)])
+            storage.store_response(self.spider, requests[1], self.response)
+            rows = storage.dbs[self.spider].execute(
+                'SELECT request_fingerprint FROM httpcache ORDER BY seq')
+            self.assertEqual([to_unicode(row['request_fingerprint']) for row in rows],
+                             [request_fingerprint(requests[i]) for i in (0, 2, 1)])
+            self.assertEqualResponse(self.response,
+                                     storage.retrieve_response(self.spider, requests[0]))
+            db = storage.dbs[self.spider]
+            assert 'expires' in storage._columns(db)
+            self.assertEqual(len(list(db.execute("SELECT name FROM sqlite_master "
+                                                 "WHERE name='httpcache_expires'"))), 1)
 
 
 class LeveldbStorageTest(DefaultStorageTest):
 
     pytest.importorskip('leveldb')
     storage_class = 'scrapy_httpcache.storage.LeveldbCacheStorage'
+    blob_storage = True
 
     db_module = 'leveldb'
 
@@ -179,6 +499,7 @@ class PlyvelLeveldbStorageTest(DefaultStorageTest):
 
     pytest.importorskip('plyvel')
     storage_class = 'scrapy_httpcache.storage.LeveldbCacheStorage'
+    blob_storage = True
 
     db_module = 'plyvel'
 
@@ -192,6 +513,478 @@ class PlyvelLeveldbStorageTest(DefaultStorageTest):
             self.assertEqual(storage.dbmodule.__name__, self.db_module)
 
 
+class ShardedStorageTest(DefaultStorageTest):
+
+    storage_class = 'scrapy_httpcache.storage.ShardedCacheStorage'
+    blob_storage = True
+
+    def _get_settings(self, **new_settings):
+        new_settings.setdefault('HTTPCACHE_SHARD_STORAGE',
+                                'scrapy_httpcache.storage.SqliteCacheStorage')
+        new_settings.setdefault('HTTPCACHE_SHARDS', {
+            'disk1': {},
+            'disk2': {'HTTPCACHE_STORAGE': 'scrapy_httpcache.storage.DbmCacheStorage'},
+            'disk3': {'HTTPCACHE_DIR': os.path.join(self.tmpdir, 'other')},
+        })
+        return super(ShardedStorageTest, self)._get_settings(**new_settings)
+
+    def test_shards(self):
+        requests = [Request('http://www.example.com/%d' % i) for i in range(30)]
+        with self._storage() as storage:
+            self.assertEqual(storage.shards['disk1'].cachedir,
+                             os.path.join(self.tmpdir, 'disk1'))
+            self.assertEqual(storage.shards['disk3'].cachedir,
+                             os.path.join(self.tmpdir, 'other'))
+            assert isinstance(storage.shards['disk2'], DbmCacheStorage)
+            for request in requests:
+                storage.store_response(self.spider, request, self.response)
+            counts = [len(list(shard.iter_entries(self.spider)))
+                      for shard in storage.shards.values()]
+            self.assertEqual(sum(counts), len(requests))
+            assert all(counts)  # spread over all shards
+            self.assertEqual(len(list(storage.iter_entries(self.spider))), len(requests))
+            for request in requests:
+                self.assertEqualResponse(self.response,
+                                         storage.retrieve_response(self.spider, request))
+
+    def test_added_shard(self):
+        requests = [Request('http://www.example.com/%d' % i) for i in range(30)]
+        shards = {'disk1': {}, 'disk2': {}}
+        with self._storage(HTTPCACHE_SHARDS=shards) as storage:
+            for request in requests:
+                storage.store_response(self.spider, request, self.response)
+        shards['disk3'] = {}
+        with self._storage(HTTPCACHE_SHARDS=shards) as storage:
+            moved = [request for request in requests
+                     if storage._shard(request_fingerprint(request)) is storage.shards['disk3']]
+            assert moved
+            # still found in the shard they were stored in
+            for request in requests:
+                self.assertEqualResponse(self.response,
+                                         storage.retrieve_response(self.spider, request))
+            self.assertEqual(list(storage.shards['disk3'].iter_entries(self.spider)), [])
+            # moved to their shard when written again
+            response = self.response.replace(headers={'X-Updated': '1'})
+            storage.update_metadata(self.spider, moved[0], response)
+            storage.delete_response(self.spider, request_fingerprint(moved[1]))
+            self.assertEqual([key for key, _ in
+                              storage.shards['disk3'].iter_entries(self.spider)],
+                             [request_fingerprint(moved[0])])
+            self.assertEqual(len(list(storage.iter_entries(self.spider))), len(requests) - 1)
+        with self._storage(HTTPCACHE_SHARDS=shards) as storage:
+            self.assertEqual(len(storage.previous[self.spider]), 1)
+            cached = storage.retrieve_response(self.spider, moved[0])
+            self.assertEqual(cached.headers.get('X-Updated'), b'1')
+            assert not storage.has_entry(self.spider, request_fingerprint(moved[1]))
+            for request in moved[2:]:
+                assert storage.has_entry(self.spider, request_fingerprint(request))
+                storage.store_response(self.spider, request, self.response)
+        with self._storage(HTTPCACHE_SHARDS=shards) as storage:
+            # forgotten once all responses are in their shard
+            self.assertEqual(storage.previous[self.spider], [])
+            for request in requests:
+                if request not in moved[:2]:
+                    self.assertEqualResponse(self.response,
+                                             storage.retrieve_response(self.spider, request))
+        with open(os.path.join(self.tmpdir, 'shards.json')) as f:
+            self.assertEqual(json.load(f), {self.spider.name: [['disk1', 'disk2', 'disk3']]})
+
+    def test_lookups(self):
+        key = request_fingerprint(self.request)
+        with self._storage() as storage:
+            storage.store_response(self.spider, self.request, self.response)
+            shard = storage._shard(key)
+            # without reading the body
+            shard.retrieve_entry = None
+            assert storage.has_entry(self.spider, key)
+            storage.update_metadata(self.spider, self.request, self.response)
+            storage.delete_response(self.spider, key)
+            assert not storage.has_entry(self.spider, key)
+
+    def test_not_configured(self):
+        self.assertRaises(NotConfigured, ShardedCacheStorage,
+                          self._get_settings(HTTPCACHE_SHARDS={}))
+
+    def test_hash_ring(self):
+        keys = [request_fingerprint(Request('http://www.example.com/%d' % i))
+                for i in range(1000)]
+        ring = HashRing(['a', 'b', 'c'])
+        before = dict((key, ring.get(key)) for key in keys)
+        assert 250 < sum(1 for s in before.values() if s == 'a') < 420
+        ring.add('d')
+        after = dict((key, ring.get(key)) for key in keys)
+        moved = [key for key in keys if before[key] != after[key]]
+        # only keys moved to the new shard, about a fourth of them
+        assert all(after[key] == 'd' for key in moved)
+        assert 150 < len(moved) < 350
+        ring.remove('d')
+        self.assertEqual(dict((key, ring.get(key)) for key in keys), before)
+
+
+class InProcessPool(object):
+    """Send cache server requests to a server resource in this process."""
+
+    def __init__(self, root):
+        self.root = root  # None for a server down
+
+    def request(self, method, path, body=None):
+        if self.root is None:
+            raise RemoteCacheError('Connection refused')
+        request = DummyRequest([to_bytes(p) for p in path.strip('/').split('/')])
+        request.method = to_bytes(method)
+        request.content = BytesIO(body or b'')
+        data = self.root.render(request)
+        if request.responseCode not in (None, 200):
+            raise RemoteCacheError(request.responseCode)
+        return data
+
+    def close(self):
+        pass
+
+
+def deferred_result(d):
+    results = []
+    d.addBoth(results.append)
+    assert results, 'Deferred not fired'
+    return results[0]
+
+
+class DeferredPool(InProcessPool):
+    """Queue cache server requests until answered, as a pool not blocking
+    the reactor does."""
+
+    def __init__(self, root):
+        super(DeferredPool, self).__init__(root)
+        self.requests = []
+
+    def request(self, method, path, body=None):
+        d = defer.Deferred()
+        self.requests.append((path, loads(body), d))
+        return d
+
+    def answer(self):
+        path, body, d = self.requests.pop(0)
+        d.callback(InProcessPool.request(self, 'POST', path, dumps(body)))
+        return path, body
+
+
+class RemoteStorageTest(DefaultStorageTest):
+
+    storage_class = 'scrapy_httpcache.storage.RemoteCacheStorage'
+    blob_storage = False
+
+    def setUp(self):
+        super(RemoteStorageTest, self).setUp()
+        serverdir = os.path.join(self.tmpdir, 'server')
+        self.server = CacheServerResource(SqliteCacheStorage(Settings({
+            'HTTPCACHE_DIR': serverdir,
+            'HTTPCACHE_EXPIRATION_SECS': 0,
+        })))
+
+    def tearDown(self):
+        self.server.close()
+        super(RemoteStorageTest, self).tearDown()
+
+    def _get_settings(self, **new_settings):
+        new_settings.setdefault('HTTPCACHE_REMOTE_BATCH_SIZE', 1)
+        return super(RemoteStorageTest, self)._get_settings(**new_settings)
+
+    @contextmanager
+    def _middleware(self, **new_settings):
+        settings = self._get_settings(**new_settings)
+        mw = HttpCacheMiddleware(settings, self.crawler.stats)
+        mw.storage.pool = mw.storage.syncpool = InProcessPool(self.server)
+        mw.spider_opened(self.spider)
+        try:
+            yield mw
+        finally:
+            mw.spider_closed(self.spider)
+
+    def test_shared(self):
+        with self._storage() as storage, self._storage() as storage2:
+            storage.store_response(self.spider, self.request, self.response)
+            self.assertEqualResponse(self.response,
+                                     storage2.retrieve_response(self.spider, self.request))
+        assert 'example.com' in self.server.spiders
+
+    def test_batches(self):
+        requests = [Request('http://www.example.com/%d' % i) for i in range(5)]
+        with self._storage(HTTPCACHE_REMOTE_BATCH_SIZE=3) as storage, \
+                self._storage() as storage2:
+            for request in requests:
+                storage.store_response(self.spider, request, self.response)
+            # pending writes are readable from their storage only
+            self.assertEqual(len(storage._pending), 2)
+            assert storage2.retrieve_response(self.spider, requests[-1]) is None
+            self.assertEqualResponse(self.response,
+                                     storage.retrieve_response(self.spider, requests[-1]))
+            self.assertEqualResponse(self.response,
+                                     storage2.retrieve_response(self.spider, requests[0]))
+            storage.flush()
+            self.assertEqualResponse(self.response,
+                                     storage2.retrieve_response(self.spider, requests[-1]))
+
+    def test_local_storage(self):
+        local = 'scrapy_httpcache.storage.DbmCacheStorage'
+        with self._storage() as storage:
+            storage.store_response(self.spider, self.request, self.response)
+        with self._storage(HTTPCACHE_REMOTE_LOCAL_STORAGE=local) as storage:
+            assert isinstance(storage.local, DbmCacheStorage)
+            self.assertEqualResponse(self.response,
+                                     storage.retrieve_response(self.spider, self.request))
+            local_response = storage.local.retrieve_response(self.spider, self.request)
+            self.assertEqualResponse(self.response, local_response)
+
+            # expired as stored on the server
+            cached = storage.retrieve_response(self.spider, self.request)
+            self.server.close()
+            storage.pool = InProcessPool(None)  # any lookup would fail
+            self.assertEqualResponse(self.response,
+                                     storage.retrieve_response(self.spider, self.request))
+            self.assertEqual(storage.retrieve_response(self.spider, self.request).cache_timestamp,
+                             cached.cache_timestamp)
+            storage.pool = InProcessPool(self.server)
+
+    def test_partitions(self):
+        requests = [Request('http://www.example.com/%d' % i) for i in range(10)]
+        with self._storage() as storage:
+            for request in requests:
+                storage.store_response(self.spider, request, self.response)
+            parts = [list(storage.iter_partition(self.spider, partition, 3))
+                     for partition in range(3)]
+            assert all(parts)
+            self.assertEqual(sorted(sum(parts, [])), sorted(storage.iter_entries(self.spider)))
+
+    def test_server_errors(self):
+        with self._storage() as storage:
+            storage.pool = InProcessPool(None)
+            assert storage.retrieve_response(self.spider, self.request) is None
+            storage.store_response(self.spider, self.request, self.response)
+            self.assertEqual(len(storage._pending), 0)
+
+    def test_lookups(self):
+        requests = [Request('http://www.example.com/%d' % i) for i in range(3)]
+        with self._storage(HTTPCACHE_REMOTE_POOL_SIZE=1,
+                           HTTPCACHE_REMOTE_BATCH_SIZE=10) as storage:
+            for request in requests[:2]:
+                storage.store_response(self.spider, request, self.response)
+            storage.flush()
+            storage.pool = pool = DeferredPool(self.server)
+            results = [storage.retrieve_response(self.spider, request) for request in requests]
+            # not waiting for the server, which is asked one key at once
+            assert all(isinstance(d, defer.Deferred) and not d.called for d in results)
+            self.assertEqual(len(pool.requests), 1)
+            self.assertEqual(pool.answer(), ('/example.com/get',
+                                             {'keys': [request_fingerprint(requests[0])]}))
+            # the keys looked up meanwhile, at once
+            self.assertEqual(pool.answer(), ('/example.com/get', {
+                'keys': [request_fingerprint(r) for r in requests[1:]]}))
+            self.assertEqual(pool.requests, [])
+            responses = [deferred_result(d) for d in results]
+            self.assertEqualResponse(self.response, responses[0])
+            self.assertEqualResponse(self.response, responses[1])
+            assert responses[2] is None
+
+    def test_lookups_middleware(self):
+        with self._middleware(HTTPCACHE_POLICY='scrapy_httpcache.policy.DummyPolicy') as mw:
+            mw.storage.store_response(self.spider, self.request, self.response)
+            mw.storage.pool = pool = DeferredPool(self.server)
+            d = mw.process_request(self.request, self.spider)
+            assert isinstance(d, defer.Deferred) and not d.called
+            pool.answer()
+            response = deferred_result(d)
+            self.assertEqualResponse(self.response, response)
+            assert 'cached' in response.flags
+            mw.storage.pool = mw.storage.syncpool
+
+    def test_batched_writes(self):
+        request2 = Request('http://www.example.com/2')
+        response2 = self.response.replace(body=b'other body')
+        with self._storage(HTTPCACHE_REMOTE_BATCH_SIZE=3) as storage:
+            storage.store_response(self.spider, self.request, self.response)
+            storage.flush()
+            storage.pool = pool = DeferredPool(self.server)
+            storage.update_metadata(self.spider, self.request, self.response, {'x': 1})
+            storage.update_metadata(self.spider, request2, response2)
+            storage.delete_response(self.spider, '0' * 40)
+            self.assertEqual(pool.requests, [])
+            d = storage.close_spider(self.spider)
+            self.assertEqual(pool.answer()[1], {'keys': ['0' * 40]})
+            # updates without the body, but for responses the server misses
+            path, body = pool.answer()
+            self.assertEqual(path, '/example.com/put')
+            assert not any('body' in entry['response'] for entry in body['entries'])
+            path, body = pool.answer()
+            self.assertEqual([entry['response']['body'] for entry in body['entries']],
+                             [b'other body'])
+            deferred_result(d)
+            storage.open_spider(self.spider)
+            storage.pool = storage.syncpool
+            cached = storage.retrieve_response(self.spider, self.request)
+            self.assertEqualResponse(self.response, cached)
+            self.assertEqual(cached.cache_metadata['x'], 1)
+            self.assertEqualResponse(response2, storage.retrieve_response(self.spider, request2))
+
+    def test_server_requests(self):
+        pool = InProcessPool(self.server)
+        self.assertRaises(RemoteCacheError, pool.request, 'POST', '/example.com/unknown')
+        self.assertRaises(RemoteCacheError, pool.request, 'POST', '/example.com/get', b'{')
+        body = b'{"entries": [{"method": "delete_response"}]}'
+        self.assertRaises(RemoteCacheError, pool.request, 'POST', '/example.com/put', body)
+        self.assertEqual(loads(pool.request('POST', '/example.com/get',
+                                            dumps({'keys': ['0' * 40]}))),
+                         {'responses': {'0' * 40: None}})
+        # spider names are file names of the server storage
+        for name in ('..', '.hidden', 'a b'):
+            self.assertRaises(RemoteCacheError, pool.request, 'POST', '/%s/get' % name,
+                              dumps({'keys': []}))
+        self.assertEqual(list(self.server.spiders), ['example.com'])
+
+    def test_server_hints(self):
+        pool = InProcessPool(self.server)
+        response = encode_response(self.response)
+        response['hints'] = {'class': 'tests.mocks.dummydbm.DummyDB'}
+        pool.request('POST', '/example.com/put', dumps({'entries': [{
+            'method': 'store_response',
+            'request': encode_request(self.request),
+            'response': response,
+            'metadata': {},
+        }]}))
+        key = request_fingerprint(self.request)
+        data = loads(pool.request('POST', '/example.com/get', dumps({'keys': [key]})))
+        # as the server picks it
+        self.assertEqual(data['responses'][key]['hints']['class'],
+                         'scrapy.http.response.html.HtmlResponse')
+
+    def test_entries_pages(self):
+        requests = [Request('http://www.example.com/%d' % i) for i in range(10)]
+        self.server.page_size = 3
+        with self._storage() as storage:
+            for request in requests:
+                storage.store_response(self.spider, request, self.response)
+            self.assertEqual(sorted(key for key, _ in storage.iter_entries(self.spider)),
+                             sorted(request_fingerprint(r) for r in requests))
+            parts = [list(storage.iter_partition(self.spider, partition, 2))
+                     for partition in range(2)]
+            self.assertEqual(sum(len(part) for part in parts), len(requests))
+
+
+class WarcStorageTest(DefaultStorageTest):
+
+    storage_class = 'scrapy_httpcache.storage.WarcCacheStorage'
+    blob_storage = False
+
+    def _warc_path(self, serial=0):
+        return os.path.join(self.tmpdir, '%s.warc' % self.spider.name,
+                            '%s-%05d.warc.gz' % (self.spider.name, serial))
+
+    def test_archive(self):
+        with self._storage() as storage:
+            storage.store_response(self.spider, self.request, self.response)
+        records = list(iter_warc_records(self._warc_path()))
+        self.assertEqual([h[b'WARC-Type'] for h, _ in records],
+                         [b'warcinfo', b'response', b'request'])
+        (response, rblock), (request, qblock) = records[1:]
+        self.assertEqual(response[b'WARC-Target-URI'], b'http://www.example.com')
+        self.assertEqual(request[b'WARC-Concurrent-To'], response[b'WARC-Record-ID'])
+        assert rblock.startswith(b'HTTP/1.1 202 Accepted\r\n')
+        assert rblock.endswith(b'\r\n\r\ntest body')
+        assert qblock.startswith(b'GET / HTTP/1.1\r\nHost: www.example.com\r\n')
+
+    def test_index(self):
+        request2 = Request('http://www.example.com/2')
+        with self._storage() as storage:
+            storage.store_response(self.spider, self.request, self.response)
+            storage.store_response(self.spider, request2, self.response)
+            storage.delete_response(self.spider, request_fingerprint(request2))
+        # read back from the index on the next run
+        with self._storage(HTTPCACHE_EXPIRATION_SECS=0) as storage:
+            self.assertEqualResponse(self.response,
+                                     storage.retrieve_response(self.spider, self.request))
+            assert storage.retrieve_response(self.spider, request2) is None
+            self.assertEqual(list(storage.iter_entries(self.spider)),
+                             [(request_fingerprint(self.request), len(self.response.body))])
+
+    def test_rotation(self):
+        with self._storage(HTTPCACHE_WARC_MAX_SIZE=1) as storage:
+            for i in range(3):
+                storage.store_response(self.spider, Request('http://www.example.com/%d' % i),
+                                       self.response)
+            for i in range(3):
+                cached = storage.retrieve_response(self.spider,
+                                                   Request('http://www.example.com/%d' % i))
+                self.assertEqual(cached.body, self.response.body)
+        assert os.path.exists(self._warc_path(2))
+        assert not os.path.exists(self._warc_path(3))
+
+    def test_compact(self):
+        requests = [Request('http://www.example.com/%d' % i) for i in range(3)]
+        with self._storage(HTTPCACHE_EXPIRATION_SECS=0) as storage:
+            responses = [self.response.replace(url=r.url) for r in requests]
+            for request, response in zip(requests, responses):
+                storage.store_response(self.spider, request, response)
+            storage.update_metadata(self.spider, requests[0], responses[0])
+            storage.delete_response(self.spider, request_fingerprint(requests[1]))
+            assert storage.compact(self.spider) > 0
+            self.assertEqualResponse(responses[0],
+                                     storage.retrieve_response(self.spider, requests[0]))
+            assert storage.retrieve_response(self.spider, requests[1]) is None
+            storage.store_response(self.spider, requests[1], responses[1])
+        # in the order responses were first stored, with their request
+        records = list(iter_warc_records(self._warc_path()))
+        self.assertEqual([(h[b'WARC-Type'], h.get(b'WARC-Target-URI')) for h, _ in records], [
+            (b'warcinfo', None),
+            (b'response', b'http://www.example.com/0'),
+            (b'request', b'http://www.example.com/0'),
+            (b'response', b'http://www.example.com/2'),
+            (b'request', b'http://www.example.com/2'),
+            (b'response', b'http://www.example.com/1'),
+            (b'request', b'http://www.example.com/1'),
+        ])
+        with self._storage(HTTPCACHE_EXPIRATION_SECS=0) as storage:
+            self.assertEqual([key for key, _ in storage.iter_entries(self.spider)],
+                             [request_fingerprint(requests[i]) for i in (0, 2, 1)])
+
+    def test_import(self):
+        # request records before or after their response, or missing
+        post = warc_record(b'request', b'POST /form HTTP/1.1\r\nHost: www.example.com\r\n'
+                                       b'\r\nq=1', [
+            (b'WARC-Record-ID', b'<urn:uuid:1>'),
+            (b'WARC-Concurrent-To', b'<urn:uuid:2>'),
+            (b'WARC-Target-URI', b'http://www.example.com/form'),
+        ])
+        chunked = warc_record(b'response', b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n'
+                                           b'Transfer-Encoding: chunked\r\n\r\n'
+                                           b'4\r\nform\r\n5\r\n body\r\n0\r\n\r\n', [
+            (b'WARC-Record-ID', b'<urn:uuid:2>'),
+            (b'WARC-Target-URI', b'http://www.example.com/form'),
+        ], timestamp=1000000000)
+        page = warc_record(b'response', b'HTTP/1.0 404 Not Found\r\n\r\nmissing', [
+            (b'WARC-Record-ID', b'<urn:uuid:3>'),
+            (b'WARC-Target-URI', b'http://www.example.com/missing'),
+        ])
+        path = os.path.join(self.tmpdir, 'import.warc')
+        with open(path, 'wb') as f:
+            f.write(post + chunked + page)
+        with self._storage(HTTPCACHE_EXPIRATION_SECS=0) as storage:
+            self.assertEqual(storage.import_warc(self.spider, path), 2)
+            request = Request('http://www.example.com/form', method='POST', body=b'q=1')
+            cached = storage.retrieve_response(self.spider, request)
+            self.assertEqual((cached.status, cached.body), (200, b'form body'))
+            assert isinstance(cached, HtmlResponse)
+            assert b'Transfer-Encoding' not in cached.headers
+            self.assertEqual(cached.cache_timestamp, 1000000000)
+            cached = storage.retrieve_response(self.spider,
+                                               Request('http://www.example.com/missing'))
+            self.assertEqual((cached.status, cached.body), (404, b'missing'))
+        # and back from the WARC files of the cache
+        path = os.path.join(self.tmpdir, 'import.warc.gz')
+        shutil.copy(self._warc_path(), path)
+        self.spider = self.crawler._create_spider('other.example.com')
+        with self._storage() as storage:
+            self.assertEqual(storage.import_warc(self.spider, path), 2)
+
+
 # TODO:
 # https://github.com/mongomock/mongomock
 # https://github.com/mdomke/pytest-mongodb
@@ -204,6 +997,40 @@ class MongodbStorageTest(DefaultStorageTest):
 '''
 
 
+class GridFSFile(object):
+    """A GridFS file, with attributes read back from BSON (text, not bytes)."""
+
+    def __init__(self, body, attributes):
+        self.__dict__.update(json.loads(json.dumps(attributes)))
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class InMemoryGridFS(dict):
+
+    def put(self, body, **attributes):
+        self[attributes['_id']] = GridFSFile(body, attributes)
+
+
+class MongodbHeadersTest(_BaseTest):
+
+    def test_headers(self):
+        from scrapy_httpcache.storage.mongodb import MongodbCacheStorage
+        # without a MongoDB server
+        storage = MongodbCacheStorage.__new__(MongodbCacheStorage)
+        CacheStorage.__init__(storage, self._get_settings())
+        storage.fs = {self.spider: InMemoryGridFS()}
+        response = self.response.replace(headers={'Content-Type': 'text/html; charset=latin-1',
+                                                  'X-Test': ['a', b'\xe9']})
+        storage.store_response(self.spider, self.request, response)
+        cached = storage.retrieve_response(self.spider, self.request)
+        self.assertEqualResponse(response, cached)
+        self.assertEqual(cached.headers[b'Content-Type'], b'text/html; charset=latin-1')
+        self.assertEqual(cached.headers.getlist('x-test'), [b'a', b'\xe9'])
+
+
 class DummyPolicyTest(_BaseTest):
 
     policy_class = 'scrapy_httpcache.policy.DummyPolicy'
@@ -236,6 +1063,56 @@ class DummyPolicyTest(_BaseTest):
             self.assertEqualResponse(res, cached)
             assert 'cached' in cached.flags
 
+    def test_expired_revalidation(self):
+        with self._middleware() as mw:
+            req0 = Request('http://example.com/etag')
+            res0 = Response(req0.url, body=b'foo', headers={'ETag': 'foo'})
+            req1 = Request('http://example.com/changed')
+            res1 = Response(req1.url, body=b'foo', headers={'Last-Modified': self.yesterday})
+            req2 = Request('http://example.com/novalidators')
+            res2 = Response(req2.url, body=b'foo')
+            for req, res in ((req0, res0), (req1, res1), (req2, res2)):
+                mw.process_request(req, self.spider)
+                mw.process_response(req, res, self.spider)
+            time.sleep(1.5)  # wait for cache to expire
+
+            # expired entries are revalidated
+            assert mw.process_request(req0, self.spider) is None
+            self.assertEqual(req0.headers[b'If-None-Match'], b'foo')
+            res3 = mw.process_response(req0, Response(req0.url, status=304), self.spider)
+            self.assertEqual(res3.status, 200)
+            self.assertEqual(res3.body, b'foo')
+            assert 'cached' in res3.flags and 'expired' not in res3.flags
+            # and fresh again once revalidated
+            res4 = mw.process_request(Request(req0.url), self.spider)
+            assert 'cached' in res4.flags and 'expired' not in res4.flags
+
+            # changed since
+            assert mw.process_request(req1, self.spider) is None
+            self.assertEqual(req1.headers[b'If-Modified-Since'], to_bytes(self.yesterday))
+            res5 = res1.replace(body=b'bar')
+            self.assertIs(mw.process_response(req1, res5, self.spider), res5)
+            self.assertEqual(mw.storage.retrieve_response(self.spider, req1).body, b'bar')
+
+            # expired entries without validators are downloaded again
+            assert mw.process_request(req2, self.spider) is None
+            assert 'cached_response' not in req2.meta
+
+            stats = self.crawler.stats.get_stats(self.spider)
+            self.assertEqual(stats['httpcache/expired'], 3)
+            self.assertEqual(stats['httpcache/revalidate'], 1)
+            self.assertEqual(stats['httpcache/invalidate'], 1)
+
+    def test_expired_download_error(self):
+        with self._middleware() as mw:
+            req0 = Request('http://example.com')
+            res0 = Response(req0.url, body=b'foo', headers={'ETag': 'foo'})
+            mw.process_request(req0, self.spider)
+            mw.process_response(req0, res0, self.spider)
+            time.sleep(1.5)  # wait for cache to expire
+            assert mw.process_request(req0, self.spider) is None
+            assert mw.process_exception(req0, mw.DOWNLOAD_EXCEPTIONS[0](), self.spider) is None
+
     def test_middleware_ignore_missing(self):
         with self._middleware(HTTPCACHE_IGNORE_MISSING=True) as mw:
             self.assertRaises(IgnoreRequest, mw.process_request, self.request, self.spider)
@@ -522,6 +1399,82 @@ class RFC2616PolicyTest(DefaultStorageTest):
                 else:
                     assert 'cached' in res5.flags
 
+    def test_cached_metadata(self):
+        with self._middleware() as mw:
+            req0 = Request('http://example.com')
+            res0 = Response(req0.url, status=200, headers={
+                'Date': self.today, 'Cache-Control': 'max-age=600', 'ETag': 'foo'})
+            self._process_requestresponse(mw, req0, res0)
+            cached = mw.storage.retrieve_response(self.spider, req0)
+            metadata = cached.cache_metadata
+            self.assertEqual(metadata['freshness_lifetime'], 600)
+            self.assertEqual(metadata['expires'], metadata['date'] + 600)
+            self.assertEqual(metadata['etag'], b'foo')
+            # freshness is decided from metadata, not from headers
+            del cached.headers['Cache-Control']
+            del cached.headers['Date']
+            assert mw.policy.is_cached_response_fresh(cached, req0)
+            cached.cache_metadata = dict(metadata, date=metadata['date'] - 601)
+            req1 = req0.copy()
+            assert not mw.policy.is_cached_response_fresh(cached, req1)
+            self.assertEqual(req1.headers[b'If-None-Match'], b'foo')
+            # headers are parsed when metadata is missing
+            cached.cache_metadata = {}
+            assert not mw.policy.is_cached_response_fresh(cached, req0)
+
+    def test_cached_metadata_without_date(self):
+        with self._policy() as policy:
+            res0 = Response('http://example.com', headers={'Date': 'garbage'})
+            self.assertEqual(policy.get_cache_metadata(res0, self.request), {})
+
+    def test_freshen_on_revalidation(self):
+        with self._middleware() as mw:
+            req0 = Request('http://example.com')
+            res0 = Response(req0.url, body=b'foo', headers={
+                'Date': self.yesterday, 'Age': '10', 'ETag': 'foo',
+                'Cache-Control': 'max-age=600', 'X-Foo': 'foo'})
+            self._process_requestresponse(mw, req0, res0)
+            # stale, the server says it has not changed
+            res1 = Response(req0.url, status=304, headers={
+                'Date': self.today, 'Cache-Control': 'max-age=600',
+                'X-Foo': 'bar', 'Content-Length': '0'})
+            res2 = self._process_requestresponse(mw, req0, res1)
+            self.assertEqual(res2.status, 200)
+            self.assertEqual(res2.body, b'foo')
+            self.assertEqual(res2.headers[b'X-Foo'], b'bar')
+            self.assertEqual(res2.headers[b'Date'], to_bytes(self.today))
+            self.assertNotIn(b'Age', res2.headers)
+            self.assertNotIn(b'Content-Length', res2.headers)
+            # the stored entry is fresh again, no further round trip
+            cached = mw.storage.retrieve_response(self.spider, req0)
+            self.assertEqualResponse(res2, cached)
+            res3 = mw.process_request(Request('http://example.com'), self.spider)
+            assert 'cached' in res3.flags
+            stats = self.crawler.stats.get_stats(self.spider)
+            self.assertEqual(stats['httpcache/update'], 1)
+            self.assertEqual(stats['httpcache/store'], 1)
+
+    def test_unchanged_body(self):
+        with self._middleware() as mw:
+            req0 = Request('http://example.com')
+            res0 = Response(req0.url, body=b'foo', headers={'Cache-Control': 'max-age=0'})
+            self._process_requestresponse(mw, req0, res0)
+            # stale, refetched with the same body
+            res1 = res0.replace(headers={'Cache-Control': 'max-age=0', 'X-Foo': 'bar'})
+            res2 = self._process_requestresponse(mw, req0, res1)
+            self.assertIs(res2, res1)
+            cached = mw.storage.retrieve_response(self.spider, req0)
+            self.assertEqual(cached.headers[b'X-Foo'], b'bar')
+            # refetched with another body
+            res3 = res0.replace(body=b'bar')
+            self._process_requestresponse(mw, req0, res3)
+            self.assertEqual(mw.storage.retrieve_response(self.spider, req0).body, b'bar')
+            stats = self.crawler.stats.get_stats(self.spider)
+            self.assertEqual(stats['httpcache/revalidate'], 1)
+            self.assertEqual(stats['httpcache/invalidate'], 1)
+            self.assertEqual(stats['httpcache/update'], 1)
+            self.assertEqual(stats['httpcache/store'], 2)
+
     def test_process_exception(self):
         with self._middleware() as mw:
             res0 = Response(self.request.url, headers={'Expires': self.yesterday})
@@ -560,5 +1513,991 @@ class RFC2616PolicyTest(DefaultStorageTest):
                 assert 'cached' in res2.flags
 
 
+class RFC9111PolicyTest(RFC2616PolicyTest):
+
+    policy_class = 'scrapy_httpcache.policy.RFC9111Policy'
+
+    def _revalidating_middleware(self, **new_settings):
+        scheduled = []
+
+        class Engine(object):
+            def crawl(self, request, spider=None):
+                scheduled.append(request)
+
+        self.crawler.engine = Engine()
+        settings = self._get_settings(**new_settings)
+        mw = HttpCacheMiddleware(settings, self.crawler.stats, self.crawler)
+        return mw, scheduled
+
+    def test_stale_while_revalidate(self):
+        mw, scheduled = self._revalidating_middleware()
+        mw.spider_opened(self.spider)
+        try:
+            date = email.utils.formatdate(time.time() - 10)
+            req0 = Request('http://example.com', meta={'foo': 'bar'})
+            res0 = Response(req0.url, status=200, headers={
+                'Date': date, 'ETag': 'foo',
+                'Cache-Control': 'max-age=5, stale-while-revalidate=60'})
+            self._process_requestresponse(mw, req0, res0)
+
+            # stale response is served at once, revalidation is scheduled
+            res1 = mw.process_request(req0, self.spider)
+            self.assertEqualResponse(res0, res1)
+            assert 'cached' in res1.flags and 'stale' in res1.flags
+            assert b'If-None-Match' not in req0.headers
+            self.assertEqual(len(scheduled), 1)
+            req1 = scheduled[0]
+            self.assertEqual(req1.headers[b'If-None-Match'], b'foo')
+            self.assertEqual(req1.meta['foo'], 'bar')
+            assert req1.dont_filter
+
+            # only one revalidation at a time for the same resource
+            mw.process_request(req0, self.spider)
+            self.assertEqual(len(scheduled), 1)
+
+            # revalidation goes to the network and its result never
+            # reaches the spider
+            assert mw.process_request(req1, self.spider) is None
+            res2 = res0.replace(status=200, body=b'new', headers={
+                'Cache-Control': 'max-age=5, stale-while-revalidate=60'})
+            self.assertRaises(IgnoreRequest, mw.process_response, req1, res2, self.spider)
+            res3 = mw.process_request(req0, self.spider)
+            self.assertEqual(res3.body, b'new')
+            assert 'stale' not in res3.flags
+            stats = self.crawler.stats.get_stats(self.spider)
+            self.assertEqual(stats['httpcache/stale_while_revalidate'], 2)
+            self.assertEqual(stats['httpcache/background_revalidation'], 1)
+        finally:
+            mw.spider_closed(self.spider)
+
+    def test_stale_while_revalidate_failure(self):
+        mw, scheduled = self._revalidating_middleware()
+        mw.spider_opened(self.spider)
+        try:
+            date = email.utils.formatdate(time.time() - 10)
+            req0 = Request('http://example.com')
+            res0 = Response(req0.url, status=200, headers={
+                'Date': date, 'Cache-Control': 'max-age=5, stale-while-revalidate=60'})
+            self._process_requestresponse(mw, req0, res0)
+            mw.process_request(req0, self.spider)
+            req1 = scheduled.pop()
+            assert mw.process_request(req1, self.spider) is None
+            self.assertRaises(IgnoreRequest, mw.process_exception, req1,
+                              mw.DOWNLOAD_EXCEPTIONS[0](), self.spider)
+            # can be scheduled again
+            mw.process_request(req0, self.spider)
+            self.assertEqual(len(scheduled), 1)
+        finally:
+            mw.spider_closed(self.spider)
+
+    def test_stale_while_revalidate_window(self):
+        sampledata = [
+            # beyond the stale-while-revalidate window
+            {'Cache-Control': 'max-age=5, stale-while-revalidate=2'},
+            # must-revalidate forbids serving stale responses
+            {'Cache-Control': 'max-age=5, stale-while-revalidate=60, must-revalidate'},
+        ]
+        with self._middleware() as mw:
+            for idx, headers in enumerate(sampledata):
+                req0 = Request('http://example-%d.com' % idx)
+                headers = dict(headers, Date=email.utils.formatdate(time.time() - 10))
+                res0 = Response(req0.url, status=200, headers=headers)
+                self._process_requestresponse(mw, req0, res0)
+                assert mw.process_request(req0, self.spider) is None
+        # request max-age asks for a fresh response
+        with self._middleware() as mw:
+            req0 = Request('http://example.com')
+            res0 = Response(req0.url, status=200, headers={
+                'Date': email.utils.formatdate(time.time() - 10),
+                'Cache-Control': 'max-age=5, stale-while-revalidate=60'})
+            self._process_requestresponse(mw, req0, res0)
+            req1 = req0.replace(headers={'Cache-Control': 'max-age=8'})
+            assert mw.process_request(req1, self.spider) is None
+
+    def test_stale_if_error(self):
+        sampledata = [
+            # within the response stale-if-error window
+            ({'Cache-Control': 'max-age=5, stale-if-error=60, must-revalidate'}, {}, True),
+            # beyond the response stale-if-error window
+            ({'Cache-Control': 'max-age=5, stale-if-error=2'}, {}, False),
+            # the request window takes precedence
+            ({'Cache-Control': 'max-age=5, stale-if-error=60'},
+             {'Cache-Control': 'stale-if-error=2'}, False),
+            ({'Cache-Control': 'max-age=5, must-revalidate'},
+             {'Cache-Control': 'stale-if-error=60'}, True),
+        ]
+        with self._middleware() as mw:
+            for idx, (headers, reqheaders, usable) in enumerate(sampledata):
+                req0 = Request('http://example-%d.com' % idx, headers=reqheaders)
+                headers = dict(headers, Date=email.utils.formatdate(time.time() - 10))
+                res0 = Response(req0.url, status=200, headers=headers)
+                self._process_requestresponse(mw, req0, res0)
+                # server errors
+                res1 = self._process_requestresponse(mw, req0, res0.replace(status=503))
+                self.assertEqual('cached' in res1.flags, usable)
+                # download errors
+                assert mw.process_request(req0, self.spider) is None
+                res2 = mw.process_exception(req0, mw.DOWNLOAD_EXCEPTIONS[0](), self.spider)
+                self.assertEqual(res2 is not None, usable)
+
+
+class AdaptivePolicyTest(_BaseTest):
+
+    policy_class = 'scrapy_httpcache.policy.AdaptivePolicy'
+
+    def test_change_rate(self):
+        with self._policy() as policy:
+            self.assertIsNone(policy.get_change_rate({}))
+            stable = policy.get_change_rate({'checks': 10, 'changes': 0, 'observed': 36000})
+            volatile = policy.get_change_rate({'checks': 10, 'changes': 9, 'observed': 36000})
+            assert 0 < stable < volatile
+            # more observations of an unchanged page lower its estimate
+            self.assertLess(stable, policy.get_change_rate(
+                {'checks': 2, 'changes': 0, 'observed': 7200}))
+
+    def test_adaptive_lifetime(self):
+        with self._policy(HTTPCACHE_ADAPTIVE_MIN_LIFETIME=0) as policy:
+            date = int(time.time()) - 7200
+            req0 = Request('http://example.com')
+            res0 = Response(req0.url, headers={
+                'Date': email.utils.formatdate(date), 'ETag': 'foo', 'Cache-Control': 'max-age=600'})
+            metadata = policy.get_cache_metadata(res0, req0)
+            # nothing learnt yet, lifetime from the headers
+            self.assertEqual(metadata['freshness_lifetime'], 600)
+            self.assertNotIn('checks', metadata)
+
+            # revalidated an hour later, same content
+            res0.cache_metadata = metadata
+            res1 = res0.replace(headers={
+                'Date': email.utils.formatdate(date + 3600), 'ETag': 'foo',
+                'Cache-Control': 'max-age=600'})
+            unchanged = policy.get_cache_metadata(res1, req0, res0)
+            self.assertEqual(unchanged['checks'], 1)
+            self.assertEqual(unchanged['changes'], 0)
+            self.assertEqual(unchanged['observed'], 3600)
+            self.assertEqual(unchanged['date'], date + 3600)
+            self.assertEqual(unchanged['etag'], b'foo')
+
+            # changed an hour later
+            res2 = res1.replace(body=b'changed')
+            changed = policy.get_cache_metadata(res2, req0, res0)
+            self.assertEqual(changed['checks'], 1)
+            self.assertEqual(changed['changes'], 1)
+            self.assertLess(changed['freshness_lifetime'], unchanged['freshness_lifetime'])
+
+            # stable pages are revisited less often over time
+            res1.cache_metadata = unchanged
+            res3 = res1.replace(headers={
+                'Date': email.utils.formatdate(date + 7200), 'ETag': 'foo'})
+            stable = policy.get_cache_metadata(res3, req0, res1)
+            self.assertGreater(stable['freshness_lifetime'], unchanged['freshness_lifetime'])
+
+    def test_lifetime_bounds(self):
+        settings = {
+            'HTTPCACHE_ADAPTIVE_MIN_LIFETIME': 100,
+            'HTTPCACHE_ADAPTIVE_MAX_LIFETIME': 1000,
+        }
+        with self._policy(**settings) as policy:
+            res0 = Response('http://example.com', headers={'Date': self.today, 'ETag': 'foo'})
+            self.assertEqual(policy.get_cache_metadata(res0, self.request)['freshness_lifetime'], 100)
+            res0 = res0.replace(headers={'Date': self.today, 'Cache-Control': 'max-age=86400'})
+            self.assertEqual(policy.get_cache_metadata(res0, self.request)['freshness_lifetime'], 1000)
+
+    def test_middleware(self):
+        with self._middleware() as mw:
+            req0 = Request('http://example.com')
+            res0 = Response(req0.url, headers={'Date': self.yesterday, 'ETag': 'foo'})
+            mw.process_request(req0, self.spider)
+            mw.process_response(req0, res0, self.spider)
+            # stale, revalidated and found unchanged
+            assert mw.process_request(req0, self.spider) is None
+            self.assertEqual(req0.headers[b'If-None-Match'], b'foo')
+            res1 = Response(req0.url, status=304, headers={'Date': self.today})
+            res2 = mw.process_response(req0, res1, self.spider)
+            assert 'cached' in res2.flags
+            metadata = mw.storage.retrieve_response(self.spider, req0).cache_metadata
+            self.assertEqual(metadata['checks'], 1)
+            self.assertEqual(metadata['changes'], 0)
+            self.assertGreater(metadata['freshness_lifetime'], 3600)
+            # fresh again
+            req1 = Request('http://example.com')
+            assert 'cached' in mw.process_request(req1, self.spider).flags
+
+
+class ExpirationRulesTest(unittest.TestCase):
+
+    def test_default(self):
+        rules = ExpirationRules(30)
+        self.assertEqual(rules.get_expiration_secs(), 30)
+        self.assertEqual(rules.get_expiration_secs(Request('http://example.com')), 30)
+
+    def test_domains(self):
+        rules = ExpirationRules(30, domains={
+            'example.com': 60,
+            'news.example.com': 10,
+            '.Example.org': 0,
+        })
+        for url, secs in [
+            ('http://example.com/', 60),
+            ('http://www.example.com/', 60),
+            ('http://news.example.com/', 10),
+            ('http://a.news.example.com/', 10),
+            ('http://othernews.example.com/', 60),
+            ('http://notexample.com/', 30),
+            ('http://example.org/', 0),
+            ('http://WWW.EXAMPLE.ORG/', 0),
+            ('http://com/', 30),
+        ]:
+            self.assertEqual(rules.get_expiration_secs(Request(url)), secs, url)
+
+    def test_patterns(self):
+        rules = ExpirationRules(30, domains={'example.com': 60}, patterns=[
+            (r'/search\?', 5),
+            (r'^https://', 20),
+            (r'q=', 15),
+        ])
+        for url, secs in [
+            ('http://example.com/search?q=foo', 5),
+            ('https://example.com/search?q=foo', 5),
+            ('https://example.com/', 20),
+            ('http://example.com/?q=foo', 15),
+            ('http://example.com/search', 60),
+            ('http://example.net/', 30),
+        ]:
+            self.assertEqual(rules.get_expiration_secs(Request(url)), secs, url)
+
+    def test_many_rules(self):
+        domains = dict(('site%d.example.com' % i, i) for i in range(1, 5000))
+        patterns = [('/section%d/' % i, i) for i in range(1, 2000)]
+        rules = ExpirationRules(0, domains=domains, patterns=patterns)
+        self.assertEqual(rules.get_expiration_secs(Request('http://a.site1234.example.com/')), 1234)
+        self.assertEqual(rules.get_expiration_secs(Request('http://x.com/section1999/')), 1999)
+        self.assertEqual(rules.get_expiration_secs(Request('http://x.com/section0/')), 0)
+
+    def test_regex_patterns(self):
+        rules = ExpirationRules(30, patterns=[
+            (r'(?i)/search', 5),
+            (r'/(\w+)/\1/', 10),
+            (r'^http://example\.com/', 20),
+            (r'', 40),
+        ])
+        for url, secs in [
+            ('http://example.com/SEARCH', 5),
+            ('http://example.com/a/a/', 10),
+            ('http://example.com/a/b/', 20),
+            ('http://www.example.com/a/b/', 40),
+        ]:
+            self.assertEqual(rules.get_expiration_secs(Request(url)), secs, url)
+        with self.assertRaises(ValueError) as cm:
+            ExpirationRules(30, patterns=[('(', 5)])
+        self.assertIn("Invalid expiration pattern '('", str(cm.exception))
+
+    def test_many_rules_cost(self):
+        # literal patterns are looked up in one pass, whatever their number
+        request = Request('http://www.example.com/some/path/to/a/page?id=12345&sort=desc')
+
+        def cost(count):
+            rules = ExpirationRules(0, patterns=[('/section%d/' % i, i) for i in range(count)])
+            return min(timeit.repeat(lambda: rules.get_expiration_secs(request),
+                                     number=200, repeat=5))
+
+        self.assertLess(cost(5000), 5 * cost(5))
+
+    def test_meta(self):
+        rules = ExpirationRules(30, domains={'example.com': 60}, patterns={'/': 20})
+        request = Request('http://example.com/', meta={'httpcache_expiration_secs': 0})
+        self.assertEqual(rules.get_expiration_secs(request), 0)
+
+
+class ResponseHintsTest(unittest.TestCase):
+
+    def test_hints(self):
+        response = Response('http://www.example.com/doc.txt', body=b'text',
+                            headers={'Content-Type': 'text/plain; charset=utf-8'})
+        self.assertEqual(response_hints(response),
+                         {'class': 'scrapy.http.response.text.TextResponse',
+                          'encoding': 'utf-8'})
+        self.assertEqual(response_hints(Response('http://www.example.com/a.png')),
+                         {'class': 'scrapy.http.response.Response'})
+
+    def test_build_response(self):
+        headers = dict(Headers({'Content-Type': 'text/html; charset=utf-8'}))
+        response = build_response('http://www.example.com', 200, headers, b'body',
+                                  {'class': 'scrapy.http.HtmlResponse', 'encoding': 'latin1'})
+        assert isinstance(response, HtmlResponse)
+        self.assertEqual(response.encoding, 'latin1')
+        self.assertEqual(response.headers['content-type'], b'text/html; charset=utf-8')
+        # unknown classes, or none, are sniffed from the headers
+        for hints in (None, {'class': 'os.path.join'}, {'class': 'no.such.Response'}):
+            response = build_response('http://www.example.com', 200,
+                                      {'Content-Type': 'text/html'}, b'body', hints)
+            assert isinstance(response, HtmlResponse)
+            self.assertEqual(response.headers['Content-Type'], b'text/html')
+
+
+class LazyAttributesTest(unittest.TestCase):
+
+    def test_warc_imports(self):
+        # in a new interpreter, as other tests import the cache server
+        code = ('import sys, scrapy_httpcache.storage.warc; '
+                'sys.exit("scrapy_httpcache.server" in sys.modules)')
+        self.assertEqual(subprocess.call([sys.executable, '-c', code]), 0)
+
+    def test_lazy_attributes(self):
+        import scrapy_httpcache
+        from scrapy_httpcache import storage, httpcache
+        self.assertIs(storage.SqliteCacheStorage, SqliteCacheStorage)
+        self.assertIs(httpcache.DbmCacheStorage, DbmCacheStorage)
+        self.assertIs(scrapy_httpcache.HttpCacheMiddleware, HttpCacheMiddleware)
+        self.assertEqual(scrapy_httpcache.version_info[0], int(scrapy_httpcache.__version__[0]))
+        assert 'MongodbCacheStorage' in dir(storage)
+        assert 'MongodbCacheStorage' in storage.__all__
+        self.assertRaises(AttributeError, getattr, storage, 'UnknownCacheStorage')
+
+
+class CircuitBreakerTest(_BaseTest):
+
+    def test_circuitbreaker(self):
+        now = [1000.0]
+        breaker = CircuitBreaker(2, 60, clock=lambda: now[0])
+        assert breaker.allow('a')
+        assert not breaker.failure('a')
+        assert breaker.failure('a')
+        assert breaker.is_open('a')
+        assert not breaker.allow('a')
+        assert breaker.allow('b')
+        # a single probe after the cooldown
+        now[0] += 61
+        assert breaker.allow('a')
+        assert not breaker.allow('a')
+        # a failed probe opens the breaker again
+        assert breaker.failure('a')
+        assert not breaker.allow('a')
+        now[0] += 61
+        assert breaker.allow('a')
+        breaker.success('a')
+        assert not breaker.is_open('a')
+        assert breaker.allow('a')
+
+    def test_middleware(self):
+        with self._middleware(HTTPCACHE_CIRCUIT_BREAKER_FAILURES=2) as mw:
+            now = [time.time()]
+            mw.circuitbreaker.clock = lambda: now[0]
+            req0 = Request('http://example.com/a')
+            res0 = Response(req0.url, headers={'Expires': self.yesterday})
+            mw.process_request(req0, self.spider)
+            mw.process_response(req0, res0, self.spider)
+            for _ in range(2):
+                assert mw.process_request(req0, self.spider) is None
+                res1 = mw.process_exception(req0, mw.DOWNLOAD_EXCEPTIONS[0](), self.spider)
+                assert 'cached' in res1.flags
+            # stale responses are served without attempting the network
+            res2 = mw.process_request(req0, self.spider)
+            self.assertEqualResponse(res0, res2)
+            assert 'cached' in res2.flags and 'stale' in res2.flags
+            # uncached requests still go to the network
+            assert mw.process_request(Request('http://example.com/b'), self.spider) is None
+            # a successful probe closes the breaker
+            now[0] += 61
+            assert mw.process_request(req0, self.spider) is None
+            assert mw.process_request(req0, self.spider) is not None
+            mw.process_response(req0, res0, self.spider)
+            assert not mw.circuitbreaker.is_open('example.com')
+            assert mw.process_request(req0, self.spider) is None
+            stats = self.crawler.stats.get_stats(self.spider)
+            self.assertEqual(stats['httpcache/circuitbreaker/open'], 1)
+            self.assertEqual(stats['httpcache/circuitbreaker/served'], 2)
+
+    def test_server_errors(self):
+        with self._middleware(HTTPCACHE_CIRCUIT_BREAKER_FAILURES=2,
+                              HTTPCACHE_EXPIRATION_SECS=0) as mw:
+            req0 = Request('http://example.com/a')
+            res0 = Response(req0.url, headers={'Expires': self.yesterday})
+            mw.process_request(req0, self.spider)
+            mw.process_response(req0, res0, self.spider)
+            # 5xx responses count as failures, like download errors
+            for _ in range(2):
+                assert mw.process_request(req0, self.spider) is None
+                mw.process_response(req0, Response(req0.url, status=503), self.spider)
+            assert mw.circuitbreaker.is_open('example.com')
+            res1 = mw.process_request(req0, self.spider)
+            self.assertEqualResponse(res0, res1)
+            assert 'stale' in res1.flags
+
+    def test_expired(self):
+        with self._middleware(HTTPCACHE_CIRCUIT_BREAKER_FAILURES=1,
+                              HTTPCACHE_POLICY='scrapy_httpcache.policy.DummyPolicy') as mw:
+            req0 = Request('http://example.com/a')
+            res0 = Response(req0.url, body=b'body')
+            mw.process_request(req0, self.spider)
+            mw.process_response(req0, res0, self.spider)
+            time.sleep(1.5)  # wait for cache to expire
+            assert mw.process_request(req0, self.spider) is None
+            mw.process_exception(req0, mw.DOWNLOAD_EXCEPTIONS[0](), self.spider)
+            # expired responses are served too
+            res1 = mw.process_request(req0, self.spider)
+            self.assertEqualResponse(res0, res1)
+            assert 'cached' in res1.flags and 'stale' in res1.flags
+            stats = self.crawler.stats.get_stats(self.spider)
+            self.assertEqual(stats['httpcache/circuitbreaker/served'], 1)
+
+    def test_disabled(self):
+        with self._middleware() as mw:
+            self.assertIsNone(mw.circuitbreaker)
+
+
+class CollapseRequestsTest(_BaseTest):
+
+    policy_class = 'scrapy_httpcache.policy.DummyPolicy'
+
+    def _results(self, d):
+        results = []
+        d.addCallback(results.append)
+        return results
+
+    def test_collapse(self):
+        with self._middleware(HTTPCACHE_COLLAPSE_REQUESTS=True) as mw:
+            req0 = Request('http://example.com', callback=lambda r: None)
+            req1 = Request('http://example.com', dont_filter=True)
+            assert mw.process_request(req0, self.spider) is None
+            results = self._results(mw.process_request(req1, self.spider))
+            self.assertEqual(results, [])
+            res0 = mw.process_response(req0, self.response, self.spider)
+            self.assertIs(res0, self.response)
+            res1, = results
+            assert res1 is not res0
+            self.assertEqualResponse(res0, res1)
+            assert 'cached' in res1.flags and 'cached' not in res0.flags
+            # the copy is not stored again
+            self.assertIs(mw.process_response(req1, res1, self.spider), res1)
+            stats = self.crawler.stats.get_stats(self.spider)
+            self.assertEqual(stats['httpcache/store'], 1)
+            self.assertEqual(stats['httpcache/collapsed'], 1)
+            self.assertEqual(mw._inflight, {})
+            # later requests are served from the cache
+            assert 'cached' in mw.process_request(req1, self.spider).flags
+
+    def test_collapse_failure(self):
+        with self._middleware(HTTPCACHE_COLLAPSE_REQUESTS=True) as mw:
+            req0 = Request('http://example.com')
+            assert mw.process_request(req0, self.spider) is None
+            results = self._results(mw.process_request(req0.copy(), self.spider))
+            mw.process_exception(req0, mw.DOWNLOAD_EXCEPTIONS[0](), self.spider)
+            # waiting requests go to the network on their own
+            self.assertEqual(results, [None])
+            self.assertEqual(mw._inflight, {})
+
+    def test_spider_closed(self):
+        with self._middleware(HTTPCACHE_COLLAPSE_REQUESTS=True) as mw:
+            req0 = Request('http://example.com')
+            assert mw.process_request(req0, self.spider) is None
+            results = self._results(mw.process_request(req0.copy(), self.spider))
+        self.assertEqual(results, [None])
+
+    def test_disabled(self):
+        with self._middleware() as mw:
+            req0 = Request('http://example.com')
+            assert mw.process_request(req0, self.spider) is None
+            assert mw.process_request(req0.copy(), self.spider) is None
+
+
+class ThreadClock(Clock):
+    """Clock running the calls from other threads on demand."""
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.fromthreads = queue.Queue()
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.fromthreads.put((f, args, kwargs))
+
+    def run_from_threads(self):
+        f, args, kwargs = self.fromthreads.get(timeout=10)
+        f(*args, **kwargs)
+
+    def addSystemEventTrigger(self, *args):
+        return object()
+
+    def removeSystemEventTrigger(self, trigger):
+        pass
+
+
+class WriteBehindTest(_BaseTest):
+
+    policy_class = 'scrapy_httpcache.policy.DummyPolicy'
+
+    @contextmanager
+    def _middleware(self, **new_settings):
+        new_settings.setdefault('HTTPCACHE_WRITE_BEHIND', True)
+        with super(WriteBehindTest, self)._middleware(**new_settings) as mw:
+            if mw.writequeue is not None:
+                mw.writequeue.clock = Clock()
+                mw.writequeue.threaded = False
+            yield mw
+
+    def test_write_behind(self):
+        with self._middleware() as mw:
+            storage = mw.writequeue.storage
+            assert mw.process_request(self.request, self.spider) is None
+            mw.process_response(self.request, self.response, self.spider)
+            self.assertIsNone(storage.retrieve_response(self.spider, self.request))
+            # pending writes are read from the queue
+            response = mw.process_request(self.request, self.spider)
+            self.assertEqualResponse(self.response, response)
+            assert 'cached' in response.flags
+            self.assertAlmostEqual(response.cache_timestamp, time.time(), delta=1)
+            mw.writequeue.clock.advance(1)
+            self.assertEqual(len(mw.writequeue), 0)
+            self.assertEqualResponse(self.response,
+                                     storage.retrieve_response(self.spider, self.request))
+
+    def test_coalesce(self):
+        with self._middleware() as mw:
+            queue = mw.writequeue
+            queue.store_response(self.spider, self.request, self.response)
+            response = self.response.replace(body=b'new body')
+            queue.update_metadata(self.spider, self.request, response)
+            self.assertEqual(len(queue), 1)
+            queue.flush()
+            # still stored in full, the first body was never written
+            cached = queue.storage.retrieve_response(self.spider, self.request)
+            self.assertEqual(cached.body, b'new body')
+            stats = self.crawler.stats.get_stats(self.spider)
+            self.assertEqual(stats['httpcache/writebehind/coalesced'], 1)
+            self.assertEqual(stats['httpcache/writebehind/flushed'], 1)
+
+    def test_backpressure(self):
+        with self._middleware(HTTPCACHE_WRITE_BEHIND_MAX_BYTES=5) as mw:
+            assert mw.process_request(self.request, self.spider) is None
+            d = mw.process_response(self.request, self.response, self.spider)
+            results = []
+            d.addCallback(results.append)
+            self.assertEqual(results, [])
+            mw.writequeue.clock.advance(0)
+            self.assertEqual(results, [self.response])
+            self.assertEqual(len(mw.writequeue), 0)
+            stats = self.crawler.stats.get_stats(self.spider)
+            self.assertEqual(stats['httpcache/writebehind/backpressure'], 1)
+
+    def test_writer_thread(self):
+        clock = ThreadClock()
+        with self._middleware() as mw:
+            queue = mw.writequeue
+            queue.clock, queue.threaded = clock, True
+            threads = []
+            store_response = queue.storage.store_response
+            queue.storage.store_response = lambda *args: (
+                threads.append(threading.current_thread().name), store_response(*args))
+            queue.store_response(self.spider, self.request, self.response)
+            clock.advance(1)
+            # read from the queue while written
+            self.assertEqual(len(queue), 1)
+            response = queue.retrieve_response(self.spider, self.request)
+            self.assertEqualResponse(self.response, response)
+            assert response.cache_timestamp is not None
+            d = queue.close_spider(self.spider)
+            assert isinstance(d, defer.Deferred)
+            clock.run_from_threads()
+            deferred_result(d)
+            self.assertEqual(len(threads), 1)
+            assert 'httpcache-writer' in threads[0]
+            self.assertEqual(len(queue), 0)
+            assert queue.threadpool is None
+            queue.open_spider(self.spider)
+            self.assertEqualResponse(self.response,
+                                     queue.storage.retrieve_response(self.spider, self.request))
+
+    def test_flush_on_close(self):
+        with self._middleware() as mw:
+            mw.process_request(self.request, self.spider)
+            mw.process_response(self.request, self.response, self.spider)
+        with self._middleware(HTTPCACHE_WRITE_BEHIND=False) as mw:
+            response = mw.process_request(self.request, self.spider)
+            self.assertEqualResponse(self.response, response)
+
+
+class EvictionTest(_BaseTest):
+
+    policy_class = 'scrapy_httpcache.policy.DummyPolicy'
+
+    @contextmanager
+    def _middleware(self, **new_settings):
+        new_settings.setdefault('HTTPCACHE_EXPIRATION_SECS', 0)
+        new_settings.setdefault('HTTPCACHE_MAX_ENTRIES', 2)
+        mw = HttpCacheMiddleware(self._get_settings(**new_settings), self.crawler.stats)
+        if isinstance(mw.storage, EvictingStorage):
+            mw.storage.clock = Clock()
+        mw.spider_opened(self.spider)
+        try:
+            yield mw
+        finally:
+            mw.spider_closed(self.spider)
+
+    def _requests(self, n):
+        return [Request('http://www.example.com/%d' % i) for i in range(n)]
+
+    def test_lru(self):
+        r1, r2, r3 = self._requests(3)
+        with self._middleware() as mw:
+            storage = mw.storage
+            storage.store_response(self.spider, r1, self.response)
+            storage.store_response(self.spider, r2, self.response)
+            storage.retrieve_response(self.spider, r1)
+            storage.store_response(self.spider, r3, self.response)
+            self.assertEqual(len(storage), 3)
+            storage.clock.advance(0)
+            self.assertEqual(len(storage), 2)
+            assert storage.retrieve_response(self.spider, r2) is None
+            assert storage.retrieve_response(self.spider, r1) is not None
+        stats = self.crawler.stats.get_stats(self.spider)
+        self.assertEqual(stats['httpcache/eviction/evicted'], 1)
+        self.assertEqual(stats['httpcache/eviction/entries'], 2)
+        self.assertEqual(stats['httpcache/eviction/size'], 2 * len(self.response.body))
+
+    def test_lfu(self):
+        r1, r2, r3 = self._requests(3)
+        with self._middleware(HTTPCACHE_EVICTION_POLICY='lfu') as mw:
+            storage = mw.storage
+            storage.store_response(self.spider, r1, self.response)
+            storage.retrieve_response(self.spider, r1)
+            storage.store_response(self.spider, r2, self.response)
+            storage.store_response(self.spider, r3, self.response)
+            storage.clock.advance(0)
+            assert storage.retrieve_response(self.spider, r2) is None
+            assert storage.retrieve_response(self.spider, r1) is not None
+
+    def test_max_size(self):
+        requests = self._requests(3)
+        size = len(self.response.body)
+        with self._middleware(HTTPCACHE_MAX_ENTRIES=0, HTTPCACHE_MAX_SIZE=2 * size) as mw:
+            for request in requests:
+                mw.storage.store_response(self.spider, request, self.response)
+            mw.storage.clock.advance(0)
+            self.assertEqual(mw.storage.size, 2 * size)
+            assert mw.storage.retrieve_response(self.spider, requests[0]) is None
+
+    def test_previous_entries(self):
+        requests = self._requests(4)
+        with self._middleware(HTTPCACHE_MAX_ENTRIES=0) as mw:
+            assert not isinstance(mw.storage, EvictingStorage)
+            for request in requests[:3]:
+                mw.storage.store_response(self.spider, request, self.response)
+        with self._middleware(HTTPCACHE_EVICTION_BATCH_SIZE=1) as mw:
+            storage = mw.storage
+            storage.retrieve_response(self.spider, requests[0])
+            storage.store_response(self.spider, requests[3], self.response)
+            # found one entry at a time, entries of the previous run go first
+            storage.clock.advance(0)
+            storage.clock.advance(0)
+            storage.clock.advance(0)
+            storage.clock.advance(0)
+            self.assertEqual(len(storage), 2)
+            assert storage.retrieve_response(self.spider, requests[0]) is not None
+            assert storage.retrieve_response(self.spider, requests[3]) is not None
+
+    def test_multiple_spiders(self):
+        spider2 = Spider('example.net')
+        r1, r2, r3 = self._requests(3)
+        with self._middleware() as mw:
+            storage = mw.storage
+            storage.open_spider(spider2)
+            try:
+                storage.store_response(self.spider, r1, self.response)
+                storage.store_response(spider2, r1, self.response)
+                storage.store_response(spider2, r2, self.response)
+                storage.store_response(spider2, r3, self.response)
+                storage.clock.advance(0)
+                # bounded for each spider
+                self.assertEqual(len(storage), 3)
+                assert storage.retrieve_response(self.spider, r1) is not None
+                assert storage.retrieve_response(spider2, r1) is None
+            finally:
+                storage.close_spider(spider2)
+            self.assertEqual(len(storage), 1)
+            stats = self.crawler.stats
+            self.assertEqual(stats.get_value('httpcache/eviction/entries', spider=spider2), 2)
+
+
+class AdmissionTest(_BaseTest):
+
+    policy_class = 'scrapy_httpcache.policy.DummyPolicy'
+
+    def _download(self, mw, request, response):
+        assert mw.process_request(request, self.spider) is None
+        mw.process_response(request, response, self.spider)
+        return mw.storage.retrieve_response(self.spider, request)
+
+    def test_disabled(self):
+        with self._middleware() as mw:
+            assert mw.admission is None
+
+    def test_frequency_sketch(self):
+        sketch = FrequencySketch(width=16)
+        key = request_fingerprint(self.request)
+        self.assertEqual(sketch.estimate(key), 0)
+        self.assertEqual(sketch.add(key), 1)
+        self.assertEqual(sketch.add(key), 2)
+        for _ in range(20):
+            sketch.add(key)
+        self.assertEqual(sketch.estimate(key), FrequencySketch.MAX_COUNT)
+        sketch.reset()
+        self.assertEqual(sketch.estimate(key), FrequencySketch.MAX_COUNT // 2)
+
+    def test_frequency(self):
+        with self._middleware(HTTPCACHE_ADMISSION_FREQUENCY=2) as mw:
+            assert self._download(mw, self.request, self.response) is None
+        # counts are kept between runs
+        with self._middleware(HTTPCACHE_ADMISSION_FREQUENCY=2) as mw:
+            assert self._download(mw, self.request, self.response) is not None
+        stats = self.crawler.stats.get_stats(self.spider)
+        self.assertEqual(stats['httpcache/admission/rejected'], 1)
+        self.assertEqual(stats['httpcache/admission/rejected/frequency'], 1)
+        self.assertEqual(stats['httpcache/admission/rejected_bytes'], len(self.response.body))
+
+    def test_frequency_spiders(self):
+        other = Spider('example.org')
+        with self._middleware(HTTPCACHE_ADMISSION_FREQUENCY=2) as mw:
+            mw.spider_opened(other)
+            try:
+                assert self._download(mw, self.request, self.response) is None
+                # counted for each spider
+                assert mw.process_request(self.request, other) is None
+                mw.process_response(self.request, self.response, other)
+                assert mw.storage.retrieve_response(other, self.request) is None
+            finally:
+                mw.spider_closed(other)
+            self.assertEqual(list(mw.admission.sketches), [self.spider])
+        self.assertEqual(mw.admission.sketches, {})
+
+    def test_max_body_size(self):
+        with self._middleware(HTTPCACHE_ADMISSION_MAX_BODY_SIZE=5) as mw:
+            assert self._download(mw, self.request, self.response) is None
+            response = self.response.replace(body=b'tiny')
+            assert self._download(mw, self.request, response) is not None
+        stats = self.crawler.stats.get_stats(self.spider)
+        self.assertEqual(stats['httpcache/admission/rejected/size'], 1)
+
+    def test_content_types(self):
+        image = self.response.replace(headers={'Content-Type': 'image/png'})
+        html = self.response.replace(headers={'Content-Type': 'text/html; charset=utf-8'})
+        with self._middleware(HTTPCACHE_ADMISSION_CONTENT_TYPES=['text/*']) as mw:
+            assert self._download(mw, Request('http://www.example.com/a.png'), image) is None
+            assert self._download(mw, Request('http://www.example.com/a'), html) is not None
+        with self._middleware(HTTPCACHE_ADMISSION_IGNORE_CONTENT_TYPES=['image/*']) as mw:
+            assert self._download(mw, Request('http://www.example.com/b.png'), image) is None
+            assert self._download(mw, Request('http://www.example.com/b'), html) is not None
+        stats = self.crawler.stats.get_stats(self.spider)
+        self.assertEqual(stats['httpcache/admission/rejected/content_type'], 2)
+
+
+class InstrumentationTest(_BaseTest):
+
+    policy_class = 'scrapy_httpcache.policy.DummyPolicy'
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 101):
+            histogram.add(ms / 1000.0)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.max, 0.1)
+        self.assertAlmostEqual(histogram.percentile(50), 0.05, delta=0.005)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta=0.01)
+        self.assertEqual(histogram.percentile(100), 0.1)
+        self.assertEqual(LatencyHistogram().percentile(50), 0.0)
+
+    def test_disabled(self):
+        with self._middleware() as mw:
+            assert mw.instrumentation is None
+            mw.process_request(self.request, self.spider)
+            mw.process_response(self.request, self.response, self.spider)
+        stats = self.crawler.stats.get_stats(self.spider)
+        assert not any(k.startswith('httpcache/latency/') for k in stats)
+        assert 'httpcache/bytes_written' not in stats
+
+    def test_stats(self):
+        with self._middleware(HTTPCACHE_INSTRUMENTATION=True) as mw:
+            mw.process_request(self.request, self.spider)
+            mw.process_response(self.request, self.response, self.spider)
+            mw.process_request(self.request, self.spider)
+            mw.process_request(self.request, self.spider)
+        stats = self.crawler.stats.get_stats(self.spider)
+        self.assertEqual(stats['httpcache/latency/retrieve/count'], 3)
+        self.assertEqual(stats['httpcache/latency/store/count'], 1)
+        for op in ('retrieve', 'store', 'policy'):
+            for key in ('p50', 'p95', 'p99', 'max'):
+                assert stats['httpcache/latency/%s/%s' % (op, key)] >= 0
+        self.assertEqual(stats['httpcache/bytes_written'], len(self.response.body))
+        self.assertEqual(stats['httpcache/bytes_read'], 2 * len(self.response.body))
+        self.assertEqual(stats['httpcache/domain/www.example.com/hit'], 2)
+        self.assertEqual(stats['httpcache/domain/www.example.com/miss'], 1)
+        self.assertAlmostEqual(stats['httpcache/domain/www.example.com/hit_ratio'], 2 / 3.0)
+
+    def test_signal(self):
+        received = []
+        def handler(operation, duration, nbytes, request, spider):
+            received.append((operation, nbytes))
+        self.crawler.signals.connect(handler, signal=httpcache_operation)
+        settings = self._get_settings(HTTPCACHE_INSTRUMENTATION=True)
+        mw = HttpCacheMiddleware(settings, self.crawler.stats, self.crawler)
+        mw.spider_opened(self.spider)
+        try:
+            mw.process_request(self.request, self.spider)
+            mw.process_response(self.request, self.response, self.spider)
+        finally:
+            mw.spider_closed(self.spider)
+        assert ('retrieve', 0) in received
+        assert ('store', len(self.response.body)) in received
+        assert any(op == 'policy' for op, _ in received)
+
+
+class TraceTest(_BaseTest):
+
+    policy_class = 'scrapy_httpcache.policy.DummyPolicy'
+
+    def _trace(self):
+        return list(trace.read_trace(trace.trace_path(self.tmpdir, self.spider.name)))
+
+    def test_disabled(self):
+        with self._middleware() as mw:
+            assert mw.trace is None
+        assert not os.path.exists(trace.trace_path(self.tmpdir, self.spider.name))
+
+    def test_record(self):
+        response = self.response.replace(headers={'Cache-Control': 'max-age=60'})
+        with self._middleware(HTTPCACHE_TRACE=True) as mw:
+            mw.process_request(self.request, self.spider)
+            mw.process_response(self.request, response, self.spider)
+            mw.process_request(self.request, self.spider)
+        # appended to by the next runs
+        with self._middleware(HTTPCACHE_TRACE=True, HTTPCACHE_EXPIRATION_SECS=0) as mw:
+            mw.process_request(self.request, self.spider)
+        events = self._trace()
+        self.assertEqual([e.event for e in events],
+                         [trace.MISS, trace.STORE, trace.HIT, trace.HIT])
+        fingerprint = request_fingerprint(self.request)
+        for e in events:
+            self.assertEqual(e.fingerprint, fingerprint)
+            self.assertEqual(e.domain, 'www.example.com')
+            self.assertAlmostEqual(e.time, time.time(), delta=60)
+            assert e.latency >= 0
+        store, hit = events[1], events[2]
+        self.assertEqual((store.status, store.size), (202, len(response.body)))
+        self.assertAlmostEqual(store.lifetime, 60, delta=1)
+        assert store.cacheable  # has an expiration
+        self.assertEqual((hit.status, hit.size), (202, len(response.body)))
+
+    def test_domains(self):
+        # with the same CRC-32
+        path = trace.trace_path(self.tmpdir, self.spider.name)
+        for domains in (['plumless', 'buckeroo'], ['buckeroo', 'plumless']):
+            writer = trace.TraceWriter(path)
+            for domain in domains + domains:
+                writer.write(trace.MISS, request_fingerprint(self.request), domain)
+            writer.close()
+        self.assertEqual([e.domain for e in self._trace()],
+                         ['plumless', 'buckeroo'] * 2 + ['buckeroo', 'plumless'] * 2)
+
+    def test_background_revalidation(self):
+        with self._middleware(HTTPCACHE_TRACE=True) as mw:
+            mw.process_request(self.request, self.spider)
+            mw.process_response(self.request, self.response, self.spider)
+            revalidation = self.request.replace(
+                meta={'_httpcache_revalidation': request_fingerprint(self.request)})
+            assert mw.process_request(revalidation, self.spider) is None
+        self.assertEqual([e.event for e in self._trace()], [trace.MISS, trace.STORE])
+
+    def test_truncated(self):
+        with self._middleware(HTTPCACHE_TRACE=True) as mw:
+            mw.process_request(self.request, self.spider)
+        path = trace.trace_path(self.tmpdir, self.spider.name)
+        with open(path, 'ab') as f:
+            f.write(b'\x01\x00')
+        self.assertEqual([e.event for e in self._trace()], [trace.MISS])
+        # in a domain record, or its name
+        for data in (b'\x00\x01', trace.DOMAIN.pack(0, 1, 10) + b'www'):
+            with open(path, 'rb') as f:
+                complete = f.read()
+            with open(path, 'wb') as f:
+                f.write(complete[:-2] + data)
+            self.assertEqual([e.event for e in self._trace()], [trace.MISS])
+            with open(path, 'wb') as f:
+                f.write(complete)
+        with open(path, 'wb') as f:
+            f.write(b'not a trace')
+        self.assertRaises(ValueError, self._trace)
+
+    def test_policy_metadata(self):
+        response = self.response.replace(headers={'Cache-Control': 'max-age=60',
+                                                  'Date': self.today})
+        for policy, shared in [('scrapy_httpcache.policy.DummyPolicy', False),
+                               ('scrapy_httpcache.policy.RFC2616Policy', True),
+                               ('scrapy_httpcache.policy.AdaptivePolicy', False)]:
+            with self._middleware(HTTPCACHE_TRACE=True, HTTPCACHE_POLICY=policy) as mw:
+                self.assertEqual(mw.trace.shared, shared)
+                self.assertEqual(mw.trace.http is mw.policy, shared)
+                metadata = mw.policy.get_cache_metadata(response, self.request)
+                if shared:
+                    # not computed again
+                    mw.trace.http._compute_cache_metadata = None
+                    mw.trace.http.should_cache_response = None
+                mw.trace.written(self.spider, self.request, trace.STORE, response,
+                                 metadata=metadata, cacheable=True)
+            store = self._trace()[-1]
+            self.assertAlmostEqual(store.lifetime, 60, delta=1)
+            assert store.cacheable
+
+    def _events(self, *events):
+        # (event, key, time, size, lifetime, cacheable)
+        return [trace.TraceEvent(event, hashlib.sha1(to_bytes(key)).hexdigest(), t,
+                                 'example.com', 200, size, 0.0, lifetime, cacheable)
+                for event, key, t, size, lifetime, cacheable in events]
+
+    def test_simulate(self):
+        events = self._events(
+            (trace.MISS, 'a', 0, 0, -1, False),
+            (trace.STORE, 'a', 0, 100, 10, True),
+            (trace.MISS, 'b', 1, 0, -1, False),
+            (trace.STORE, 'b', 1, 200, 0, False),
+            (trace.HIT, 'a', 20, 100, -1, False),
+            (trace.HIT, 'b', 21, 200, -1, False),
+            (trace.MISS, 'c', 22, 0, -1, False),  # never downloaded
+        )
+        report = trace.CacheSimulator().run(events)
+        self.assertEqual((report.lookups, report.hits, report.misses), (5, 2, 3))
+        self.assertEqual(report.recorded_hits, 2)
+        self.assertEqual(report.stores, 2)
+        self.assertEqual(report.downloaded_bytes, 300)
+        self.assertEqual(report.max_bytes, 300)
+        # stale after 10 seconds, b is not cacheable
+        report = trace.CacheSimulator(policy='rfc2616').run(events)
+        self.assertEqual((report.hits, report.misses, report.revalidations), (0, 4, 1))
+        self.assertEqual(report.stores, 1)
+        self.assertEqual(report.downloaded_bytes, 600)
+        # expired after 5 seconds
+        report = trace.CacheSimulator(expiration=ExpirationRules(0, {'example.com': 5})).run(events)
+        self.assertEqual((report.hits, report.revalidations), (0, 2))
+        # a and b keep evicting each other
+        report = trace.CacheSimulator(max_bytes=250).run(events)
+        self.assertEqual((report.hits, report.evictions, report.max_bytes), (0, 3, 200))
+        # admission filters
+        report = trace.CacheSimulator(frequency=2).run(events)
+        self.assertEqual((report.hits, report.stores, report.rejected), (0, 2, 2))
+        report = trace.CacheSimulator(max_body_size=150).run(events)
+        self.assertEqual((report.hits, report.stores, report.rejected), (1, 1, 2))
+        assert 'Hit ratio:' in report.format()
+
+    def test_simulator_settings(self):
+        settings = self._get_settings(HTTPCACHE_MAX_ENTRIES=10,
+                                      HTTPCACHE_EVICTION_POLICY='LFU',
+                                      HTTPCACHE_IGNORE_HTTP_CODES=[404])
+        simulator = trace.CacheSimulator.from_settings(settings)
+        self.assertEqual(simulator.policy, 'dummy')
+        self.assertEqual((simulator.max_entries, simulator.eviction), (10, 'lfu'))
+        self.assertEqual(simulator.ignore_http_codes, set([404]))
+        settings = self._get_settings(HTTPCACHE_POLICY='scrapy_httpcache.policy.RFC9111Policy')
+        self.assertEqual(trace.CacheSimulator.from_settings(settings).policy, 'rfc2616')
+        self.assertRaises(ValueError, trace.CacheSimulator, policy='unknown')
+
+
 if __name__ == '__main__':
     unittest.main()